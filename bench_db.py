@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""بنچمارک متدهای دیتابیس در چند مقیاس داده
+
+داده مصنوعی (کاربر، پیام، پاسخ) در یک پوشه موقت ساخته می‌شود و هر متد بعد از
+گرم کردن چند بار اندازه‌گیری می‌شود. خروجی JSON است و می‌توان آن را با اجرای قبلی مقایسه کرد.
+
+    python bench_db.py --scales 10000,100000 --output before.json
+    python bench_db.py --scales 10000,100000 --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CHATS = 50
+LOAD_BATCH = 5000
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def measure(func, setup=None, warmup=2, repeat=10):
+    for _ in range(warmup):
+        if setup:
+            setup()
+        func()
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {
+        "repeat": repeat,
+        "min_ms": round(min(timings) * 1000, 4),
+        "median_ms": round(statistics.median(timings) * 1000, 4),
+        "mean_ms": round(statistics.mean(timings) * 1000, 4),
+        "p95_ms": round(percentile(timings, 95) * 1000, 4),
+    }
+
+
+def populate(db, rows, rng):
+    users = max(100, min(rows // 100, 100_000))
+    words = max(100, min(rows // 100, 50_000))
+    for user_id in range(1, users + 1):
+        db.add_user(user_id, f"user{user_id}", f"User {user_id}")
+    for index in range(words):
+        db.add_response(f"word{index}", f"response {index}", 1)
+
+    # پیام‌ها در ۳۰ روز اخیر پخش می‌شوند تا شمارنده‌های هفتگی هم پر شوند
+    now = datetime.now()
+    started = time.perf_counter()
+    for offset in range(0, rows, LOAD_BATCH):
+        batch = []
+        for index in range(min(LOAD_BATCH, rows - offset)):
+            date = now - timedelta(seconds=rng.randrange(30 * 86400))
+            batch.append((rng.randint(1, users), -(1000 + rng.randrange(CHATS)),
+                          f"synthetic message {rng.random():.6f}", date.isoformat(), offset + index + 1))
+        db.add_messages(batch)
+    elapsed = time.perf_counter() - started
+    return users, words, {"rows": rows, "seconds": round(elapsed, 3),
+                          "rows_per_second": round(rows / elapsed, 1) if elapsed else None}
+
+
+def run_scale(bot_module, backend, rows, args):
+    rng = random.Random(rows)
+    db = bot_module.STORAGE_BACKENDS[backend]()
+    try:
+        users, words, load = populate(db, rows, rng)
+        db.flush()
+        chats = [-(1000 + index) for index in range(CHATS)]
+        results = {"load": load}
+
+        def add_message():
+            for _ in range(100):
+                db.add_message(rng.randint(1, users), rng.choice(chats), "benchmark message")
+            db.flush()
+
+        def mute_some():
+            for user_id in rng.sample(range(1, users + 1), min(100, users)):
+                db.mute_user(user_id, -1)
+
+        benchmarks = {
+            "add_message_x100": (add_message, None),
+            "add_messages_batch500": (
+                lambda: db.add_messages([(rng.randint(1, users), rng.choice(chats), "batch message",
+                                          datetime.now().isoformat(), None) for _ in range(500)]), None),
+            "get_user": (lambda: db.get_user(rng.randint(1, users)), None),
+            "get_top_users_chat": (lambda: db.get_top_users(rng.choice(chats), 10), None),
+            "get_top_users_global": (lambda: db.get_top_users(None, 10), None),
+            "get_weekly_top_users": (lambda: db.get_weekly_top_users(rng.choice(chats)), None),
+            "get_responses": (lambda: db.get_responses(f"word{rng.randrange(words)}"), None),
+            "get_all_response_pairs": (db.get_all_response_pairs, None),
+            "get_all_users": (db.get_all_users, None),
+            "get_message_count": (db.get_message_count, None),
+            "get_message_ids_last": (lambda: db.get_message_ids(rng.choice(chats), 100), None),
+            "get_message_ids_user": (
+                lambda: db.get_message_ids(rng.choice(chats), 100, user_id=rng.randint(1, users)), None),
+            "get_message_ids_since": (
+                lambda: db.get_message_ids(rng.choice(chats), 100,
+                                           since=(datetime.now() - timedelta(hours=1)).isoformat()), None),
+            "get_upcoming_mutes": (lambda: db.get_upcoming_mutes(datetime.now().isoformat()), mute_some),
+        }
+
+        for name, (func, setup) in benchmarks.items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(func, setup, args.warmup, args.repeat)
+            print(f"  {rows:>10} {name:<26} median {results[name]['median_ms']:>10.3f} ms", flush=True)
+        return results
+    finally:
+        db.close()
+
+
+def compare(current, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\ncompared with {baseline_path} (commit {baseline.get('commit')}):")
+    regressions = 0
+    for scale, methods in current["results"].items():
+        old_methods = baseline.get("results", {}).get(scale, {})
+        for name, stats in methods.items():
+            old = old_methods.get(name)
+            if not old or "median_ms" not in stats or not old.get("median_ms"):
+                continue
+            ratio = stats["median_ms"] / old["median_ms"]
+            marker = ""
+            if ratio > 1 + threshold:
+                marker = "  SLOWER"
+                regressions += 1
+            elif ratio < 1 - threshold:
+                marker = "  faster"
+            print(f"  {scale:>10} {name:<26} {old['median_ms']:>10.3f} -> {stats['median_ms']:>10.3f} ms"
+                  f"  x{ratio:.2f}{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks for the storage backends")
+    parser.add_argument("--scales", default="10000,100000",
+                        help="comma separated message counts, e.g. 10000,100000,1000000,10000000")
+    parser.add_argument("--backend", default="sqlite", choices=("sqlite", "sharded", "memory"))
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--only", type=lambda value: set(value.split(",")), help="comma separated benchmark names")
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary database directory")
+    args = parser.parse_args()
+    args.output = args.output and os.path.abspath(args.output)
+    args.compare = args.compare and os.path.abspath(args.compare)
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    # bot.py فایل‌ها را در پوشه جاری می‌سازد؛ قبل از import به پوشه موقت می‌رویم
+    os.chdir(workdir)
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    sys.path.insert(0, BOT_DIR)
+    import bot as bot_module
+    bot_module.logger.setLevel("WARNING")
+
+    output = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(),
+        "backend": args.backend,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "warmup": args.warmup,
+        "repeat": args.repeat,
+        "results": {},
+    }
+    try:
+        for scale in (int(value) for value in args.scales.split(",")):
+            scale_dir = os.path.join(workdir, str(scale))
+            os.makedirs(scale_dir)
+            os.chdir(scale_dir)
+            print(f"scale {scale}: loading...", flush=True)
+            output["results"][str(scale)] = run_scale(bot_module, args.backend, scale, args)
+            os.chdir(workdir)
+            if not args.keep:
+                shutil.rmtree(scale_dir)
+    finally:
+        bot_module.bot.async_db.close()
+        bot_module.bot.db.close()
+        os.chdir(BOT_DIR)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        regressions = compare(output, args.compare, args.threshold)
+        if regressions:
+            print(f"\n{regressions} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,23 +6,52 @@ import random
 import sqlite3
 import json
 import re
+import string
 import time
 import os
 import threading
-from datetime import datetime, timedelta
+import atexit
+import abc
+import bisect
+import functools
+import hashlib
+import queue
+from contextlib import contextmanager
+import tempfile
+import struct
+import zlib
+import heapq
+import itertools
+import multiprocessing
+import signal
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Tuple, Optional
 import asyncio
 
+import httpx
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
+
+from spamhash import SPAM_MIN_LENGTH, fingerprint_text
 
 # ==================== تنظیمات ====================
 TOKEN = os.environ.get("BOT_TOKEN")
@@ -30,6 +59,106 @@ ADMIN_ID = 8223560115
 DATABASE_NAME = "bot_database.db"
 CONFIG_FILE = "bot_config.json"
 
+# ذخیره تاخیری تنظیمات و بررسی تغییر فایل توسط پروسه‌های دیگر
+CONFIG_SAVE_DELAY = float(os.environ.get("CONFIG_SAVE_DELAY", 1.0))
+CONFIG_RELOAD_INTERVAL = float(os.environ.get("CONFIG_RELOAD_INTERVAL", 5))
+
+# تنظیمات SQLite: یک اتصال نویسنده و چند اتصال فقط‌خواندنی در حالت WAL
+READER_POOL_SIZE = int(os.environ.get("READER_POOL_SIZE", 4))
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", 20000))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+
+# حالت اجرا: polling یا webhook
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = os.environ.get("PORT", "8443")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# صف ذخیره‌سازی دسته‌ای پیام‌ها
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+INGEST_FLUSH_INTERVAL = float(os.environ.get("INGEST_FLUSH_INTERVAL", 0.5))
+# بیش از این تعداد پیام در صف، پیام‌های جدید دور ریخته می‌شوند (bot_messages_shed_total)
+INGEST_MAX_PENDING = int(os.environ.get("INGEST_MAX_PENDING", 20000))
+INGEST_RETRY_MAX_DELAY = float(os.environ.get("INGEST_RETRY_MAX_DELAY", 5))
+
+# محدودیت ارسال تلگرام (حدود ۳۰ پیام در ثانیه برای کل ربات)
+SEND_RATE_LIMIT = float(os.environ.get("SEND_RATE_LIMIT", 25))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 8))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", 5))
+# هر کار همگانی مالک دارد؛ اگر مالک این مدت اجاره را تمدید نکند، کار دیگری ادامه‌اش می‌دهد
+BROADCAST_LEASE = float(os.environ.get("BROADCAST_LEASE", 60))
+
+# نگهداری و بایگانی پیام‌های قدیمی
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", 86400))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 2000))
+RETENTION_VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", 2000))
+
+# کش ردیف کاربران
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 300))
+
+# کش زبان کاربران و فاصله ذخیره تغییرات آن
+LANGUAGE_CACHE_SIZE = int(os.environ.get("LANGUAGE_CACHE_SIZE", 50000))
+LANGUAGE_FLUSH_INTERVAL = float(os.environ.get("LANGUAGE_FLUSH_INTERVAL", 2))
+
+# ورود اعضای جدید هر گروه در این بازه جمع و یکجا خوش‌آمد گفته می‌شود
+JOIN_WINDOW = float(os.environ.get("JOIN_WINDOW", 3))
+JOIN_MAX_NAMES = int(os.environ.get("JOIN_MAX_NAMES", 10))
+JOIN_RESTRICT_CONCURRENCY = int(os.environ.get("JOIN_RESTRICT_CONCURRENCY", 5))
+JOIN_HISTORY_SIZE = int(os.environ.get("JOIN_HISTORY_SIZE", 1000))
+
+# دستورهای گروهی مدیریت (!mute و ...) روی چند کاربر
+MODERATION_CONCURRENCY = int(os.environ.get("MODERATION_CONCURRENCY", 5))
+MODERATION_MAX_TARGETS = int(os.environ.get("MODERATION_MAX_TARGETS", 500))
+WARN_MUTE_MINUTES = int(os.environ.get("WARN_MUTE_MINUTES", 120))
+
+# پاک کردن پیام‌ها با /clean
+CLEAN_MAX_MESSAGES = int(os.environ.get("CLEAN_MAX_MESSAGES", 1000))
+CLEAN_CONCURRENCY = int(os.environ.get("CLEAN_CONCURRENCY", 5))
+CLEAN_BATCH_SIZE = 100
+CLEAN_PROGRESS_INTERVAL = float(os.environ.get("CLEAN_PROGRESS_INTERVAL", 3))
+
+# تقسیم آپدیت‌ها بر اساس chat_id بین چند پروسه؛ ۱ یعنی اجرای تک‌پروسه‌ای
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 1))
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 10000))
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", 30))
+CHANGE_POLL_INTERVAL = float(os.environ.get("CHANGE_POLL_INTERVAL", 1))
+CHANGE_LOG_TTL = int(os.environ.get("CHANGE_LOG_TTL", 3600))
+
+# ذخیره‌سازی تقسیم‌شده: یک فایل SQLite برای هر گروه
+SHARD_DIR = os.environ.get("SHARD_DIR", "shards")
+SHARD_MAX_OPEN = int(os.environ.get("SHARD_MAX_OPEN", 256))
+
+# ردیابی دستورهای SQL (پیش‌فرض خاموش) و آستانه ثبت دستور کند
+SQL_TRACE = os.environ.get("SQL_TRACE", "0") == "1"
+SQL_SLOW_MS = float(os.environ.get("SQL_SLOW_MS", 50))
+
+# تشخیص فلود: حداکثر تعداد (گروه، کاربر) در حافظه و مدت اعتبار اخطارها
+FLOOD_MAX_TRACKED = int(os.environ.get("FLOOD_MAX_TRACKED", 200000))
+FLOOD_STRIKE_TTL = int(os.environ.get("FLOOD_STRIKE_TTL", 3600))
+
+# تشخیص پیام‌های تکراری بین گروه‌ها (SimHash + LSH)
+# SPAM_MIN_LENGTH و SPAM_SHINGLE_SIZE در spamhash.py تعریف شده‌اند
+SPAM_MAX_DISTANCE = int(os.environ.get("SPAM_MAX_DISTANCE", 3))
+SPAM_MAX_ENTRIES = int(os.environ.get("SPAM_MAX_ENTRIES", 100000))
+SPAM_BUCKET_SCAN = int(os.environ.get("SPAM_BUCKET_SCAN", 64))
+# بیش از این تعداد پیام در ثانیه، اثر انگشت در پروسه‌های جدا محاسبه می‌شود؛ ۰ یعنی همیشه در همین پروسه
+SPAM_POOL_WORKERS = int(os.environ.get("SPAM_POOL_WORKERS", 2))
+SPAM_POOL_RATE = int(os.environ.get("SPAM_POOL_RATE", 50))
+SPAM_DELETE_CONCURRENCY = int(os.environ.get("SPAM_DELETE_CONCURRENCY", 5))
+
+# خروجی متریک‌ها با فرمت Prometheus؛ ۰ یعنی غیرفعال
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+
+# زمان‌بندی پایان سکوت و ادمینی؛ فقط مهلت‌های این بازه در حافظه نگه داشته می‌شوند
+EXPIRY_HORIZON = int(os.environ.get("EXPIRY_HORIZON", 3600))
+
 # تنظیم لاگ انگلیسی
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -37,9 +166,221 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== متریک‌ها ====================
+# مرز سطل‌های هیستوگرام به ثانیه
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q):
+        # تخمین خطی داخل سطل، مثل histogram_quantile در Prometheus
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class Metrics:
+    # شمارنده‌ها و هیستوگرام‌ها در حافظه؛ خروجی با فرمت متنی Prometheus
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.label_names = {}
+        self.buckets = {}
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+        self.port = METRICS_PORT
+    
+    def counter(self, name, labels, help_text):
+        self.kinds[name], self.label_names[name], self.help[name] = "counter", labels, help_text
+    
+    def histogram(self, name, labels, help_text, buckets=LATENCY_BUCKETS):
+        self.kinds[name], self.label_names[name], self.help[name] = "histogram", labels, help_text
+        self.buckets[name] = buckets
+    
+    def gauge(self, name, help_text, func):
+        self.kinds[name], self.label_names[name], self.help[name] = "gauge", (), help_text
+        self.gauges[name] = func
+    
+    def inc(self, name, *labels, amount=1):
+        with self.lock:
+            self.counters[(name, labels)] += amount
+    
+    def observe(self, name, value, *labels):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets[name])
+            histogram.observe(value)
+    
+    def counter_value(self, name, *labels):
+        return self.counters.get((name, labels), 0)
+    
+    def counter_total(self, name, where=None):
+        with self.lock:
+            return sum(value for (metric, labels), value in self.counters.items()
+                       if metric == name and (where is None or where(labels)))
+    
+    def summary(self, name, limit=10):
+        # (برچسب، تعداد، p50، p95، مجموع) به ترتیب بیشترین زمان کل
+        with self.lock:
+            rows = [(labels[0] if labels else "", h.count, h.quantile(0.5), h.quantile(0.95), h.sum)
+                    for (metric, labels), h in self.histograms.items() if metric == name]
+        return sorted(rows, key=lambda row: row[4], reverse=True)[:limit]
+    
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    
+    @classmethod
+    def _labels(cls, names, values, extra=""):
+        pairs = [f'{name}="{cls._escape(value)}"' for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()}
+        
+        lines = []
+        for name, kind in self.kinds.items():
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            names = self.label_names[name]
+            if kind == "counter":
+                for (metric, labels), value in counters.items():
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(names, labels)} {value:g}")
+            elif kind == "histogram":
+                for (metric, labels), (counts, total, count) in histograms.items():
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets[name] + ("+Inf",), counts):
+                        cumulative += bucket_count
+                        le = f'le="{bound}"'
+                        lines.append(f"{name}_bucket{self._labels(names, labels, le)} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(names, labels)} {total:.6f}")
+                    lines.append(f"{name}_count{self._labels(names, labels)} {count}")
+            else:
+                try:
+                    lines.append(f"{name} {self.gauges[name]():g}")
+                except Exception as e:
+                    logger.error(f"Error reading gauge {name}: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.counter("bot_updates_total", ("type",), "Updates received by type")
+metrics.histogram("bot_update_lag_seconds", (), "Delay between message date and processing", LAG_BUCKETS)
+metrics.histogram("bot_handler_seconds", ("handler",), "Handler callback latency")
+metrics.counter("bot_handler_errors_total", ("handler",), "Handler callbacks that raised")
+metrics.histogram("bot_db_seconds", ("method",), "Database method execution time")
+metrics.histogram("bot_db_queue_seconds", ("pool",), "Time a database call waited for an executor thread")
+metrics.histogram("bot_telegram_api_seconds", ("method",), "Bot API request latency")
+metrics.counter("bot_telegram_requests_total", ("method", "outcome"), "Bot API requests by HTTP status or error")
+metrics.counter("bot_messages_stored_total", (), "Messages written by the ingest queue")
+metrics.counter("bot_messages_shed_total", (), "Messages dropped because the ingest queue was full")
+metrics.counter("bot_sql_slow_total", (), "SQL statements slower than SQL_SLOW_MS (SQL_TRACE=1)")
+metrics.counter("bot_flood_actions_total", ("action",), "Messages flagged by the flood detector")
+metrics.counter("bot_spam_fingerprints_total", ("where",), "Message fingerprints computed inline or in the process pool")
+metrics.counter("bot_spam_clusters_total", (), "Near-duplicate clusters that crossed the spam threshold")
+metrics.counter("bot_spam_deleted_total", (), "Messages deleted as near-duplicate spam")
+metrics.counter("bot_joins_total", (), "Members that joined a group")
+metrics.counter("bot_raids_total", (), "Join raids detected")
+metrics.counter("bot_moderation_actions_total", ("action", "outcome"), "Per-user results of quick moderation commands")
+metrics.counter("bot_clean_deleted_total", ("outcome",), "Messages handled by /clean")
+
+def instrument_handler(callback):
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, name)
+    
+    return wrapper
+
+# نام فیلدهای نوع آپدیت؛ پرتکرارها (message) اول هستند
+UPDATE_TYPES = tuple(kind.value for kind in Update.ALL_TYPES)
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # در گروه -1 قبل از هندلرهای اصلی اجرا می‌شود
+    metrics.inc("bot_updates_total", next((kind for kind in UPDATE_TYPES if getattr(update, kind, None) is not None),
+                                          "unknown"))
+    message = update.effective_message
+    if message and message.date:
+        sent = message.edit_date or message.date
+        metrics.observe("bot_update_lag_seconds", max(0.0, (datetime.now(timezone.utc) - sent).total_seconds()))
+
+class MetricsRequest(HTTPXRequest):
+    # زمان و نتیجه هر درخواست Bot API
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_telegram_requests_total", api_method, type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_telegram_api_seconds", time.perf_counter() - started, api_method)
+        metrics.inc("bot_telegram_requests_total", api_method, code)
+        return code, payload
+
+async def serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
 # ==================== کلاس تنظیمات ====================
 class BotConfig:
     def __init__(self):
+        self.lock = threading.Lock()
+        self.save_timer = None
+        self.dirty_keys = set()
+        self.file_stat = None
         self.config = self.load_config()
     
     def load_config(self):
@@ -58,41 +399,873 @@ class BotConfig:
             "contest_enabled": True,
             "contest_prize_days": 3,
             "max_warnings": 3,
-            "mute_duration": 60
+            "mute_duration": 60,
+            "message_retention_days": 0,
+            "antispam_enabled": True,
+            "flood_max_messages": 5,
+            "flood_window_seconds": 5,
+            "duplicate_detection_enabled": True,
+            "duplicate_chat_threshold": 4,
+            "duplicate_user_threshold": 6,
+            "duplicate_window_seconds": 600,
+            "raid_join_threshold": 20,
+            "raid_window_seconds": 60,
+            "raid_mute_minutes": 0,
+            "storage_backend": "sqlite"
         }
         
-        try:
-            if os.path.exists(CONFIG_FILE):
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    loaded = json.load(f)
-                    default_config.update(loaded)
-        except Exception as e:
-            logger.error(f"Error loading config: {e}")
+        loaded, ok = self._read()
+        if loaded:
+            default_config.update(loaded)
         
         self.config = default_config
-        self.save_config()
+        # فایل فقط وقتی نوشته می‌شود که وجود ندارد یا کلید جدیدی اضافه شده
+        if ok and (loaded is None or set(default_config) - set(loaded)):
+            self.save_config()
         return default_config
     
-    def save_config(self):
+    def _stat(self):
+        try:
+            st = os.stat(CONFIG_FILE)
+            return (st.st_mtime_ns, st.st_ino, st.st_size)
+        except FileNotFoundError:
+            return None
+    
+    def _read(self):
+        stat = self._stat()
+        if stat is None:
+            return None, True
         try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, ensure_ascii=False, indent=4)
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            self.file_stat = stat
+            return loaded, True
         except Exception as e:
-            logger.error(f"Error saving config: {e}")
+            logger.error(f"Error loading config: {e}")
+            return None, False
+    
+    def save_config(self):
+        with self.lock, open(CONFIG_FILE + ".lock", 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            
+            # تغییرات پروسه‌های دیگر حفظ می‌شود؛ فقط کلیدهای تغییرکرده اینجا بازنویسی می‌شوند
+            loaded, ok = self._read()
+            if loaded:
+                merged = dict(self.config)
+                merged.update({k: v for k, v in loaded.items() if k not in self.dirty_keys})
+                self.config = merged
+            snapshot = dict(self.config)
+            
+            # نوشتن اتمیک: فایل موقت و سپس جایگزینی
+            try:
+                directory = os.path.dirname(os.path.abspath(CONFIG_FILE))
+                fd, tmp_path = tempfile.mkstemp(prefix=".bot_config.", dir=directory)
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        json.dump(snapshot, f, ensure_ascii=False, indent=4)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, CONFIG_FILE)
+                except Exception:
+                    os.unlink(tmp_path)
+                    raise
+                self.file_stat = self._stat()
+                # فقط بعد از نوشتن موفق؛ وگرنه ادغام بعدی مقدار قدیمی فایل را برمی‌گرداند
+                self.dirty_keys.clear()
+            except Exception as e:
+                logger.error(f"Error saving config, retrying in {CONFIG_SAVE_DELAY}s: {e}")
+                self._schedule_save()
+    
+    def _save_pending(self):
+        with self.lock:
+            self.save_timer = None
+        self.save_config()
+    
+    def flush(self):
+        with self.lock:
+            timer, self.save_timer = self.save_timer, None
+        if timer:
+            timer.cancel()
+            self.save_config()
+    
+    def reload_if_changed(self):
+        # بررسی ارزان با mtime/inode؛ فقط در صورت تغییر فایل دوباره خوانده می‌شود
+        if self._stat() == self.file_stat or self.save_timer:
+            return False
+        with self.lock:
+            loaded, ok = self._read()
+            if not loaded:
+                return False
+            merged = dict(self.config)
+            merged.update(loaded)
+            self.config = merged
+        logger.info("Config reloaded from disk")
+        return True
     
     def get(self, key, default=None):
         return self.config.get(key, default)
     
     def set(self, key, value):
-        self.config[key] = value
-        self.save_config()
+        with self.lock:
+            self.config[key] = value
+            self.dirty_keys.add(key)
+            self._schedule_save()
+        return True
+    
+    def _schedule_save(self):
+        # با self.lock صدا زده می‌شود؛ چند تغییر پشت سر هم در یک نوشتن ادغام می‌شوند
+        if self.save_timer is None:
+            self.save_timer = threading.Timer(CONFIG_SAVE_DELAY, self._save_pending)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+# ==================== صف ذخیره پیام‌ها ====================
+class PartialWriteError(Exception):
+    # بخشی از دسته نوشته شده؛ rows فقط ردیف‌های باقی‌مانده است
+    def __init__(self, message, rows):
+        super().__init__(message)
+        self.rows = rows
+
+class MessageIngestQueue:
+    def __init__(self, db, batch_size=INGEST_BATCH_SIZE, flush_interval=INGEST_FLUSH_INTERVAL,
+                 max_pending=INGEST_MAX_PENDING):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.pending_since = 0.0
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.shedding = False
+        self.failures = 0
+        self.flushed = 0
+        self.thread = threading.Thread(target=self._run, name="message-ingest", daemon=True)
+        self.thread.start()
+    
+    def put(self, user_id, chat_id, text, message_id=None):
+        with self.cond:
+            if self.closed:
+                return False
+            # فشار برگشتی بدون مسدود کردن حلقه رویداد: وقتی دیتابیس عقب است پیام جدید کنار گذاشته می‌شود
+            if len(self.pending) >= self.max_pending:
+                if not self.shedding:
+                    logger.warning(f"Ingest queue full ({len(self.pending)} messages), shedding new messages")
+                    self.shedding = True
+                metrics.inc("bot_messages_shed_total")
+                return False
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending.append((user_id, chat_id, text, datetime.now().isoformat(), message_id))
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
         return True
+    
+    def _take_batch(self):
+        batch = self.pending
+        self.pending = []
+        self.shedding = False
+        self.cond.notify_all()
+        return batch
+    
+    def _write(self, batch):
+        # ردیف‌های ناموفق به ابتدای صف برمی‌گردند تا نوبت بعد نوشته شوند
+        if not batch:
+            return True
+        with self.write_lock:
+            try:
+                started = time.perf_counter()
+                self.db.add_messages(batch)
+                metrics.observe("bot_db_seconds", time.perf_counter() - started, "add_messages")
+                metrics.inc("bot_messages_stored_total", amount=len(batch))
+                self.flushed += len(batch)
+                return True
+            except PartialWriteError as e:
+                logger.error(f"Error flushing {len(e.rows)} of {len(batch)} messages: {e}")
+                metrics.inc("bot_messages_stored_total", amount=len(batch) - len(e.rows))
+                self.flushed += len(batch) - len(e.rows)
+                failed = e.rows
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} messages: {e}")
+                failed = batch
+        with self.cond:
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending[:0] = failed
+        return False
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending and self.closed:
+                    return
+                # هنگام توقف با دیتابیس خراب تا ابد منتظر نمی‌مانیم
+                if self.closed and self.failures >= 3:
+                    return
+                deadline = self.pending_since + self.flush_interval
+                while self.pending and len(self.pending) < self.batch_size and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self._take_batch()
+            if self._write(batch):
+                self.failures = 0
+            else:
+                # فقط نخ نویسنده صبر می‌کند
+                self.failures += 1
+                time.sleep(min(INGEST_RETRY_MAX_DELAY, 0.2 * 2 ** self.failures))
+    
+    def flush(self):
+        with self.cond:
+            batch = self._take_batch()
+        self._write(batch)
+    
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+    
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        # هر چیزی که بعد از توقف نخ باقی مانده
+        self.flush()
+        if self.pending:
+            logger.error(f"Lost {len(self.pending)} messages at shutdown after repeated flush failures")
+        logger.info(f"Message ingest queue drained ({self.flushed} messages stored)")
+
+# ==================== توابع کمکی ====================
+def week_start(when=None):
+    # مسابقه هر یکشنبه ریست می‌شود؛ شروع هفته به صورت YYYY-MM-DD
+    when = when or datetime.now()
+    start = when - timedelta(days=(when.weekday() + 1) % 7)
+    return start.strftime("%Y-%m-%d")
+
+def next_week_start(when=None):
+    when = when or datetime.now()
+    start = datetime.strptime(week_start(when), "%Y-%m-%d")
+    return start + timedelta(days=7)
+
+def _backfill_weekly_counts(cursor):
+    current = week_start()
+    cursor.execute('''
+        INSERT OR REPLACE INTO chat_user_weekly (chat_id, week_start, user_id, message_count)
+        SELECT chat_id, ?, user_id, COUNT(*)
+        FROM messages
+        WHERE date >= ?
+        GROUP BY chat_id, user_id
+    ''', (current, current))
+
+def aggregate_messages(rows):
+    # شمارش پیام‌های یک دسته برای به‌روزرسانی شمارنده‌ها با یک executemany
+    counts = defaultdict(int)
+    chat_counts = defaultdict(int)
+    weekly_counts = defaultdict(int)
+    weeks = {}
+    last_seen = {}
+    for user_id, chat_id, text, date, message_id in rows:
+        day = date[:10]
+        if day not in weeks:
+            weeks[day] = week_start(datetime.fromisoformat(day))
+        counts[user_id] += 1
+        chat_counts[(chat_id, user_id)] += 1
+        weekly_counts[(chat_id, weeks[day], user_id)] += 1
+        last_seen[user_id] = max(date, last_seen.get(user_id, date))
+    return counts, chat_counts, weekly_counts, last_seen
+
+# ==================== بایگانی پیام‌ها ====================
+# هر فایل ماهانه شامل تکه‌هایی است: طول ۴ بایتی + NDJSON فشرده با zlib
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"messages-{month}.ndjson.z")
+
+def append_archive_chunk(path, rows):
+    payload = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+    chunk = zlib.compress(payload, 6)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "ab") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(struct.pack(">I", len(chunk)) + chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_archive(path):
+    # خواندن جریانی؛ هر بار فقط یک تکه در حافظه است
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            chunk = f.read(struct.unpack(">I", header)[0])
+            for line in zlib.decompress(chunk).decode("utf-8").splitlines():
+                yield json.loads(line)
+
+# ==================== کش کاربران ====================
+class UserRowCache:
+    # کش LRU با انقضا برای ردیف‌های جدول users
+    MISSING = object()
+    
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id):
+        with self.lock:
+            entry = self.rows.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.rows.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.rows[user_id]
+            self.misses += 1
+            return self.MISSING
+    
+    def put(self, user_id, row, version):
+        with self.lock:
+            # اگر در حین خواندن نوشتنی انجام شده، ردیف احتمالا قدیمی است
+            if version != self.version:
+                return
+            self.rows[user_id] = (time.monotonic() + self.ttl, row)
+            self.rows.move_to_end(user_id)
+            while len(self.rows) > self.maxsize:
+                self.rows.popitem(last=False)
+    
+    def invalidate(self, *user_ids):
+        with self.lock:
+            self.version += 1
+            for user_id in user_ids:
+                self.rows.pop(user_id, None)
+    
+    def update(self, user_id, func):
+        with self.lock:
+            self.version += 1
+            entry = self.rows.get(user_id)
+            if entry is not None and entry[1] is not None:
+                self.rows[user_id] = (entry[0], func(entry[1]))
+    
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.rows),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+# ==================== مهاجرت‌های دیتابیس ====================
+# هر مهاجرت: (نسخه، توضیح، لیست دستورات SQL یا توابعی که cursor می‌گیرند)
+# مهاجرت‌ها فقط به انتهای لیست اضافه می‌شوند و هرگز تغییر نمی‌کنند
+MIGRATIONS = [
+    (1, "index messages by chat and user", [
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_user ON messages (chat_id, user_id)',
+    ]),
+    (2, "index responses by word", [
+        'CREATE INDEX IF NOT EXISTS idx_responses_word ON responses (word)',
+    ]),
+    (3, "index users by mute and admin expiry", [
+        'CREATE INDEX IF NOT EXISTS idx_users_mute ON users (is_muted, mute_until)',
+        'CREATE INDEX IF NOT EXISTS idx_users_admin ON users (is_admin, admin_until)',
+    ]),
+    (4, "per-chat user message counters", [
+        '''
+            CREATE TABLE IF NOT EXISTS chat_user_stats (
+                chat_id INTEGER,
+                user_id INTEGER,
+                message_count INTEGER DEFAULT 0,
+                last_message TEXT,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''',
+        '''
+            INSERT OR REPLACE INTO chat_user_stats (chat_id, user_id, message_count, last_message)
+            SELECT chat_id, user_id, COUNT(*), MAX(date)
+            FROM messages
+            GROUP BY chat_id, user_id
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_chat_user_stats_top ON chat_user_stats (chat_id, message_count DESC)',
+    ]),
+    (5, "weekly contest counters and per-chat contest results", [
+        '''
+            CREATE TABLE IF NOT EXISTS chat_user_weekly (
+                chat_id INTEGER,
+                week_start TEXT,
+                user_id INTEGER,
+                message_count INTEGER DEFAULT 0,
+                PRIMARY KEY (chat_id, week_start, user_id)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_chat_user_weekly_top ON chat_user_weekly (chat_id, week_start, message_count DESC)',
+        _backfill_weekly_counts,
+        'ALTER TABLE contests ADD COLUMN chat_id INTEGER',
+        'ALTER TABLE contests ADD COLUMN message_count INTEGER',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_contests_chat_week ON contests (chat_id, start_date)',
+    ]),
+    (6, "resumable broadcast jobs", [
+        '''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_by INTEGER,
+                text TEXT,
+                button_text TEXT,
+                button_url TEXT,
+                status TEXT DEFAULT 'running',
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                total INTEGER DEFAULT 0,
+                success INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                created_date TEXT,
+                finished_date TEXT
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                job_id INTEGER,
+                user_id INTEGER,
+                status INTEGER DEFAULT 0,
+                PRIMARY KEY (job_id, user_id)
+            ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)',
+    ]),
+    (7, "message retention policies and archive segments", [
+        'ALTER TABLE group_settings ADD COLUMN retention_days INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages (chat_id, date)',
+        '''
+            CREATE TABLE IF NOT EXISTS archive_segments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                month TEXT,
+                path TEXT,
+                row_count INTEGER,
+                first_id INTEGER,
+                last_id INTEGER,
+                created_date TEXT
+            )
+        ''',
+    ]),
+    (8, "change log for multi-process cache invalidation", [
+        '''
+            CREATE TABLE IF NOT EXISTS change_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                key TEXT,
+                origin INTEGER,
+                created_date TEXT
+            )
+        ''',
+    ]),
+    (9, "telegram message ids for /clean", [
+        'ALTER TABLE messages ADD COLUMN message_id INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_message ON messages (chat_id, message_id)',
+        # جایگزین idx_messages_chat_user با همان پیشوند
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_user_message ON messages (chat_id, user_id, message_id)',
+        'DROP INDEX IF EXISTS idx_messages_chat_user',
+    ]),
+    (10, "broadcast job owner and lease", [
+        'ALTER TABLE broadcast_jobs ADD COLUMN owner TEXT',
+        'ALTER TABLE broadcast_jobs ADD COLUMN lease_until TEXT',
+    ]),
+]
+
+# ==================== ردیابی SQL ====================
+SQL_SPACE_RE = re.compile(r"\s+")
+SQL_PARAMS_RE = re.compile(r"\?(\s*,\s*\?)+")
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+def statement_shape(sql):
+    # فاصله‌ها و لیست‌های متغیر IN (?, ?, ...) یکسان می‌شوند تا هر شکل دستور یک ردیف آمار داشته باشد
+    return SQL_PARAMS_RE.sub("?, ...", SQL_SPACE_RE.sub(" ", sql).strip())
+
+class SqlTracer:
+    # آمار تجمعی هر شکل دستور؛ پلن اجرا یک بار برای هر شکل گرفته و نگه داشته می‌شود
+    def __init__(self, slow_ms=SQL_SLOW_MS):
+        self.slow = slow_ms / 1000
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.plans = {}
+    
+    def record(self, conn, sql, params, elapsed):
+        shape = statement_shape(sql)
+        with self.lock:
+            stats = self.stats.get(shape)
+            if stats is None:
+                stats = self.stats[shape] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            slow = elapsed >= self.slow
+            if slow:
+                stats[3] += 1
+            plan = self.plans.get(shape)
+        
+        if plan is None:
+            plan = self.explain(conn, sql, params)
+            with self.lock:
+                # دو نخ ممکن است همزمان پلن یک شکل را بگیرند؛ فقط اولی ثبت و گزارش می‌شود
+                first = shape not in self.plans
+                plan = self.plans.setdefault(shape, plan)
+            if first and "full scan" in plan:
+                logger.warning(f"SQL full table scan: {shape}\n{plan}")
+        if slow:
+            metrics.inc("bot_sql_slow_total")
+            logger.warning(f"Slow SQL ({elapsed * 1000:.1f} ms): {shape}" + (f"\n{plan}" if plan else ""))
+    
+    @staticmethod
+    def explain(conn, sql, params):
+        if not sql.lstrip().upper().startswith(EXPLAINABLE):
+            return ""
+        try:
+            # کرسر ساده تا خود EXPLAIN دوباره ردیابی نشود
+            rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except sqlite3.Error as e:
+            return f"  (no plan: {e})"
+        depth = {0: 0}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, 0) + 1
+            marker = "  <- full scan" if detail.startswith("SCAN ") and "INDEX" not in detail else ""
+            lines.append("  " * depth[node_id] + detail + marker)
+        return "\n".join(lines)
+    
+    def dump(self, limit=20):
+        # (شکل دستور، تعداد، زمان کل، بیشترین، تعداد کند) به ترتیب زمان کل
+        with self.lock:
+            rows = [(shape, *stats) for shape, stats in self.stats.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:limit]
+
+sql_tracer = SqlTracer()
+
+class TracingCursor(sqlite3.Cursor):
+    # زمان SELECT تا پایان fetch حساب می‌شود، چون SQLite ردیف‌ها را تنبل تولید می‌کند
+    pending = None
+    
+    def _finish(self, extra=0.0):
+        if self.pending:
+            sql, params, elapsed = self.pending
+            self.pending = None
+            sql_tracer.record(self.connection, sql, params, elapsed + extra)
+    
+    def execute(self, sql, params=()):
+        self._finish()
+        started = time.perf_counter()
+        result = super().execute(sql, params)
+        self.pending = (sql, params, time.perf_counter() - started)
+        if self.description is None:
+            self._finish()
+        return result
+    
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        seq_of_params = list(seq_of_params)
+        started = time.perf_counter()
+        result = super().executemany(sql, seq_of_params)
+        self.pending = (sql, seq_of_params[0] if seq_of_params else (), time.perf_counter() - started)
+        self._finish()
+        return result
+    
+    def _timed_fetch(self, fetch, *args):
+        started = time.perf_counter()
+        rows = fetch(*args)
+        self._finish(time.perf_counter() - started)
+        return rows
+    
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+    
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+    
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, size if size is not None else self.arraysize)
+    
+    def __next__(self):
+        # for row in cursor: زمان هر ردیف جمع می‌شود و در پایان ثبت می‌شود
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._finish(time.perf_counter() - started)
+            raise
+        if self.pending:
+            sql, params, elapsed = self.pending
+            self.pending = (sql, params, elapsed + time.perf_counter() - started)
+        return row
+    
+    def close(self):
+        # حلقه‌ای که زودتر قطع شده هم ثبت شود
+        self._finish()
+        super().close()
+
+class TracingConnection(sqlite3.Connection):
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+    
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+def connect(database, **kwargs):
+    # همه اتصال‌ها از اینجا ساخته می‌شوند تا با SQL_TRACE ردیابی شوند
+    if SQL_TRACE:
+        kwargs["factory"] = TracingConnection
+    return sqlite3.connect(database, check_same_thread=False, **kwargs)
+
+# ==================== اتصال‌های خواندنی ====================
+def configure_connection(conn):
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA busy_timeout = 5000')
+
+class ReaderPool:
+    # اتصال‌های فقط‌خواندنی؛ در حالت WAL همزمان با نویسنده اجرا می‌شوند
+    def __init__(self, path, size=READER_POOL_SIZE):
+        self.connections = queue.Queue()
+        self.all = []
+        for _ in range(size):
+            conn = connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+            configure_connection(conn)
+            self.connections.put(conn)
+            self.all.append(conn)
+    
+    @contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+    
+    def close(self):
+        for conn in self.all:
+            conn.close()
+
+# ==================== رابط ذخیره‌سازی ====================
+class StorageBackend(abc.ABC):
+    # رابط مشترک ذخیره‌سازی؛ BotManager و هندلرها فقط از این متدها استفاده می‌کنند
+    # متدهایی که فقط می‌خوانند و در AsyncDatabase روی استخر خواننده‌ها اجرا می‌شوند
+    READ_METHODS = frozenset({
+        "get_user",
+        "get_user_languages",
+        "get_all_users",
+        "get_top_users",
+        "get_weekly_top_users",
+        "get_responses",
+        "get_all_response_pairs",
+        "get_all_responses",
+        "get_upcoming_mutes",
+        "get_upcoming_admin_expiries",
+        "get_broadcast",
+        "get_running_broadcasts",
+        "get_pending_recipients",
+        "get_user_count",
+        "find_users_by_username",
+        "get_message_count",
+        "get_message_ids",
+        "get_retention_policies",
+        "get_cache_stats",
+    })
+    
+    change_log_enabled = False
+    
+    # کاربران
+    @abc.abstractmethod
+    def add_user(self, user_id, username, first_name, last_name=""): ...
+    
+    @abc.abstractmethod
+    def add_users(self, rows): ...
+    
+    @abc.abstractmethod
+    def update_user(self, user_id, **kwargs): ...
+    
+    @abc.abstractmethod
+    def get_user(self, user_id): ...
+    
+    @abc.abstractmethod
+    def get_all_users(self): ...
+    
+    @abc.abstractmethod
+    def get_user_languages(self, user_ids): ...
+    
+    @abc.abstractmethod
+    def set_user_languages(self, pairs): ...
+    
+    @abc.abstractmethod
+    def get_user_count(self): ...
+    
+    @abc.abstractmethod
+    def find_users_by_username(self, usernames): ...
+    
+    # پیام‌ها و آمار
+    @abc.abstractmethod
+    def add_message(self, user_id, chat_id, text, message_id=None): ...
+    
+    @abc.abstractmethod
+    def add_messages(self, rows): ...
+    
+    @abc.abstractmethod
+    def get_message_count(self): ...
+    
+    @abc.abstractmethod
+    def get_message_ids(self, chat_id, limit, user_id=None, since=None): ...
+    
+    @abc.abstractmethod
+    def get_top_users(self, chat_id=None, limit=10): ...
+    
+    @abc.abstractmethod
+    def get_weekly_top_users(self, chat_id, week=None, limit=10): ...
+    
+    @abc.abstractmethod
+    def settle_contests(self, prize_tokens): ...
+    
+    # پاسخ‌های یادگرفته
+    @abc.abstractmethod
+    def add_response(self, word, response, added_by): ...
+    
+    @abc.abstractmethod
+    def get_responses(self, word): ...
+    
+    @abc.abstractmethod
+    def get_all_response_pairs(self): ...
+    
+    @abc.abstractmethod
+    def delete_response(self, word, response): ...
+    
+    @abc.abstractmethod
+    def get_all_responses(self): ...
+    
+    # سکوت، ادمینی و توکن
+    @abc.abstractmethod
+    def mute_user(self, user_id, minutes): ...
+    
+    @abc.abstractmethod
+    def unmute_user(self, user_id): ...
+    
+    @abc.abstractmethod
+    def mute_users(self, user_ids, minutes): ...
+    
+    @abc.abstractmethod
+    def unmute_users(self, user_ids): ...
+    
+    @abc.abstractmethod
+    def warn_users(self, user_ids, max_warnings, minutes): ...
+    
+    @abc.abstractmethod
+    def get_upcoming_mutes(self, until): ...
+    
+    @abc.abstractmethod
+    def expire_mute(self, user_id): ...
+    
+    @abc.abstractmethod
+    def add_admin(self, user_id, days): ...
+    
+    @abc.abstractmethod
+    def get_upcoming_admin_expiries(self, until): ...
+    
+    @abc.abstractmethod
+    def expire_admin(self, user_id): ...
+    
+    @abc.abstractmethod
+    def add_token(self, user_id, count=1): ...
+    
+    # پیام همگانی
+    @abc.abstractmethod
+    def create_broadcast(self, created_by, text, button_text=None, button_url=None): ...
+    
+    @abc.abstractmethod
+    def set_broadcast_status_message(self, job_id, chat_id, message_id): ...
+    
+    @abc.abstractmethod
+    def get_broadcast(self, job_id): ...
+    
+    @abc.abstractmethod
+    def get_running_broadcasts(self): ...
+    
+    @abc.abstractmethod
+    def claim_broadcast(self, job_id, owner, lease_seconds): ...
+    
+    @abc.abstractmethod
+    def get_pending_recipients(self, job_id, after_user_id=None, limit=1000): ...
+    
+    @abc.abstractmethod
+    def mark_broadcast_recipients(self, job_id, results): ...
+    
+    @abc.abstractmethod
+    def finish_broadcast(self, job_id, status="done"): ...
+    
+    # نگهداری پیام‌ها
+    @abc.abstractmethod
+    def set_retention(self, chat_id, days): ...
+    
+    @abc.abstractmethod
+    def get_retention_policies(self, default_days): ...
+    
+    @abc.abstractmethod
+    def archive_messages(self, chat_id, cutoff, limit=RETENTION_BATCH_SIZE): ...
+    
+    # پیاده‌سازی پیش‌فرض برای ذخیره‌سازی‌هایی که کش یا فایل ندارند
+    def incremental_vacuum(self, pages=RETENTION_VACUUM_PAGES):
+        return False
+    
+    def get_cache_stats(self):
+        return {"size": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+    
+    def invalidate_users(self, *user_ids):
+        pass
+    
+    def enable_change_log(self):
+        pass
+    
+    def get_changes(self):
+        return []
+    
+    def prune_change_log(self, max_age=CHANGE_LOG_TTL):
+        return 0
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
 
 # ==================== دیتابیس ====================
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False)
+class Database(StorageBackend):
+    # ذخیره‌سازی پیش‌فرض: همه داده‌ها در یک فایل SQLite
+    def __init__(self, path=DATABASE_NAME):
+        self.path = path
+        self.conn = connect(path)
+        # برای دیتابیس جدید اثر دارد؛ دیتابیس قدیمی یک بار VACUUM کامل لازم دارد
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        configure_connection(self.conn)
+        self.lock = threading.RLock()
+        self.user_cache = UserRowCache()
+        # ثبت تغییرات برای پروسه‌های دیگر فقط در اجرای چندپروسه‌ای
+        self.change_log_enabled = False
+        self.change_cursor = 0
         self.create_tables()
+        self.readers = ReaderPool(path)
+        self.ingest = MessageIngestQueue(self)
+        atexit.register(self.close)
     
     def create_tables(self):
         cursor = self.conn.cursor()
@@ -165,271 +1338,2789 @@ class Database:
             )
         ''')
         
+        # جدول نسخه‌های اسکیما
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_date TEXT
+            )
+        ''')
+        
         self.conn.commit()
+        self.migrate()
     
-    def add_user(self, user_id, username, first_name, last_name=""):
+    @contextmanager
+    def reader(self):
+        with self.readers.connection() as conn:
+            yield conn.cursor()
+    
+    # جداول مخصوص هر گروه (messages و شمارنده‌ها)؛ ShardedSQLiteStorage آن‌ها را به فایل گروه می‌برد
+    @contextmanager
+    def chat_reader(self, chat_id):
+        with self.reader() as cursor:
+            yield cursor
+    
+    @contextmanager
+    def chat_writer(self, chat_id):
+        with self.lock:
+            yield self.conn
+    
+    def get_schema_version(self):
         cursor = self.conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO users 
-                (user_id, username, first_name, last_name, join_date, last_seen)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name, 
-                  datetime.now().isoformat(), datetime.now().isoformat()))
-            self.conn.commit()
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        return cursor.fetchone()[0]
+    
+    def migrate(self):
+        for version, description, steps in MIGRATIONS:
+            with self.lock:
+                cursor = self.conn.cursor()
+                # قفل نوشتن قبل از بررسی نسخه، تا دو پروسه همزمان مهاجرت نکنند
+                cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    if version <= self.get_schema_version():
+                        self.conn.rollback()
+                        continue
+                    
+                    logger.info(f"Applying migration {version}: {description}")
+                    for step in steps:
+                        if callable(step):
+                            step(cursor)
+                        else:
+                            cursor.execute(step)
+                    cursor.execute('''
+                        INSERT INTO schema_version (version, description, applied_date)
+                        VALUES (?, ?, ?)
+                    ''', (version, description, datetime.now().isoformat()))
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    logger.error(f"Migration {version} failed, rolled back")
+                    raise
+    
+    def add_user(self, user_id, username, first_name, last_name=""):
+        return self.add_users([(user_id, username, first_name, last_name)])
+    
+    def add_users(self, rows):
+        # rows: (user_id, username, first_name, last_name)؛ همه در یک تراکنش
+        if not rows:
             return True
-        except Exception as e:
-            logger.error(f"Error adding user: {e}")
-            return False
+        now = datetime.now().isoformat()
+        with self.lock:
+            try:
+                # ردیف موجود جایگزین نمی‌شود تا زبان و آمار کاربر حفظ شود
+                self.conn.executemany('''
+                    INSERT INTO users 
+                    (user_id, username, first_name, last_name, join_date, last_seen)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name,
+                        last_seen = excluded.last_seen
+                ''', [(user_id, username, first_name, last_name, now, now)
+                      for user_id, username, first_name, last_name in rows])
+                self.conn.commit()
+                self._users_changed(*[row[0] for row in rows])
+                return True
+            except Exception as e:
+                self.conn.rollback()
+                logger.error(f"Error adding user: {e}")
+                return False
     
     def update_user(self, user_id, **kwargs):
-        cursor = self.conn.cursor()
-        try:
-            for key, value in kwargs.items():
-                cursor.execute(f'UPDATE users SET {key} = ? WHERE user_id = ?', (value, user_id))
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                for key, value in kwargs.items():
+                    cursor.execute(f'UPDATE users SET {key} = ? WHERE user_id = ?', (value, user_id))
+                self.conn.commit()
+                self._users_changed(user_id)
+                return True
+            except Exception as e:
+                logger.error(f"Error updating user: {e}")
+                return False
+    
+    def _users_changed(self, *user_ids):
+        self.user_cache.invalidate(*user_ids)
+        self._log_changes("user", user_ids)
+    
+    def _log_changes(self, kind, keys):
+        if not self.change_log_enabled or not keys:
+            return
+        now = datetime.now().isoformat()
+        self.conn.executemany('''
+            INSERT INTO change_log (kind, key, origin, created_date) VALUES (?, ?, ?, ?)
+        ''', [(kind, str(key), os.getpid(), now) for key in keys])
+        self.conn.commit()
+    
+    def enable_change_log(self):
+        with self.lock:
+            self.change_log_enabled = True
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM change_log')
+            self.change_cursor = cursor.fetchone()[0]
+    
+    def get_changes(self):
+        # تغییرات پروسه‌های دیگر از آخرین بررسی؛ مکان‌نما از همین نتیجه جلو می‌رود تا ردیفی
+        # که بین دو دستور جدا commit شده جا نماند. ردیف‌های خودمان هم خوانده و بعد کنار گذاشته می‌شوند
+        with self.reader() as cursor:
+            cursor.execute('''
+                SELECT id, kind, key, origin FROM change_log
+                WHERE id > ?
+                ORDER BY id
+            ''', (self.change_cursor,))
+            rows = cursor.fetchall()
+        if rows:
+            self.change_cursor = rows[-1][0]
+        pid = os.getpid()
+        return [(kind, key) for _, kind, key, origin in rows if origin != pid]
+    
+    def prune_change_log(self, max_age=CHANGE_LOG_TTL):
+        cutoff = (datetime.now() - timedelta(seconds=max_age)).isoformat()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('DELETE FROM change_log WHERE created_date < ?', (cutoff,))
             self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error updating user: {e}")
-            return False
+            return cursor.rowcount
+    
+    def invalidate_users(self, *user_ids):
+        self.user_cache.invalidate(*user_ids)
     
     def get_user(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        return cursor.fetchone()
+        row = self.user_cache.get(user_id)
+        if row is not UserRowCache.MISSING:
+            return row
+        version = self.user_cache.version
+        with self.reader() as cursor:
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            self.user_cache.put(user_id, row, version)
+            return row
+    
+    def get_cache_stats(self):
+        return self.user_cache.stats()
     
     def get_all_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id FROM users')
-        return [row[0] for row in cursor.fetchall()]
+        with self.reader() as cursor:
+            cursor.execute('SELECT user_id FROM users')
+            return [row[0] for row in cursor.fetchall()]
     
-    def add_message(self, user_id, chat_id, text):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO messages (user_id, chat_id, text, date)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, chat_id, text, datetime.now().isoformat()))
-            
-            cursor.execute('''
-                UPDATE users SET message_count = message_count + 1, last_seen = ?
-                WHERE user_id = ?
-            ''', (datetime.now().isoformat(), user_id))
-            
-            self.conn.commit()
+    def get_user_languages(self, user_ids):
+        with self.reader() as cursor:
+            placeholders = ",".join("?" * len(user_ids))
+            cursor.execute(f'SELECT user_id, language FROM users WHERE user_id IN ({placeholders})', list(user_ids))
+            return dict(cursor.fetchall())
+    
+    def set_user_languages(self, pairs):
+        # pairs: (user_id, language)؛ کاربری که هنوز ثبت نشده با همین زبان ساخته می‌شود
+        with self.lock:
+            now = datetime.now().isoformat()
+            try:
+                self.conn.executemany('''
+                    INSERT INTO users (user_id, language, join_date, last_seen) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET language = excluded.language
+                ''', [(user_id, language, now, now) for user_id, language in pairs])
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                logger.error(f"Error saving user languages: {e}")
+                return False
+            user_ids = [user_id for user_id, _ in pairs]
+            self.user_cache.invalidate(*user_ids)
+            self._log_changes("language", user_ids)
             return True
-        except Exception as e:
-            logger.error(f"Error adding message: {e}")
-            return False
+    
+    def add_message(self, user_id, chat_id, text, message_id=None):
+        # پیام در صف قرار می‌گیرد و به صورت دسته‌ای ذخیره می‌شود
+        return self.ingest.put(user_id, chat_id, text, message_id)
+    
+    def add_messages(self, rows):
+        # rows: (user_id, chat_id, text, date, message_id)
+        counts, chat_counts, weekly_counts, last_seen = aggregate_messages(rows)
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                self._insert_chat_messages(cursor, rows, chat_counts, weekly_counts, last_seen)
+                self._add_user_counts(cursor, counts, last_seen)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        self._update_cached_counts(counts, last_seen)
+    
+    def _add_user_counts(self, cursor, counts, last_seen):
+        cursor.executemany('''
+            UPDATE users SET message_count = message_count + ?, last_seen = ?
+            WHERE user_id = ?
+        ''', [(count, last_seen[user_id], user_id) for user_id, count in counts.items()])
+    
+    def _update_cached_counts(self, counts, last_seen):
+        # ردیف‌های کش‌شده به جای حذف، به‌روز می‌شوند
+        for user_id, count in counts.items():
+            seen = last_seen[user_id]
+            self.user_cache.update(
+                user_id, lambda row, count=count, seen=seen: row[:8] + (row[8] + count,) + row[9:11] + (seen,) + row[12:])
+    
+    def _insert_chat_messages(self, cursor, rows, chat_counts, weekly_counts, last_seen):
+        cursor.executemany('''
+            INSERT INTO messages (user_id, chat_id, text, date, message_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+        
+        # شمارنده‌های هر گروه در همان تراکنش
+        cursor.executemany('''
+            INSERT INTO chat_user_stats (chat_id, user_id, message_count, last_message)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                message_count = message_count + excluded.message_count,
+                last_message = excluded.last_message
+        ''', [(chat_id, user_id, count, last_seen[user_id])
+              for (chat_id, user_id), count in chat_counts.items()])
+        
+        cursor.executemany('''
+            INSERT INTO chat_user_weekly (chat_id, week_start, user_id, message_count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (chat_id, week_start, user_id) DO UPDATE SET
+                message_count = message_count + excluded.message_count
+        ''', [(chat_id, week, user_id, count)
+              for (chat_id, week, user_id), count in weekly_counts.items()])
+    
+    def flush(self):
+        self.ingest.flush()
+    
+    def close(self):
+        self.ingest.close()
     
     def get_top_users(self, chat_id=None, limit=10):
-        cursor = self.conn.cursor()
-        if chat_id:
-            cursor.execute('''
-                SELECT u.user_id, u.first_name, u.username, COUNT(m.id) as count
-                FROM users u
-                JOIN messages m ON u.user_id = m.user_id
-                WHERE m.chat_id = ?
-                GROUP BY u.user_id
-                ORDER BY count DESC
-                LIMIT ?
-            ''', (chat_id, limit))
-        else:
+        with self.reader() as cursor:
+            if chat_id:
+                cursor.execute('''
+                    SELECT u.user_id, u.first_name, u.username, s.message_count
+                    FROM chat_user_stats s
+                    JOIN users u ON u.user_id = s.user_id
+                    WHERE s.chat_id = ?
+                    ORDER BY s.message_count DESC
+                    LIMIT ?
+                ''', (chat_id, limit))
+            else:
+                cursor.execute('''
+                    SELECT user_id, first_name, username, message_count
+                    FROM users
+                    ORDER BY message_count DESC
+                    LIMIT ?
+                ''', (limit,))
+            return cursor.fetchall()
+    
+    def get_weekly_top_users(self, chat_id, week=None, limit=10):
+        with self.reader() as cursor:
             cursor.execute('''
-                SELECT user_id, first_name, username, message_count
-                FROM users
-                ORDER BY message_count DESC
+                SELECT u.user_id, u.first_name, u.username, w.message_count
+                FROM chat_user_weekly w
+                JOIN users u ON u.user_id = w.user_id
+                WHERE w.chat_id = ? AND w.week_start = ?
+                ORDER BY w.message_count DESC
                 LIMIT ?
-            ''', (limit,))
+            ''', (chat_id, week or week_start(), limit))
+            return cursor.fetchall()
+    
+    def settle_contests(self, prize_tokens):
+        # برنده هر گروه برای هفته‌های تمام‌شده‌ای که هنوز ثبت نشده‌اند
+        settled = []
+        current = week_start()
+        with self.lock:
+            cursor = self.conn.cursor()
+            for chat_id, week in self._pending_contest_weeks(cursor, current):
+                winner = self._contest_winner(cursor, chat_id, week)
+                winner_id, message_count = winner if winner else (None, 0)
+                end_date = (datetime.strptime(week, "%Y-%m-%d") + timedelta(days=7)).strftime("%Y-%m-%d")
+                
+                try:
+                    cursor.execute('''
+                        INSERT INTO contests (chat_id, start_date, end_date, winner_id, prize, message_count)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (chat_id, week, end_date, winner_id,
+                          f"{prize_tokens} tokens" if winner_id else None, message_count))
+                    if winner_id:
+                        cursor.execute('UPDATE users SET tokens = tokens + ? WHERE user_id = ?',
+                                       (prize_tokens, winner_id))
+                    self.conn.commit()
+                    if winner_id:
+                        self._users_changed(winner_id)
+                    settled.append((chat_id, week, winner_id, message_count))
+                except Exception as e:
+                    self.conn.rollback()
+                    logger.error(f"Error settling contest for chat {chat_id} week {week}: {e}")
+        return settled
+    
+    def _pending_contest_weeks(self, cursor, current):
+        cursor.execute('''
+            SELECT DISTINCT w.chat_id, w.week_start
+            FROM chat_user_weekly w
+            WHERE w.week_start < ? AND NOT EXISTS (
+                SELECT 1 FROM contests c
+                WHERE c.chat_id = w.chat_id AND c.start_date = w.week_start
+            )
+        ''', (current,))
         return cursor.fetchall()
     
+    def _contest_winner(self, cursor, chat_id, week):
+        cursor.execute('''
+            SELECT w.user_id, w.message_count
+            FROM chat_user_weekly w
+            JOIN users u ON u.user_id = w.user_id
+            WHERE w.chat_id = ? AND w.week_start = ?
+            ORDER BY w.message_count DESC
+            LIMIT 1
+        ''', (chat_id, week))
+        return cursor.fetchone()
+    
     def add_response(self, word, response, added_by):
-        cursor = self.conn.cursor()
-        try:
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('''
+                    INSERT INTO responses (word, response, added_by, added_date)
+                    VALUES (?, ?, ?, ?)
+                ''', (word.lower(), response, added_by, datetime.now().isoformat()))
+                self.conn.commit()
+                self._log_changes("response", [word.lower()])
+                return True
+            except Exception as e:
+                logger.error(f"Error adding response: {e}")
+                return False
+    
+    def get_responses(self, word):
+        with self.reader() as cursor:
+            cursor.execute('SELECT response FROM responses WHERE word = ?', (word.lower(),))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def get_all_response_pairs(self):
+        with self.reader() as cursor:
+            cursor.execute('SELECT word, response FROM responses ORDER BY id')
+            return cursor.fetchall()
+    
+    def delete_response(self, word, response):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('DELETE FROM responses WHERE word = ? AND response = ?', 
+                          (word.lower(), response))
+            self.conn.commit()
+            self._log_changes("response", [word.lower()])
+            return cursor.rowcount > 0
+    
+    def get_all_responses(self):
+        with self.reader() as cursor:
+            cursor.execute('SELECT DISTINCT word FROM responses')
+            return [row[0] for row in cursor.fetchall()]
+    
+    def mute_user(self, user_id, minutes):
+        return self.mute_users([user_id], minutes)
+    
+    def unmute_user(self, user_id):
+        self.unmute_users([user_id])
+    
+    def mute_users(self, user_ids, minutes):
+        with self.lock:
+            mute_until = (datetime.now() + timedelta(minutes=minutes)).isoformat()
+            self.conn.executemany('''
+                UPDATE users 
+                SET is_muted = 1, mute_until = ?, warnings = warnings + 1
+                WHERE user_id = ?
+            ''', [(mute_until, user_id) for user_id in user_ids])
+            self.conn.commit()
+            self._users_changed(*user_ids)
+            return mute_until
+    
+    def unmute_users(self, user_ids):
+        with self.lock:
+            self.conn.executemany('''
+                UPDATE users 
+                SET is_muted = 0, mute_until = NULL
+                WHERE user_id = ?
+            ''', [(user_id,) for user_id in user_ids])
+            self.conn.commit()
+            self._users_changed(*user_ids)
+    
+    def warn_users(self, user_ids, max_warnings, minutes):
+        # اخطار و سکوت کسانی که به max_warnings رسیده‌اند در یک تراکنش
+        # خروجی: (user_id, warnings, mute_until یا None)
+        with self.lock:
+            mute_until = (datetime.now() + timedelta(minutes=minutes)).isoformat()
+            cursor = self.conn.cursor()
+            try:
+                cursor.executemany('UPDATE users SET warnings = warnings + 1 WHERE user_id = ?',
+                                   [(user_id,) for user_id in user_ids])
+                placeholders = ",".join("?" * len(user_ids))
+                cursor.execute(f'SELECT user_id, warnings FROM users WHERE user_id IN ({placeholders})',
+                               list(user_ids))
+                warned = [(user_id, warnings, mute_until if warnings >= max_warnings else None)
+                          for user_id, warnings in cursor.fetchall()]
+                cursor.executemany('UPDATE users SET is_muted = 1, mute_until = ? WHERE user_id = ?',
+                                   [(until, user_id) for user_id, _, until in warned if until])
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            self._users_changed(*user_ids)
+            return warned
+    
+    def get_upcoming_mutes(self, until):
+        with self.reader() as cursor:
+            cursor.execute('''
+                SELECT user_id, mute_until FROM users
+                WHERE is_muted = 1 AND mute_until <= ?
+            ''', (until,))
+            return cursor.fetchall()
+    
+    def expire_mute(self, user_id):
+        # فقط اگر مهلت واقعا گذشته باشد؛ سکوت تمدیدشده دست نمی‌خورد
+        with self.lock:
+            cursor = self.conn.cursor()
             cursor.execute('''
-                INSERT INTO responses (word, response, added_by, added_date)
-                VALUES (?, ?, ?, ?)
-            ''', (word.lower(), response, added_by, datetime.now().isoformat()))
+                UPDATE users
+                SET is_muted = 0, mute_until = NULL
+                WHERE user_id = ? AND is_muted = 1 AND mute_until <= ?
+            ''', (user_id, datetime.now().isoformat()))
             self.conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error adding response: {e}")
-            return False
+            self._users_changed(user_id)
+            return cursor.rowcount > 0
+    
+    def add_admin(self, user_id, days):
+        with self.lock:
+            cursor = self.conn.cursor()
+            admin_until = (datetime.now() + timedelta(days=days)).isoformat()
+            cursor.execute('''
+                UPDATE users 
+                SET is_admin = 1, admin_until = ?
+                WHERE user_id = ?
+            ''', (admin_until, user_id))
+            self.conn.commit()
+            self._users_changed(user_id)
+            return admin_until
+    
+    def get_upcoming_admin_expiries(self, until):
+        with self.reader() as cursor:
+            cursor.execute('''
+                SELECT user_id, admin_until FROM users
+                WHERE is_admin = 1 AND admin_until <= ?
+            ''', (until,))
+            return cursor.fetchall()
+    
+    def expire_admin(self, user_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE users
+                SET is_admin = 0, admin_until = NULL
+                WHERE user_id = ? AND is_admin = 1 AND admin_until <= ?
+            ''', (user_id, datetime.now().isoformat()))
+            self.conn.commit()
+            self._users_changed(user_id)
+            return cursor.rowcount > 0
+    
+    def add_token(self, user_id, count=1):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('UPDATE users SET tokens = tokens + ? WHERE user_id = ?', (count, user_id))
+            self.conn.commit()
+            self._users_changed(user_id)
+    
+    # وضعیت گیرنده‌ها: ۰ در انتظار، ۱ موفق، ۲ ناموفق
+    def create_broadcast(self, created_by, text, button_text=None, button_url=None):
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('''
+                    INSERT INTO broadcast_jobs (created_by, text, button_text, button_url, created_date)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (created_by, text, button_text, button_url, datetime.now().isoformat()))
+                job_id = cursor.lastrowid
+                cursor.execute('''
+                    INSERT INTO broadcast_recipients (job_id, user_id)
+                    SELECT ?, user_id FROM users
+                ''', (job_id,))
+                total = cursor.rowcount
+                cursor.execute('UPDATE broadcast_jobs SET total = ? WHERE id = ?', (total, job_id))
+                self.conn.commit()
+                return job_id, total
+            except Exception:
+                self.conn.rollback()
+                raise
+    
+    def set_broadcast_status_message(self, job_id, chat_id, message_id):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE broadcast_jobs SET status_chat_id = ?, status_message_id = ? WHERE id = ?',
+                (chat_id, message_id, job_id))
+            self.conn.commit()
+    
+    def get_broadcast(self, job_id):
+        with self.reader() as cursor:
+            cursor.execute('''
+                SELECT id, text, button_text, button_url, status, status_chat_id, status_message_id,
+                       total, success, failed
+                FROM broadcast_jobs WHERE id = ?
+            ''', (job_id,))
+            return cursor.fetchone()
+    
+    def get_running_broadcasts(self):
+        with self.reader() as cursor:
+            cursor.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+            return [row[0] for row in cursor.fetchall()]
+    
+    def claim_broadcast(self, job_id, owner, lease_seconds):
+        # گرفتن یا تمدید اجاره؛ فقط اگر کار بی‌مالک است، مال خودمان است یا اجاره‌اش تمام شده
+        now = datetime.now()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE broadcast_jobs SET owner = ?, lease_until = ?
+                WHERE id = ? AND status = 'running'
+                  AND (owner IS NULL OR owner = ? OR lease_until IS NULL OR lease_until < ?)
+            ''', (owner, (now + timedelta(seconds=lease_seconds)).isoformat(), job_id, owner, now.isoformat()))
+            self.conn.commit()
+            return cursor.rowcount == 1
+    
+    def get_pending_recipients(self, job_id, after_user_id=None, limit=1000):
+        with self.reader() as cursor:
+            cursor.execute('''
+                SELECT user_id FROM broadcast_recipients
+                WHERE job_id = ? AND user_id > ? AND status = 0
+                ORDER BY user_id
+                LIMIT ?
+            ''', (job_id, after_user_id if after_user_id is not None else -(2 ** 63), limit))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def mark_broadcast_recipients(self, job_id, results):
+        # results: (user_id, status)
+        success = sum(1 for _, status in results if status == 1)
+        failed = len(results) - success
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.executemany(
+                    'UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ? AND status = 0',
+                    [(status, job_id, user_id) for user_id, status in results])
+                cursor.execute(
+                    'UPDATE broadcast_jobs SET success = success + ?, failed = failed + ? WHERE id = ?',
+                    (success, failed, job_id))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+    
+    def finish_broadcast(self, job_id, status="done"):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE broadcast_jobs SET status = ?, finished_date = ? WHERE id = ?',
+                (status, datetime.now().isoformat(), job_id))
+            self.conn.commit()
+    
+    def get_user_count(self):
+        with self.reader() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM users')
+            return cursor.fetchone()[0]
+    
+    def find_users_by_username(self, usernames):
+        with self.reader() as cursor:
+            placeholders = ",".join("?" * len(usernames))
+            cursor.execute(f'SELECT user_id, username FROM users WHERE lower(username) IN ({placeholders})',
+                           [name.lower() for name in usernames])
+            return cursor.fetchall()
+    
+    def get_message_count(self):
+        with self.reader() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM messages')
+            count = cursor.fetchone()[0]
+            cursor.execute('SELECT COALESCE(SUM(row_count), 0) FROM archive_segments')
+            return count + cursor.fetchone()[0]
+    
+    def get_message_ids(self, chat_id, limit, user_id=None, since=None):
+        # شناسه‌های تلگرام از جدیدترین؛ با ایندکس (chat_id, [user_id,] message_id)
+        query = 'SELECT message_id FROM messages WHERE chat_id = ? AND message_id IS NOT NULL'
+        params = [chat_id]
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        if since is not None:
+            query += ' AND date >= ?'
+            params.append(since)
+        query += ' ORDER BY message_id DESC LIMIT ?'
+        params.append(limit)
+        with self.chat_reader(chat_id) as cursor:
+            cursor.execute(query, params)
+            return [row[0] for row in cursor.fetchall()]
+    
+    def set_retention(self, chat_id, days):
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO group_settings (chat_id) VALUES (?)', (chat_id,))
+            self.conn.execute('UPDATE group_settings SET retention_days = ? WHERE chat_id = ?', (days, chat_id))
+            self.conn.commit()
+    
+    def get_retention_policies(self, default_days):
+        with self.reader() as cursor:
+            cursor.execute('''
+                SELECT c.chat_id, COALESCE(g.retention_days, ?)
+                FROM (SELECT DISTINCT chat_id FROM chat_user_stats) c
+                LEFT JOIN group_settings g ON g.chat_id = c.chat_id
+            ''', (default_days,))
+            return cursor.fetchall()
+    
+    def archive_messages(self, chat_id, cutoff, limit=RETENTION_BATCH_SIZE):
+        # پیام‌های قدیمی‌تر از cutoff به فایل ماهانه منتقل و از جدول حذف می‌شوند
+        with self.chat_reader(chat_id) as cursor:
+            cursor.execute('''
+                SELECT id, user_id, chat_id, text, date, message_id FROM messages
+                WHERE chat_id = ? AND date < ?
+                ORDER BY date
+                LIMIT ?
+            ''', (chat_id, cutoff, limit))
+            rows = cursor.fetchall()
+        if not rows:
+            return 0
+        
+        months = defaultdict(list)
+        for row in rows:
+            months[row[4][:7]].append(row)
+        
+        # اول فایل نوشته می‌شود؛ اگر قبل از حذف کرش کند، فقط تکرار در بایگانی داریم نه از دست رفتن
+        for month, items in months.items():
+            append_archive_chunk(archive_path(month), [
+                {"id": r[0], "user_id": r[1], "chat_id": r[2], "text": r[3], "date": r[4], "message_id": r[5]}
+                for r in items
+            ])
+        
+        with self.chat_writer(chat_id) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany('DELETE FROM messages WHERE id = ?', [(r[0],) for r in rows])
+                cursor.executemany('''
+                    INSERT INTO archive_segments (chat_id, month, path, row_count, first_id, last_id, created_date)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(chat_id, month, archive_path(month), len(items),
+                       min(r[0] for r in items), max(r[0] for r in items), datetime.now().isoformat())
+                      for month, items in months.items()])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return len(rows)
+    
+    def incremental_vacuum(self, pages=RETENTION_VACUUM_PAGES):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                return False
+            cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+            self.conn.commit()
+        return True
+
+# ==================== ذخیره‌سازی در حافظه ====================
+USER_COLUMNS = ("user_id", "username", "first_name", "last_name", "phone", "language", "bio", "country",
+                "message_count", "total_time", "join_date", "last_seen", "tokens", "is_admin",
+                "admin_until", "is_muted", "mute_until", "warnings")
+
+class MemoryStorage(StorageBackend):
+    # همه چیز در دیکشنری‌ها؛ برای تست و بنچمارک بدون فایل روی دیسک
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        self.messages = defaultdict(list)
+        self.message_ids = itertools.count(1)
+        self.archived = 0
+        self.chat_stats = {}
+        self.weekly = defaultdict(int)
+        self.responses = []
+        self.response_ids = itertools.count(1)
+        self.contests = {}
+        self.retention = {}
+        self.broadcasts = {}
+        self.broadcast_leases = {}
+        self.recipients = {}
+        self.broadcast_ids = itertools.count(1)
+    
+    def add_user(self, user_id, username, first_name, last_name=""):
+        now = datetime.now().isoformat()
+        with self.lock:
+            row = self.users.get(user_id)
+            if row:
+                row[1:4] = [username, first_name, last_name]
+                row[USER_COLUMNS.index("last_seen")] = now
+            else:
+                self.users[user_id] = [user_id, username, first_name, last_name, None, 'fa', None, None,
+                                       0, 0, now, now, 0, 0, None, 0, None, 0]
+        return True
+    
+    def add_users(self, rows):
+        for row in rows:
+            self.add_user(*row)
+        return True
+    
+    def update_user(self, user_id, **kwargs):
+        with self.lock:
+            if any(key not in USER_COLUMNS for key in kwargs):
+                logger.error(f"Error updating user: unknown column in {list(kwargs)}")
+                return False
+            row = self.users.get(user_id)
+            if row:
+                for key, value in kwargs.items():
+                    row[USER_COLUMNS.index(key)] = value
+        return True
+    
+    def get_user(self, user_id):
+        with self.lock:
+            row = self.users.get(user_id)
+            return tuple(row) if row else None
+    
+    def get_all_users(self):
+        with self.lock:
+            return list(self.users)
+    
+    def get_user_languages(self, user_ids):
+        with self.lock:
+            return {user_id: self.users[user_id][5] for user_id in user_ids if user_id in self.users}
+    
+    def set_user_languages(self, pairs):
+        for user_id, language in pairs:
+            if user_id not in self.users:
+                self.add_user(user_id, None, None, None)
+            with self.lock:
+                self.users[user_id][5] = language
+        return True
+    
+    def get_user_count(self):
+        return len(self.users)
+    
+    def find_users_by_username(self, usernames):
+        names = {name.lower() for name in usernames}
+        with self.lock:
+            return [(row[0], row[1]) for row in self.users.values() if row[1] and row[1].lower() in names]
+    
+    def add_message(self, user_id, chat_id, text, message_id=None):
+        self.add_messages([(user_id, chat_id, text, datetime.now().isoformat(), message_id)])
+        return True
+    
+    def add_messages(self, rows):
+        counts, chat_counts, weekly_counts, last_seen = aggregate_messages(rows)
+        with self.lock:
+            for user_id, chat_id, text, date, message_id in rows:
+                self.messages[chat_id].append((next(self.message_ids), user_id, chat_id, text, date, message_id))
+            for user_id, count in counts.items():
+                row = self.users.get(user_id)
+                if row:
+                    row[8] += count
+                    row[11] = last_seen[user_id]
+            for key, count in chat_counts.items():
+                stats = self.chat_stats.setdefault(key, [0, None])
+                stats[0] += count
+                stats[1] = last_seen[key[1]]
+            for key, count in weekly_counts.items():
+                self.weekly[key] += count
+    
+    def get_message_count(self):
+        with self.lock:
+            return sum(len(rows) for rows in self.messages.values()) + self.archived
+    
+    def get_message_ids(self, chat_id, limit, user_id=None, since=None):
+        with self.lock:
+            ids = [row[5] for row in self.messages.get(chat_id, ())
+                   if row[5] is not None and (user_id is None or row[1] == user_id)
+                   and (since is None or row[4] >= since)]
+        return sorted(ids, reverse=True)[:limit]
+    
+    def _named(self, counted, limit):
+        # مثل JOIN با users: کاربران ناشناخته حذف می‌شوند
+        result = []
+        for user_id, count in sorted(counted, key=lambda item: item[1], reverse=True):
+            row = self.users.get(user_id)
+            if row:
+                result.append((user_id, row[2], row[1], count))
+                if len(result) == limit:
+                    break
+        return result
+    
+    def get_top_users(self, chat_id=None, limit=10):
+        with self.lock:
+            if chat_id:
+                return self._named([(user_id, stats[0]) for (chat, user_id), stats in self.chat_stats.items()
+                                    if chat == chat_id], limit)
+            return self._named([(user_id, row[8]) for user_id, row in self.users.items()], limit)
+    
+    def get_weekly_top_users(self, chat_id, week=None, limit=10):
+        week = week or week_start()
+        with self.lock:
+            return self._named([(user_id, count) for (chat, start, user_id), count in self.weekly.items()
+                                if chat == chat_id and start == week], limit)
+    
+    def settle_contests(self, prize_tokens):
+        settled = []
+        current = week_start()
+        with self.lock:
+            pending = sorted({(chat, start) for chat, start, _ in self.weekly
+                              if start < current and (chat, start) not in self.contests})
+            for chat_id, week in pending:
+                winner = self._named([(user_id, count) for (chat, start, user_id), count in self.weekly.items()
+                                      if chat == chat_id and start == week], 1)
+                winner_id, message_count = (winner[0][0], winner[0][3]) if winner else (None, 0)
+                self.contests[(chat_id, week)] = (winner_id, message_count)
+                if winner_id:
+                    self.users[winner_id][12] += prize_tokens
+                settled.append((chat_id, week, winner_id, message_count))
+        return settled
+    
+    def add_response(self, word, response, added_by):
+        with self.lock:
+            self.responses.append((next(self.response_ids), word.lower(), response))
+        return True
     
     def get_responses(self, word):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT response FROM responses WHERE word = ?', (word.lower(),))
-        return [row[0] for row in cursor.fetchall()]
+        word = word.lower()
+        with self.lock:
+            return [response for _, w, response in self.responses if w == word]
+    
+    def get_all_response_pairs(self):
+        with self.lock:
+            return [(word, response) for _, word, response in self.responses]
     
     def delete_response(self, word, response):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM responses WHERE word = ? AND response = ?', 
-                      (word.lower(), response))
-        self.conn.commit()
-        return cursor.rowcount > 0
+        word = word.lower()
+        with self.lock:
+            before = len(self.responses)
+            self.responses = [item for item in self.responses if (item[1], item[2]) != (word, response)]
+            return len(self.responses) < before
     
     def get_all_responses(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT DISTINCT word FROM responses')
-        return [row[0] for row in cursor.fetchall()]
+        with self.lock:
+            return list(dict.fromkeys(word for _, word, _ in self.responses))
     
     def mute_user(self, user_id, minutes):
-        cursor = self.conn.cursor()
+        return self.mute_users([user_id], minutes)
+    
+    def unmute_user(self, user_id):
+        self.unmute_users([user_id])
+    
+    def mute_users(self, user_ids, minutes):
         mute_until = (datetime.now() + timedelta(minutes=minutes)).isoformat()
-        cursor.execute('''
-            UPDATE users 
-            SET is_muted = 1, mute_until = ?, warnings = warnings + 1
-            WHERE user_id = ?
-        ''', (mute_until, user_id))
-        self.conn.commit()
+        with self.lock:
+            for user_id in user_ids:
+                row = self.users.get(user_id)
+                if row:
+                    row[15], row[16], row[17] = 1, mute_until, row[17] + 1
         return mute_until
     
-    def unmute_user(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE users 
-            SET is_muted = 0, mute_until = NULL
-            WHERE user_id = ?
-        ''', (user_id,))
-        self.conn.commit()
+    def unmute_users(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                row = self.users.get(user_id)
+                if row:
+                    row[15], row[16] = 0, None
     
-    def check_expired_mutes(self):
-        cursor = self.conn.cursor()
-        now = datetime.now().isoformat()
-        cursor.execute('SELECT user_id FROM users WHERE is_muted = 1 AND mute_until < ?', (now,))
-        users = [row[0] for row in cursor.fetchall()]
-        for user_id in users:
-            self.unmute_user(user_id)
-        return users
+    def warn_users(self, user_ids, max_warnings, minutes):
+        mute_until = (datetime.now() + timedelta(minutes=minutes)).isoformat()
+        warned = []
+        with self.lock:
+            for user_id in user_ids:
+                row = self.users.get(user_id)
+                if not row:
+                    continue
+                row[17] += 1
+                if row[17] >= max_warnings:
+                    row[15], row[16] = 1, mute_until
+                warned.append((user_id, row[17], mute_until if row[17] >= max_warnings else None))
+        return warned
+    
+    def get_upcoming_mutes(self, until):
+        with self.lock:
+            return [(row[0], row[16]) for row in self.users.values() if row[15] == 1 and row[16] <= until]
+    
+    def expire_mute(self, user_id):
+        with self.lock:
+            row = self.users.get(user_id)
+            if row and row[15] == 1 and row[16] <= datetime.now().isoformat():
+                row[15], row[16] = 0, None
+                return True
+            return False
     
     def add_admin(self, user_id, days):
-        cursor = self.conn.cursor()
         admin_until = (datetime.now() + timedelta(days=days)).isoformat()
-        cursor.execute('''
-            UPDATE users 
-            SET is_admin = 1, admin_until = ?
-            WHERE user_id = ?
-        ''', (admin_until, user_id))
-        self.conn.commit()
+        with self.lock:
+            row = self.users.get(user_id)
+            if row:
+                row[13], row[14] = 1, admin_until
         return admin_until
     
-    def check_expired_admins(self):
-        cursor = self.conn.cursor()
-        now = datetime.now().isoformat()
-        cursor.execute('SELECT user_id FROM users WHERE is_admin = 1 AND admin_until < ?', (now,))
-        users = [row[0] for row in cursor.fetchall()]
-        for user_id in users:
-            cursor.execute('UPDATE users SET is_admin = 0, admin_until = NULL WHERE user_id = ?', (user_id,))
-        self.conn.commit()
-        return users
+    def get_upcoming_admin_expiries(self, until):
+        with self.lock:
+            return [(row[0], row[14]) for row in self.users.values() if row[13] == 1 and row[14] <= until]
+    
+    def expire_admin(self, user_id):
+        with self.lock:
+            row = self.users.get(user_id)
+            if row and row[13] == 1 and row[14] <= datetime.now().isoformat():
+                row[13], row[14] = 0, None
+                return True
+            return False
     
     def add_token(self, user_id, count=1):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE users SET tokens = tokens + ? WHERE user_id = ?', (count, user_id))
-        self.conn.commit()
+        with self.lock:
+            row = self.users.get(user_id)
+            if row:
+                row[12] += count
     
-    def get_user_count(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users')
-        return cursor.fetchone()[0]
+    def create_broadcast(self, created_by, text, button_text=None, button_url=None):
+        with self.lock:
+            job_id = next(self.broadcast_ids)
+            self.recipients[job_id] = dict.fromkeys(sorted(self.users), 0)
+            total = len(self.recipients[job_id])
+            self.broadcasts[job_id] = [job_id, text, button_text, button_url, "running", None, None, total, 0, 0]
+            return job_id, total
     
-    def get_message_count(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM messages')
-        return cursor.fetchone()[0]
+    def set_broadcast_status_message(self, job_id, chat_id, message_id):
+        with self.lock:
+            self.broadcasts[job_id][5:7] = [chat_id, message_id]
+    
+    def get_broadcast(self, job_id):
+        with self.lock:
+            job = self.broadcasts.get(job_id)
+            return tuple(job) if job else None
+    
+    def get_running_broadcasts(self):
+        with self.lock:
+            return [job_id for job_id, job in self.broadcasts.items() if job[4] == "running"]
+    
+    def claim_broadcast(self, job_id, owner, lease_seconds):
+        now = time.time()
+        with self.lock:
+            job = self.broadcasts.get(job_id)
+            if not job or job[4] != "running":
+                return False
+            current, until = self.broadcast_leases.get(job_id, (None, 0))
+            if current not in (None, owner) and until >= now:
+                return False
+            self.broadcast_leases[job_id] = (owner, now + lease_seconds)
+            return True
+    
+    def get_pending_recipients(self, job_id, after_user_id=None, limit=1000):
+        with self.lock:
+            # کلیدها به ترتیب user_id درج شده‌اند
+            pending = (user_id for user_id, status in self.recipients.get(job_id, {}).items()
+                       if status == 0 and (after_user_id is None or user_id > after_user_id))
+            return list(itertools.islice(pending, limit))
+    
+    def mark_broadcast_recipients(self, job_id, results):
+        with self.lock:
+            recipients = self.recipients[job_id]
+            for user_id, status in results:
+                if recipients.get(user_id) == 0:
+                    recipients[user_id] = status
+            success = sum(1 for _, status in results if status == 1)
+            self.broadcasts[job_id][8] += success
+            self.broadcasts[job_id][9] += len(results) - success
+    
+    def finish_broadcast(self, job_id, status="done"):
+        with self.lock:
+            self.broadcasts[job_id][4] = status
+    
+    def set_retention(self, chat_id, days):
+        with self.lock:
+            self.retention[chat_id] = days
+    
+    def get_retention_policies(self, default_days):
+        with self.lock:
+            chats = {chat_id for chat_id, _ in self.chat_stats}
+            return [(chat_id, self.retention.get(chat_id, default_days)) for chat_id in chats]
+    
+    def archive_messages(self, chat_id, cutoff, limit=RETENTION_BATCH_SIZE):
+        # در حافظه فایل بایگانی نوشته نمی‌شود؛ فقط شمارش حفظ می‌شود
+        # ردیف‌ها: (id, user_id, chat_id, text, date, message_id)
+        with self.lock:
+            rows = self.messages.get(chat_id, [])
+            old = sorted((row for row in rows if row[4] < cutoff), key=lambda row: row[4])[:limit]
+            if old:
+                removed = {row[0] for row in old}
+                self.messages[chat_id] = [row for row in rows if row[0] not in removed]
+                self.archived += len(old)
+            return len(old)
 
-# ==================== مدیریت ربات ====================
-class BotManager:
-    def __init__(self):
-        self.db = Database()
-        self.config = BotConfig()
-        self.user_languages = {}
-        self.active_chats = set()
-        self.start_time = datetime.now()
-        
-        # شروع چکرهای دوره‌ای
-        self.start_checkers()
+# ==================== ذخیره‌سازی تقسیم‌شده بر اساس گروه ====================
+SHARD_SCHEMA_VERSION = 2
+SHARD_SCHEMA = [
+    '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            text TEXT,
+            date TEXT
+        )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages (chat_id, date)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_chat_user ON messages (chat_id, user_id)',
+    '''
+        CREATE TABLE IF NOT EXISTS chat_user_stats (
+            chat_id INTEGER,
+            user_id INTEGER,
+            message_count INTEGER DEFAULT 0,
+            last_message TEXT,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_chat_user_stats_top ON chat_user_stats (chat_id, message_count DESC)',
+    '''
+        CREATE TABLE IF NOT EXISTS chat_user_weekly (
+            chat_id INTEGER,
+            week_start TEXT,
+            user_id INTEGER,
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, week_start, user_id)
+        )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_chat_user_weekly_top ON chat_user_weekly (chat_id, week_start, message_count DESC)',
+    '''
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            month TEXT,
+            path TEXT,
+            row_count INTEGER,
+            first_id INTEGER,
+            last_id INTEGER,
+            created_date TEXT
+        )
+    ''',
+]
+
+# ارتقای فایل‌های موجود؛ نسخه -> دستورها (مثل MIGRATIONS فایل اصلی)
+SHARD_UPGRADES = {
+    2: [
+        'ALTER TABLE messages ADD COLUMN message_id INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_message ON messages (chat_id, message_id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_user_message ON messages (chat_id, user_id, message_id)',
+        'DROP INDEX IF EXISTS idx_messages_chat_user',
+    ],
+}
+
+class ChatShard:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.RLock()
+
+class ShardPool:
+    # یک فایل SQLite برای هر گروه؛ فقط SHARD_MAX_OPEN اتصال باز نگه داشته می‌شود
+    def __init__(self, directory=SHARD_DIR, max_open=SHARD_MAX_OPEN):
+        self.directory = directory
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.shards = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
     
-    def start_checkers(self):
-        def check_mutes():
-            while True:
+    def path(self, chat_id):
+        return os.path.join(self.directory, f"chat_{chat_id}.db")
+    
+    def chat_ids(self):
+        return sorted(int(name[5:-3]) for name in os.listdir(self.directory)
+                      if name.startswith("chat_") and name.endswith(".db"))
+    
+    def _open(self, chat_id):
+        conn = connect(self.path(chat_id))
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        configure_connection(conn)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < SHARD_SCHEMA_VERSION:
+            if version < 1:
+                for statement in SHARD_SCHEMA:
+                    conn.execute(statement)
+            for upgrade in range(max(version, 1) + 1, SHARD_SCHEMA_VERSION + 1):
+                for statement in SHARD_UPGRADES[upgrade]:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {SHARD_SCHEMA_VERSION}')
+            conn.commit()
+        return conn
+    
+    def _get(self, chat_id):
+        with self.lock:
+            shard = self.shards.get(chat_id)
+            if shard is not None:
+                self.shards.move_to_end(chat_id)
+                return shard
+            shard = self.shards[chat_id] = ChatShard(self._open(chat_id))
+            # قدیمی‌ترین اتصال‌های بیکار بسته می‌شوند
+            for old_id in list(self.shards):
+                if len(self.shards) <= self.max_open:
+                    break
+                old = self.shards[old_id]
+                if old is not shard and old.lock.acquire(blocking=False):
+                    del self.shards[old_id]
+                    old.conn.close()
+                    old.conn = None
+                    old.lock.release()
+            return shard
+    
+    @contextmanager
+    def connection(self, chat_id):
+        while True:
+            shard = self._get(chat_id)
+            with shard.lock:
+                # اگر بین گرفتن و قفل کردن بسته شده باشد، دوباره باز می‌شود
+                if shard.conn is not None:
+                    yield shard.conn
+                    return
+    
+    def close(self):
+        with self.lock:
+            for shard in self.shards.values():
+                with shard.lock:
+                    shard.conn.close()
+                    shard.conn = None
+            self.shards.clear()
+
+class ShardedSQLiteStorage(Database):
+    # پیام‌ها و شمارنده‌های هر گروه در فایل جدا تا گروه‌های بزرگ روی یک قفل نوشتن صف نکشند؛
+    # کاربران، پاسخ‌ها، مسابقات و پیام همگانی در فایل اصلی می‌مانند
+    def __init__(self, path=DATABASE_NAME, directory=SHARD_DIR):
+        self.shards = ShardPool(directory)
+        # شمارنده‌های کاربرانی که پیامشان در شارد ثبت شد ولی نوشتن در فایل اصلی شکست خورد
+        self.pending_counts = {}
+        self.pending_seen = {}
+        super().__init__(path)
+    
+    @contextmanager
+    def chat_reader(self, chat_id):
+        with self.shards.connection(chat_id) as conn:
+            yield conn.cursor()
+    
+    @contextmanager
+    def chat_writer(self, chat_id):
+        with self.shards.connection(chat_id) as conn:
+            yield conn
+    
+    def add_messages(self, rows):
+        by_chat = defaultdict(list)
+        for row in rows:
+            by_chat[row[1]].append(row)
+        
+        written, failed = [], []
+        for chat_id, chat_rows in by_chat.items():
+            _, chat_counts, weekly_counts, last_seen = aggregate_messages(chat_rows)
+            with self.chat_writer(chat_id) as conn:
+                cursor = conn.cursor()
                 try:
-                    expired = self.db.check_expired_mutes()
-                    if expired:
-                        logger.info(f"Auto-unmuted users: {expired}")
+                    self._insert_chat_messages(cursor, chat_rows, chat_counts, weekly_counts, last_seen)
+                    conn.commit()
+                    written.extend(chat_rows)
                 except Exception as e:
-                    logger.error(f"Error checking mutes: {e}")
-                time.sleep(60)
+                    conn.rollback()
+                    logger.error(f"Error writing messages to shard {chat_id}: {e}")
+                    failed.extend(chat_rows)
+        
+        if written:
+            counts, _, _, last_seen = aggregate_messages(written)
+            self._apply_user_counts(counts, last_seen)
+        if failed:
+            raise PartialWriteError(f"{len(by_chat)} shards, some failed", failed)
+    
+    def _apply_user_counts(self, counts, last_seen):
+        # ردیف‌های شاردِ commit‌شده دوباره ارسال نمی‌شوند؛ فقط شمارنده‌ها برای دفعه بعد نگه داشته می‌شوند
+        with self.lock:
+            for user_id, count in counts.items():
+                self.pending_counts[user_id] = self.pending_counts.get(user_id, 0) + count
+                self.pending_seen[user_id] = max(last_seen[user_id], self.pending_seen.get(user_id, ""))
+            if not self.pending_counts:
+                return True
+            counts, self.pending_counts = self.pending_counts, {}
+            last_seen, self.pending_seen = self.pending_seen, {}
+            cursor = self.conn.cursor()
+            try:
+                self._add_user_counts(cursor, counts, last_seen)
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                logger.error(f"Error updating message counts for {len(counts)} users, will retry: {e}")
+                self.pending_counts, self.pending_seen = counts, last_seen
+                return False
+        self._update_cached_counts(counts, last_seen)
+        return True
+    
+    def flush(self):
+        super().flush()
+        self._apply_user_counts({}, {})
+    
+    def _with_names(self, counted, limit):
+        # به جای JOIN با users در فایل اصلی
+        if not counted:
+            return []
+        ids = [user_id for user_id, _ in counted]
+        with self.reader() as cursor:
+            cursor.execute(f'''
+                SELECT user_id, first_name, username FROM users
+                WHERE user_id IN ({",".join("?" * len(ids))})
+            ''', ids)
+            names = {row[0]: row for row in cursor.fetchall()}
+        return [names[user_id] + (count,) for user_id, count in counted if user_id in names][:limit]
+    
+    def get_top_users(self, chat_id=None, limit=10):
+        if not chat_id:
+            return super().get_top_users(None, limit)
+        with self.chat_reader(chat_id) as cursor:
+            cursor.execute('''
+                SELECT user_id, message_count FROM chat_user_stats
+                WHERE chat_id = ?
+                ORDER BY message_count DESC
+                LIMIT ?
+            ''', (chat_id, limit))
+            counted = cursor.fetchall()
+        return self._with_names(counted, limit)
+    
+    def get_weekly_top_users(self, chat_id, week=None, limit=10):
+        with self.chat_reader(chat_id) as cursor:
+            cursor.execute('''
+                SELECT user_id, message_count FROM chat_user_weekly
+                WHERE chat_id = ? AND week_start = ?
+                ORDER BY message_count DESC
+                LIMIT ?
+            ''', (chat_id, week or week_start(), limit))
+            counted = cursor.fetchall()
+        return self._with_names(counted, limit)
+    
+    def _pending_contest_weeks(self, cursor, current):
+        pending = []
+        for chat_id in self.shards.chat_ids():
+            with self.chat_reader(chat_id) as shard:
+                shard.execute('SELECT DISTINCT week_start FROM chat_user_weekly WHERE week_start < ?', (current,))
+                weeks = [row[0] for row in shard.fetchall()]
+            for week in weeks:
+                cursor.execute('SELECT 1 FROM contests WHERE chat_id = ? AND start_date = ?', (chat_id, week))
+                if not cursor.fetchone():
+                    pending.append((chat_id, week))
+        return pending
+    
+    def _contest_winner(self, cursor, chat_id, week):
+        winner = self._with_names(self._weekly_counts(chat_id, week), 1)
+        return (winner[0][0], winner[0][3]) if winner else None
+    
+    def _weekly_counts(self, chat_id, week, limit=50):
+        with self.chat_reader(chat_id) as cursor:
+            cursor.execute('''
+                SELECT user_id, message_count FROM chat_user_weekly
+                WHERE chat_id = ? AND week_start = ?
+                ORDER BY message_count DESC
+                LIMIT ?
+            ''', (chat_id, week, limit))
+            return cursor.fetchall()
+    
+    def get_message_count(self):
+        # پیام‌های قدیمی فایل اصلی (قبل از تغییر ذخیره‌سازی) هم شمرده می‌شوند
+        count = super().get_message_count()
+        for chat_id in self.shards.chat_ids():
+            with self.chat_reader(chat_id) as cursor:
+                cursor.execute('SELECT COUNT(*) FROM messages')
+                count += cursor.fetchone()[0]
+                cursor.execute('SELECT COALESCE(SUM(row_count), 0) FROM archive_segments')
+                count += cursor.fetchone()[0]
+        return count
+    
+    def get_retention_policies(self, default_days):
+        with self.reader() as cursor:
+            cursor.execute('SELECT chat_id, retention_days FROM group_settings WHERE retention_days IS NOT NULL')
+            days = dict(cursor.fetchall())
+        return [(chat_id, days.get(chat_id, default_days)) for chat_id in self.shards.chat_ids()]
+    
+    def incremental_vacuum(self, pages=RETENTION_VACUUM_PAGES):
+        for chat_id in self.shards.chat_ids():
+            with self.chat_writer(chat_id) as conn:
+                conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+                conn.commit()
+        return super().incremental_vacuum(pages)
+    
+    def close(self):
+        super().close()
+        if not self._apply_user_counts({}, {}):
+            logger.error(f"Lost message counts for {len(self.pending_counts)} users at shutdown")
+        self.shards.close()
+
+STORAGE_BACKENDS = {
+    "sqlite": Database,
+    "memory": MemoryStorage,
+    "sharded": ShardedSQLiteStorage,
+}
+
+def create_storage(name):
+    if name not in STORAGE_BACKENDS:
+        logger.error(f"Unknown storage backend '{name}', using sqlite")
+        name = "sqlite"
+    logger.info(f"Using {name} storage backend")
+    return STORAGE_BACKENDS[name]()
+
+# ==================== دیتابیس غیرهمزمان ====================
+class AsyncDatabase:
+    # همان متدهای Database، ولی اجرا روی یک نخ اختصاصی تا حلقه رویداد قفل نشود
+    # خواندنی‌ها روی چند نخ جدا اجرا می‌شوند تا پشت نوشتن‌ها صف نکشند
+    def __init__(self, db):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self.read_executor = ThreadPoolExecutor(max_workers=READER_POOL_SIZE, thread_name_prefix="database-read")
+    
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+        read = name in StorageBackend.READ_METHODS
+        executor = self.read_executor if read else self.executor
+        pool = "read" if read else "write"
+        
+        def timed(queued, *args, **kwargs):
+            started = time.perf_counter()
+            metrics.observe("bot_db_queue_seconds", started - queued, pool)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                metrics.observe("bot_db_seconds", time.perf_counter() - started, name)
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(timed, time.perf_counter(), *args, **kwargs))
+        
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+    
+    def queue_depth(self, read=False):
+        executor = self.read_executor if read else self.executor
+        return executor._work_queue.qsize()
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.read_executor.shutdown(wait=True)
+
+# ==================== تطبیق کلمات یادگرفته ====================
+class ResponseMatcher:
+    # اتوماتای Aho-Corasick روی کلمات جدول responses؛ همه کلمات در یک پیمایش پیدا می‌شوند
+    def __init__(self):
+        self.responses = {}
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        self.dict_link = [0]
+        self.first_chars = set()
+        self.dirty = False
+    
+    def load(self, pairs):
+        for word, response in pairs:
+            self.add(word, response)
+    
+    def add(self, word, response):
+        word = word.lower()
+        if word not in self.responses:
+            self.responses[word] = []
+            node = 0
+            for ch in word:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.dict_link.append(0)
+                node = nxt
+            self.output[node] = word
+            self.first_chars.add(word[0])
+            self.dirty = True
+        self.responses[word].append(response)
+    
+    def set_responses(self, word, responses):
+        # جایگزینی کامل پاسخ‌های یک کلمه با نسخه دیتابیس
+        word = word.lower()
+        for response in list(self.responses.get(word, [])):
+            self.remove(word, response)
+        for response in responses:
+            self.add(word, response)
+    
+    def remove(self, word, response):
+        word = word.lower()
+        responses = self.responses.get(word)
+        if not responses or response not in responses:
+            return
+        responses.remove(response)
+        if responses:
+            return
+        
+        # گره‌های درخت باقی می‌مانند، فقط خروجی حذف می‌شود
+        del self.responses[word]
+        node = 0
+        for ch in word:
+            node = self.goto[node][ch]
+        self.output[node] = None
+        self.first_chars = {w[0] for w in self.responses}
+        self.dirty = True
+    
+    def _build(self):
+        queue = []
+        for child in self.goto[0].values():
+            self.fail[child] = 0
+            self.dict_link[child] = 0
+            queue.append(child)
+        
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                fail_node = self.fail[child]
+                self.dict_link[child] = fail_node if self.output[fail_node] else self.dict_link[fail_node]
+                queue.append(child)
+        self.dirty = False
+    
+    def find(self, text):
+        # اکثر پیام‌ها با هیچ کلمه‌ای مطابقت ندارند و همین‌جا رد می‌شوند
+        if not self.responses or self.first_chars.isdisjoint(text):
+            return []
+        if self.dirty:
+            self._build()
+        
+        found = []
+        goto, fail, output, dict_link = self.goto, self.fail, self.output, self.dict_link
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            
+            match = node if output[node] else dict_link[node]
+            while match:
+                word = output[match]
+                if self._on_boundary(text, i - len(word) + 1, i, word) and word not in found:
+                    found.append(word)
+                match = dict_link[match]
+        return found
+    
+    @staticmethod
+    def _on_boundary(text, start, end, word):
+        # کلمه باید کامل باشد، نه بخشی از یک کلمه بزرگتر
+        if word[0].isalnum() and start > 0 and text[start - 1].isalnum():
+            return False
+        if word[-1].isalnum() and end + 1 < len(text) and text[end + 1].isalnum():
+            return False
+        return True
+    
+    def get_response(self, text):
+        words = self.find(text.lower())
+        if not words:
+            return None
+        # طولانی‌ترین کلمه دقیق‌ترین تطبیق است
+        word = max(words, key=len)
+        return random.choice(self.responses[word])
+
+# ==================== تشخیص فلود ====================
+class FloodState:
+    __slots__ = ("times", "strikes", "quiet_until", "last_strike")
+    
+    def __init__(self, size):
+        self.times = deque(maxlen=size)
+        self.strikes = 0
+        self.quiet_until = 0.0
+        self.last_strike = 0.0
+
+class FloodDetector:
+    # زمان آخرین N پیام هر (گروه، کاربر) در یک بافر حلقوی؛
+    # اگر N-امین پیام قبلی داخل پنجره باشد فلود است. کلیدهای کم‌استفاده با LRU حذف می‌شوند
+    def __init__(self, max_tracked=FLOOD_MAX_TRACKED):
+        self.max_tracked = max_tracked
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def check(self, chat_id, user_id, max_messages, window, max_warnings, now=None):
+        # None: عادی، "drop": بقیه همان فلود، "warn": اخطار، "mute": سکوت
+        now = now or time.monotonic()
+        key = (chat_id, user_id)
+        with self.lock:
+            state = self.states.get(key)
+            if state is None or state.times.maxlen != max_messages:
+                state = self.states[key] = FloodState(max_messages)
+                if len(self.states) > self.max_tracked:
+                    self.states.popitem(last=False)
+            else:
+                self.states.move_to_end(key)
+            
+            state.times.append(now)
+            # تا پایان همین پنجره فقط یک بار واکنش نشان داده می‌شود؛ ادامه فلود بعد از آن اخطار بعدی است
+            if now < state.quiet_until:
+                return "drop"
+            
+            if len(state.times) < max_messages or now - state.times[0] > window:
+                return None
+            
+            if now - state.last_strike > FLOOD_STRIKE_TTL:
+                state.strikes = 0
+            state.strikes += 1
+            state.last_strike = now
+            state.quiet_until = now + window
+            state.times.clear()
+            if state.strikes >= max_warnings:
+                state.strikes = 0
+                return "mute"
+            return "warn"
+    
+    def size(self):
+        return len(self.states)
+
+# ==================== تشخیص پیام‌های تکراری ====================
+class DuplicateEntry:
+    __slots__ = ("fingerprint", "cluster", "chat_id", "user_id", "message_id", "time")
+    
+    def __init__(self, fingerprint, cluster, chat_id, user_id, message_id, now):
+        self.fingerprint = fingerprint
+        self.cluster = cluster
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.time = now
+
+class DuplicateCluster:
+    __slots__ = ("id", "members", "chats", "users", "flagged")
+    
+    def __init__(self, cluster_id):
+        self.id = cluster_id
+        self.members = deque()
+        self.chats = {}
+        self.users = {}
+        self.flagged = False
+    
+    def add(self, entry):
+        self.members.append(entry)
+        self.chats[entry.chat_id] = self.chats.get(entry.chat_id, 0) + 1
+        self.users[entry.user_id] = self.users.get(entry.user_id, 0) + 1
+    
+    def expire(self, entry):
+        # اعضا به ترتیب زمان اضافه و حذف می‌شوند
+        self.members.popleft()
+        for counts, key in ((self.chats, entry.chat_id), (self.users, entry.user_id)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+
+class DuplicateIndex:
+    # ایندکس LSH روی اثر انگشت‌ها: ۶۴ بیت در ۴ باند ۱۶ بیتی. دو پیام با فاصله همینگ
+    # حداکثر ۳ حتما در یک باند یکسان‌اند. همه چیز فقط در پنجره زمانی نگه داشته می‌شود
+    BANDS = 4
+    BAND_BITS = 16
+    
+    def __init__(self, max_distance=SPAM_MAX_DISTANCE, max_entries=SPAM_MAX_ENTRIES,
+                 bucket_scan=SPAM_BUCKET_SCAN):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.bucket_scan = bucket_scan
+        self.entries = deque()
+        self.buckets = {}
+        self.clusters = {}
+        self.ids = itertools.count(1)
+    
+    def _bands(self, fingerprint):
+        mask = (1 << self.BAND_BITS) - 1
+        return [(band, fingerprint >> (band * self.BAND_BITS) & mask) for band in range(self.BANDS)]
+    
+    def _expire(self, now, window):
+        entries = self.entries
+        while entries and (now - entries[0].time > window or len(entries) > self.max_entries):
+            entry = entries.popleft()
+            # سطل‌ها هم به ترتیب زمان پر می‌شوند پس قدیمی‌ترین عضو اول است
+            for key in self._bands(entry.fingerprint):
+                bucket = self.buckets[key]
+                bucket.popleft()
+                if not bucket:
+                    del self.buckets[key]
+            cluster = self.clusters[entry.cluster]
+            cluster.expire(entry)
+            if not cluster.members:
+                del self.clusters[cluster.id]
+    
+    def _nearest(self, fingerprint):
+        best, cluster_id = self.max_distance + 1, None
+        for key in self._bands(fingerprint):
+            bucket = self.buckets.get(key)
+            if not bucket:
+                continue
+            # فقط تازه‌ترین اعضای هر سطل بررسی می‌شوند
+            for entry in itertools.islice(reversed(bucket), self.bucket_scan):
+                distance = bin(fingerprint ^ entry.fingerprint).count("1")
+                if distance < best:
+                    best, cluster_id = distance, entry.cluster
+                    if not distance:
+                        return cluster_id
+        return cluster_id
+    
+    def add(self, fingerprint, chat_id, user_id, message_id, window, chat_threshold, user_threshold, now=None):
+        # None: عادی؛ در غیر این صورت پیام‌هایی از خوشه که باید حذف شوند
+        now = now or time.monotonic()
+        self._expire(now, window)
+        cluster_id = self._nearest(fingerprint)
+        if cluster_id is None:
+            cluster_id = next(self.ids)
+            self.clusters[cluster_id] = DuplicateCluster(cluster_id)
+        cluster = self.clusters[cluster_id]
+        
+        entry = DuplicateEntry(fingerprint, cluster_id, chat_id, user_id, message_id, now)
+        self.entries.append(entry)
+        for key in self._bands(fingerprint):
+            self.buckets.setdefault(key, deque()).append(entry)
+        cluster.add(entry)
+        
+        if cluster.flagged:
+            return {"cluster": cluster_id, "new": False, "chats": len(cluster.chats),
+                    "users": len(cluster.users), "messages": [(chat_id, message_id)]}
+        if len(cluster.chats) >= chat_threshold or len(cluster.users) >= user_threshold:
+            # اولین بار: نسخه‌های قبلی همین خوشه در همه گروه‌ها هم حذف می‌شوند
+            cluster.flagged = True
+            return {"cluster": cluster_id, "new": True, "chats": len(cluster.chats),
+                    "users": len(cluster.users),
+                    "messages": [(member.chat_id, member.message_id) for member in cluster.members]}
+        return None
+    
+    def size(self):
+        return len(self.entries)
+
+# ==================== محدودیت ارسال تلگرام ====================
+class TokenBucket:
+    # سطل توکن مشترک برای همه ارسال‌ها؛ RetryAfter کل سطل را متوقف می‌کند
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+async def call_with_retry(limiter, func, *args, attempts=5, **kwargs):
+    # هر درخواست از سطل مشترک توکن می‌گیرد و در صورت RetryAfter دوباره تلاش می‌شود
+    for attempt in range(attempts):
+        await limiter.acquire()
+        try:
+            return await func(*args, **kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Flood control hit, pausing sends for {retry_after}s")
+            limiter.pause(retry_after + 0.5)
+            if attempt == attempts - 1:
+                raise
+
+# ==================== پیام همگانی ====================
+# خطاهای httpx که یعنی درخواست اصلا به تلگرام نرسیده است
+PRE_SEND_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class BroadcastEngine:
+    def __init__(self, async_db, limiter, concurrency=BROADCAST_CONCURRENCY,
+                 progress_interval=BROADCAST_PROGRESS_INTERVAL, lease=BROADCAST_LEASE):
+        self.db = async_db
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.lease = lease
+        # شناسه این پروسه به عنوان مالک کارها
+        self.owner = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self.tasks = {}
+    
+    def start(self, bot_api, job_id):
+        if job_id not in self.tasks:
+            task = asyncio.get_running_loop().create_task(self.run(bot_api, job_id))
+            self.tasks[job_id] = task
+            task.add_done_callback(functools.partial(self._done, job_id))
+        return self.tasks[job_id]
+    
+    def _done(self, job_id, task):
+        self.tasks.pop(job_id, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Broadcast job {job_id} failed: {task.exception()!r}")
+    
+    async def resume(self, bot_api):
+        # کارهایی که مالک زنده دارند در run با claim_broadcast رد می‌شوند
+        for job_id in await self.db.get_running_broadcasts():
+            if job_id not in self.tasks:
+                self.start(bot_api, job_id)
+    
+    async def _send_one(self, bot_api, user_id, text, reply_markup):
+        # RetryAfter در call_with_retry تکرار می‌شود؛ اینجا فقط خطای اتصال قبل از ارسال درخواست
+        # تکرار می‌شود، چون بعد از TimedOut ممکن است پیام رسیده باشد و ارسال دوباره تکراری شود
+        for attempt in range(3):
+            try:
+                await call_with_retry(self.limiter, bot_api.send_message,
+                                      chat_id=user_id, text=text,
+                                      reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+                return 1
+            except (Forbidden, BadRequest) as e:
+                logger.info(f"Broadcast skipped {user_id}: {e}")
+                return 2
+            except NetworkError as e:
+                if attempt == 2 or not isinstance(e.__cause__, PRE_SEND_ERRORS):
+                    logger.error(f"Failed to send to {user_id}: {e}")
+                    return 2
+                logger.warning(f"Connection error sending to {user_id}, retrying: {e}")
+                await asyncio.sleep(1 + attempt)
+            except Exception as e:
+                logger.error(f"Failed to send to {user_id}: {e}")
+                return 2
+        return 2
+    
+    async def _report(self, bot_api, job, final=False):
+        job_id, _, _, _, _, chat_id, message_id, total, success, failed = job
+        if not chat_id or not message_id:
+            return
+        if final:
+            text = (f"✅ ارسال پیام همگانی تکمیل شد!\n"
+                    f"✅ موفق: {success}\n"
+                    f"❌ ناموفق: {failed}")
+        else:
+            text = (f"⏳ ارسال پیام به {total} کاربر...\n"
+                    f"✅ موفق: {success}\n"
+                    f"❌ ناموفق: {failed}\n"
+                    f"📊 پیشرفت: {success + failed}/{total}")
+        try:
+            await bot_api.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logger.error(f"Error updating broadcast {job_id} progress: {e}")
+    
+    async def run(self, bot_api, job_id):
+        job = await self.db.get_broadcast(job_id)
+        if not job or job[4] != "running":
+            return
+        if not await self.db.claim_broadcast(job_id, self.owner, self.lease):
+            logger.info(f"Broadcast job {job_id} is owned by another worker")
+            return
+        logger.info(f"Running broadcast job {job_id}")
+        runner = asyncio.current_task()
+        _, text, button_text, button_url = job[:4]
+        reply_markup = None
+        if button_text and button_url:
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(button_text, url=button_url)]])
+        
+        queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        results = []
+        
+        async def flush_results():
+            # نتایج دسته‌ای ذخیره می‌شوند؛ پس از کرش فقط همین دسته دوباره ارسال می‌شود
+            if results:
+                batch = results[:]
+                del results[:]
+                await self.db.mark_broadcast_recipients(job_id, batch)
+        
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    if user_id is None:
+                        return
+                    results.append((user_id, await self._send_one(bot_api, user_id, text, reply_markup)))
+                    if len(results) >= 100:
+                        await flush_results()
+                finally:
+                    queue.task_done()
+        
+        async def progress():
+            last = None
+            renewed = time.monotonic()
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                await flush_results()
+                if time.monotonic() - renewed >= self.lease / 3:
+                    if not await self.db.claim_broadcast(job_id, self.owner, self.lease):
+                        # اجاره منقضی شده و کار دیگری آن را برداشته؛ ادامه یعنی ارسال تکراری
+                        logger.warning(f"Lost lease on broadcast job {job_id}, stopping")
+                        runner.cancel()
+                        return
+                    renewed = time.monotonic()
+                current = await self.db.get_broadcast(job_id)
+                if current and current[8:10] != last:
+                    last = current[8:10]
+                    await self._report(bot_api, current)
+        
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(progress())
+        try:
+            after = None
+            while True:
+                batch = await self.db.get_pending_recipients(job_id, after)
+                if not batch:
+                    break
+                for user_id in batch:
+                    await queue.put(user_id)
+                after = batch[-1]
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            await flush_results()
+            await self.db.finish_broadcast(job_id)
+        finally:
+            reporter.cancel()
+            for task in workers:
+                task.cancel()
+        
+        job = await self.db.get_broadcast(job_id)
+        logger.info(f"Broadcast {job_id} finished: {job[8]} sent, {job[9]} failed")
+        await self._report(bot_api, job, final=True)
+
+# ==================== زمان‌بند ====================
+class Scheduler:
+    # صف اولویت مهلت‌ها روی حلقه asyncio؛ هر کلید حداکثر یک کار فعال دارد
+    def __init__(self):
+        self.heap = []
+        self.jobs = {}
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+        self.running = set()
+    
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self):
+        tasks = list(self.running)
+        if self.task:
+            tasks.append(self.task)
+            self.task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def schedule(self, when, key, callback):
+        timestamp = when.timestamp() if isinstance(when, datetime) else when
+        seq = next(self.counter)
+        self.jobs[key] = (timestamp, seq, callback)
+        heapq.heappush(self.heap, (timestamp, seq, key))
+        # اگر این زودترین مهلت است، حلقه را بیدار کن
+        if self.wakeup and self.heap[0][1] == seq:
+            self.wakeup.set()
+    
+    def cancel(self, key):
+        self.jobs.pop(key, None)
+    
+    def every(self, seconds, key, callback, first=None):
+        async def repeat():
+            self.schedule(time.time() + seconds, key, repeat)
+            await callback()
+        
+        self.schedule(first if first is not None else time.time() + seconds, key, repeat)
+    
+    def pending(self):
+        return len(self.jobs)
+    
+    async def _run(self):
+        while True:
+            # کارهای لغوشده یا جایگزین‌شده به صورت تنبل حذف می‌شوند
+            while self.heap:
+                timestamp, seq, key = self.heap[0]
+                job = self.jobs.get(key)
+                if job is not None and job[1] == seq:
+                    break
+                heapq.heappop(self.heap)
+            
+            delay = self.heap[0][0] - time.time() if self.heap else 60
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    # حداکثر یک دقیقه، تا تغییر ساعت سیستم اثر نگذارد
+                    await asyncio.wait_for(self.wakeup.wait(), min(delay, 60))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            timestamp, seq, key = heapq.heappop(self.heap)
+            _, _, callback = self.jobs.pop(key)
+            task = asyncio.get_running_loop().create_task(self._fire(key, callback))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+    
+    async def _fire(self, key, callback):
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Error in scheduled job {key}: {e}")
+
+# ==================== زبان کاربران ====================
+class LanguageStore:
+    # کش LRU زبان کاربران روی ستون users.language؛ تغییرات با تاخیر و دسته‌ای نوشته می‌شوند
+    def __init__(self, async_db, config, maxsize=LANGUAGE_CACHE_SIZE):
+        self.db = async_db
+        self.config = config
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.dirty = {}
+        # تغییراتی که در حال نوشتن در دیتابیس هستند؛ تا پایان نوشتن دیتابیس قدیمی است
+        self.pending = {}
+        self.version = 0
+    
+    async def get(self, user_id):
+        default = self.config.get("language", "fa")
+        language = self.dirty.get(user_id) or self.pending.get(user_id)
+        if language:
+            return language
+        if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+            return self.cache[user_id] or default
+        version = self.version
+        language = (await self.db.get_user_languages([user_id])).get(user_id)
+        # اگر در حین خواندن زبان عوض شده، مقدار خوانده‌شده قدیمی است
+        if version == self.version:
+            self._put(user_id, language)
+        return language or default
+    
+    def set(self, user_id, language):
+        self.version += 1
+        self.dirty[user_id] = language
+        self._put(user_id, language)
+    
+    def _put(self, user_id, language):
+        self.cache[user_id] = language
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.maxsize:
+            # تغییرات ذخیره‌نشده در dirty می‌مانند
+            self.cache.popitem(last=False)
+    
+    def invalidate(self, *user_ids):
+        self.version += 1
+        for user_id in user_ids:
+            if user_id not in self.dirty and user_id not in self.pending:
+                self.cache.pop(user_id, None)
+    
+    async def flush(self):
+        if not self.dirty or self.pending:
+            return
+        self.pending, self.dirty = self.dirty, {}
+        saved = False
+        try:
+            saved = await self.db.set_user_languages(list(self.pending.items()))
+        finally:
+            if not saved:
+                # در اجرای بعدی دوباره تلاش می‌شود؛ تغییرات جدیدتر اولویت دارند
+                self.pending.update(self.dirty)
+                self.dirty = self.pending
+            self.pending = {}
+    
+    def size(self):
+        return len(self.cache)
+
+# ==================== متن پیام‌ها ====================
+# متن‌ها به تفکیک زبان؛ برای زبان جدید کافی است یک کاتالوگ با همین کلیدها اضافه شود
+CATALOGS = {
+    "fa": {
+        "language_button": "🇮🇷 فارسی",
+        "language_selected": (
+            "✅ زبان فارسی انتخاب شد!\n\n"
+            "🤖 به ربات مدیریت گروه خوش آمدید!\n\n"
+            "📋 دستورات:\n"
+            "/help - راهنما\n"
+            "/info - اطلاعات کاربر\n"
+            "/learn - آموزش کلمه\n"
+            "/stats - آمار\n"
+            "/admin - پنل مدیریت (فقط ادمین)"
+        ),
+        "help": """
+🤖 **ربات مدیریت گروه - دستورات**
+
+👤 **دستورات کاربران:**
+/start - شروع ربات
+/help - راهنما
+/info - اطلاعات شما
+/stats - آمار گروه
+/mytokens - توکن‌های شما
+/learn - آموزش کلمه
+/responses - کلمات یادگرفته
+/contest - مسابقه هفتگی
+
+👑 **دستورات ادمین:**
+/admin - پنل مدیریت
+/mute - سکوت کاربر (ریپلای)
+/unmute - برداشتن سکوت (ریپلای)
+/promote - ادمین کردن (ریپلای)
+/demote - حذف ادمین (ریپلای)
+/broadcast - ارسال به همه
+/settings - تنظیمات ربات
+/clean - پاک کردن پیام‌ها
+
+⚠️ **مدیریت گروه:**
+روی پیام ریپلای کنید با:
+!mute 60m - سکوت ۶۰ دقیقه (واحدها: m دقیقه، h ساعت، d روز)
+!unmute - برداشتن سکوت
+!warn - اخطار دادن
+!kick - اخراج کاربر
+!ban - بن کردن
+
+چند کاربر با هم (بدون ریپلای هم):
+!ban @user1 @user2 123456
+!mute 30m joined:10 - ورودهای ۱۰ دقیقه اخیر
+""",
+        "learn_usage": (
+            "📚 **آموزش کلمه جدید:**\n"
+            "فرمت: /learn کلمه = پاسخ\n\n"
+            "**مثال‌ها:**\n"
+            "/learn hello = hi there!\n"
+            "/learn سلام = علیک\n"
+            "/learn چطوری = خوبم تو چطور؟\n\n"
+            "می‌توانید چند پاسخ برای یک کلمه اضافه کنید!"
+        ),
+        "learn_no_separator": "❌ از = برای جدا کردن کلمه و پاسخ استفاده کنید!",
+        "learn_empty": "❌ کلمه و پاسخ نمی‌توانند خالی باشند!",
+        "learn_saved": "✅ یادگرفتم: **{word}** → **{response}**",
+        "learn_error": "❌ خطا در ذخیره پاسخ!",
+        "stats": """
+📊 **آمار ربات:**
+👥 کاربران کل: {total_users}
+📨 پیام‌های کل: {total_messages}
+⏰ مدت فعالیت: {days} روز
+
+🏆 **کاربران برتر:**
+""",
+        "stats_row": "{index}. {name} (@{username}) - {count} پیام\n",
+        "user_info": """
+👤 کاربر: {first_name} {last_name}
+🆔 آی‌دی: {user_id}
+📝 نام کاربری: @{username}
+📊 پیام‌ها: {message_count}
+🎫 توکن: {tokens}
+👑 ادمین: {admin}
+🤫 سکوت: {muted}
+⚠️ اخطارها: {warnings}
+📅 عضویت: {joined}
+""",
+        "mytokens": (
+            "🎫 **توکن‌های شما:** {tokens}\n\n"
+            "هر توکن = ۱ روز ادمینی\n"
+            "برای کسب توکن بیشتر در /contest شرکت کنید!"
+        ),
+        "contest": "🏆 **مسابقه هفتگی**\n\n**کاربران برتر فعلی:**\n",
+        "contest_row": "{index}. {name} - {count} پیام\n",
+        "contest_prize": (
+            "\n**جایزه برنده:**\n"
+            "🎫 {prize} توکن ({prize} روز ادمینی)\n"
+            "👑 نشان ویژه\n\n"
+            "مسابقه هر یکشنبه ریست می‌شود!"
+        ),
+        "user_not_found": "کاربر یافت نشد",
+        "no_username": "ندارد",
+        "no_name": "بدون نام",
+        "yes": "✅",
+        "no": "❌",
+    },
+    "en": {
+        "language_button": "🇬🇧 English",
+        "language_selected": (
+            "✅ English language selected!\n\n"
+            "🤖 Welcome to Group Manager Bot!\n\n"
+            "📋 Commands:\n"
+            "/help - Help\n"
+            "/info - User info\n"
+            "/learn - Learn word\n"
+            "/stats - Statistics\n"
+            "/admin - Admin panel (admin only)"
+        ),
+        "help": """
+🤖 **Group Manager Bot - Commands**
+
+👤 **User Commands:**
+/start - Start bot
+/help - Show this help
+/info - Your info
+/stats - Group statistics
+/mytokens - Your tokens
+/learn - Teach me a word
+/responses - Show learned words
+/contest - Weekly contest
+
+👑 **Admin Commands:**
+/admin - Admin panel
+/mute - Mute user (reply)
+/unmute - Unmute user (reply)
+/promote - Make admin (reply)
+/demote - Remove admin (reply)
+/broadcast - Send to all
+/settings - Bot settings
+/clean - Clean messages
+
+⚠️ **Group Management:**
+Reply to message with:
+!mute 60m - Mute for 60min (units: m minutes, h hours, d days)
+!unmute - Remove mute
+!warn - Give warning
+!kick - Kick user
+!ban - Ban user
+
+Several users at once (reply optional):
+!ban @user1 @user2 123456
+!mute 30m joined:10 - everyone who joined in the last 10 min
+""",
+        "learn_usage": (
+            "📚 **Learn a new word:**\n"
+            "Format: /learn word = response\n\n"
+            "**Examples:**\n"
+            "/learn hello = hi there!\n"
+            "/learn سلام = علیک\n"
+            "/learn چطوری = خوبم تو چطور؟\n\n"
+            "You can add multiple responses to same word!"
+        ),
+        "learn_no_separator": "❌ Use = to separate word and response!",
+        "learn_empty": "❌ Word and response cannot be empty!",
+        "learn_saved": "✅ Learned: **{word}** → **{response}**",
+        "learn_error": "❌ Error saving response!",
+        "stats": """
+📊 **Bot Statistics:**
+👥 Total Users: {total_users}
+📨 Total Messages: {total_messages}
+⏰ Uptime: {days} days
+
+🏆 **Top Users:**
+""",
+        "stats_row": "{index}. {name} (@{username}) - {count} msgs\n",
+        "user_info": """
+👤 User: {first_name} {last_name}
+🆔 ID: {user_id}
+📝 Username: @{username}
+📊 Messages: {message_count}
+🎫 Tokens: {tokens}
+👑 Admin: {admin}
+🤫 Muted: {muted}
+⚠️ Warnings: {warnings}
+📅 Joined: {joined}
+""",
+        "mytokens": (
+            "🎫 **Your Tokens:** {tokens}\n\n"
+            "Each token = 1 day of admin\n"
+            "Use /contest to win more tokens!"
+        ),
+        "contest": "🏆 **Weekly Contest**\n\n**Current Top Users:**\n",
+        "contest_row": "{index}. {name} - {count} messages\n",
+        "contest_prize": (
+            "\n**Prize for winner:**\n"
+            "🎫 {prize} Token ({prize} day admin)\n"
+            "👑 Special badge\n\n"
+            "Contest resets every Sunday!"
+        ),
+        "user_not_found": "User not found",
+        "no_username": "no",
+        "no_name": "No name",
+        "yes": "Yes",
+        "no": "No",
+    },
+}
+
+# متغیرهای مجاز در پیام‌هایی که ادمین با /setmsg تنظیم می‌کند
+CONFIG_TEMPLATE_FIELDS = frozenset({"name", "time", "group"})
+
+class Template:
+    # قالب یک بار تجزیه می‌شود؛ رندر فقط قطعه‌های آماده را به هم می‌چسباند
+    __slots__ = ("source", "parts", "fields", "static")
+    
+    def __init__(self, source, allowed=None):
+        self.source = source
+        self.parts = []
+        self.fields = set()
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                self.parts.append((False, literal))
+            if field is None:
+                continue
+            # فقط {نام} ساده؛ {} خالی، {a.b}، {a[0]} و فرمت‌ها پذیرفته نمی‌شوند
+            if not field.isidentifier() or spec or conversion:
+                raise ValueError(f"invalid placeholder {{{field}}}")
+            if allowed is not None and field not in allowed:
+                raise ValueError(f"unknown placeholder {{{field}}}")
+            self.parts.append((True, field))
+            self.fields.add(field)
+        # متن بدون متغیر یک بار ساخته و همان رشته برگردانده می‌شود
+        self.static = None if self.fields else "".join(part for _, part in self.parts)
+    
+    def render(self, **values):
+        if self.static is not None:
+            return self.static
+        return "".join([str(values[part]) if is_field else part for is_field, part in self.parts])
+
+class MessageCatalog:
+    def __init__(self, config, catalogs=CATALOGS, default="fa"):
+        self.config = config
+        self.default = default
+        self.languages = list(catalogs)
+        # همه قالب‌ها هنگام بارگذاری تجزیه می‌شوند تا خطای کاتالوگ در شروع ربات دیده شود
+        self.templates = {
+            lang: {key: Template(text) for key, text in texts.items()}
+            for lang, texts in catalogs.items()
+        }
+        self.config_templates = {}
+    
+    def _template(self, lang, key):
+        texts = self.templates.get(lang) or self.templates[self.default]
+        return texts.get(key) or self.templates[self.default][key]
+    
+    def text(self, lang, key):
+        return self._template(lang, key).static
+    
+    def render(self, lang, key, **values):
+        return self._template(lang, key).render(**values)
+    
+    @staticmethod
+    def validate(text):
+        # خطا به صورت ValueError برای نمایش به ادمین
+        return Template(text, CONFIG_TEMPLATE_FIELDS)
+    
+    def format(self, key, **values):
+        # قالب‌های تنظیمات فقط وقتی متن عوض شود دوباره تجزیه می‌شوند
+        source = self.config.get(key) or ""
+        cached = self.config_templates.get(key)
+        if cached is None or cached[0] != source:
+            try:
+                template = Template(source, CONFIG_TEMPLATE_FIELDS)
+            except ValueError as e:
+                # متنی که دستی در فایل تنظیمات خراب شده بدون جایگزینی ارسال می‌شود
+                logger.warning(f"Invalid template in config {key}: {e}")
+                template = Template(source.replace("{", "{{").replace("}", "}}"))
+            cached = self.config_templates[key] = (source, template)
+        return cached[1].render(**values)
+
+# ==================== ادغام ورود اعضا ====================
+class JoinBuffer:
+    __slots__ = ("members", "title", "task")
+    
+    def __init__(self, title):
+        self.members = {}
+        self.title = title
+        self.task = None
+
+class RaidState:
+    # هر حمله یک هشدار دارد؛ دسته‌های بعدی فقط شمارنده همان پیام را به‌روز می‌کنند
+    __slots__ = ("until", "joined", "alerted", "alert_id")
+    
+    def __init__(self, until):
+        self.until = until
+        self.joined = 0
+        self.alerted = False
+        self.alert_id = None
+
+class JoinCoalescer:
+    # ورودهای هر گروه در یک پنجره کوتاه جمع می‌شوند: یک تراکنش برای ذخیره و یک پیام خوش‌آمد
+    def __init__(self, manager, window=JOIN_WINDOW):
+        self.manager = manager
+        self.window = window
+        self.buffers = {}
+        self.history = {}
+        self.raids = {}
+        self.recent = {}
+    
+    def add(self, bot_api, chat, members):
+        buffer = self.buffers.get(chat.id)
+        if buffer is None:
+            buffer = self.buffers[chat.id] = JoinBuffer(chat.title)
+            buffer.task = asyncio.create_task(self._flush_later(bot_api, chat.id))
+        now = time.monotonic()
+        recent = self.recent.get(chat.id)
+        if recent is None:
+            recent = self.recent[chat.id] = deque(maxlen=JOIN_HISTORY_SIZE)
+        for member in members:
+            buffer.members[member.id] = member
+            recent.append((now, member.id))
+        metrics.inc("bot_joins_total", amount=len(members))
+        self._track_rate(chat.id, len(members))
+    
+    def _track_rate(self, chat_id, count):
+        # زمان آخرین N ورود؛ اگر N-امین ورود قبلی داخل پنجره باشد حمله است
+        config = self.manager.config
+        threshold = max(2, int(config.get("raid_join_threshold", 20)))
+        window = float(config.get("raid_window_seconds", 60))
+        now = time.monotonic()
+        times = self.history.get(chat_id)
+        if times is None or times.maxlen != threshold:
+            times = self.history[chat_id] = deque(maxlen=threshold)
+        times.extend([now] * count)
+        # مدت حمله از لحظه تشخیص حساب می‌شود و با ورودهای بعدی تمدید نمی‌شود
+        if len(times) == threshold and now - times[0] <= window and not self.in_raid(chat_id):
+            metrics.inc("bot_raids_total")
+            logger.warning(f"Join raid detected in chat {chat_id}")
+            self.raids[chat_id] = RaidState(now + window)
+    
+    def joined_since(self, chat_id, minutes):
+        # برای دستورهای گروهی مثل !ban joined:10
+        cutoff = time.monotonic() - minutes * 60
+        return [user_id for joined, user_id in self.recent.get(chat_id, ()) if joined >= cutoff]
+    
+    def in_raid(self, chat_id):
+        raid = self.raids.get(chat_id)
+        return raid is not None and raid.until > time.monotonic()
+    
+    async def _flush_later(self, bot_api, chat_id):
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            return
+        buffer = self.buffers.pop(chat_id, None)
+        if buffer:
+            try:
+                await self._flush(bot_api, chat_id, buffer)
+            except Exception as e:
+                logger.error(f"Error flushing joins for chat {chat_id}: {e}")
+    
+    async def _flush(self, bot_api, chat_id, buffer):
+        members = list(buffer.members.values())
+        await self.manager.async_db.add_users(
+            [(member.id, member.username, member.first_name, member.last_name) for member in members])
+        if bot_api is None:
+            return
+        
+        if self.in_raid(chat_id):
+            await self._handle_raid(bot_api, chat_id, self.raids[chat_id], members)
+            return
+        
+        names = [member.first_name for member in members[:JOIN_MAX_NAMES]]
+        if len(members) > JOIN_MAX_NAMES:
+            names.append(f"+{len(members) - JOIN_MAX_NAMES}")
+        welcome_msg = self.manager.messages.format(
+            'welcome_message',
+            name="، ".join(names),
+            time=datetime.now().strftime("%H:%M"),
+            group=buffer.title
+        )
+        await call_with_retry(self.manager.send_limiter, bot_api.send_message, chat_id, welcome_msg)
+    
+    async def _handle_raid(self, bot_api, chat_id, raid, members):
+        # در زمان حمله خوش‌آمد فرستاده نمی‌شود؛ تازه‌واردها در صورت تنظیم موقتا سکوت می‌شوند
+        minutes = int(self.manager.config.get("raid_mute_minutes", 0))
+        if minutes > 0:
+            until = datetime.now() + timedelta(minutes=minutes)
+            semaphore = asyncio.Semaphore(JOIN_RESTRICT_CONCURRENCY)
+            
+            async def restrict(member):
+                async with semaphore:
+                    try:
+                        await call_with_retry(self.manager.send_limiter, bot_api.restrict_chat_member, chat_id,
+                                              member.id, ChatPermissions(can_send_messages=False), until_date=until)
+                    except (BadRequest, Forbidden) as e:
+                        logger.warning(f"Could not restrict raider {member.id} in {chat_id}: {e}")
+            
+            await asyncio.gather(*(restrict(member) for member in members))
+        
+        raid.joined += len(members)
+        text = (f"🚨 ورود گروهی تشخیص داده شد: {raid.joined} کاربر جدید"
+                + (f" برای {minutes} دقیقه سکوت شدند." if minutes > 0 else "."))
+        if not raid.alerted:
+            # قبل از await علامت می‌خورد تا دسته همزمان هشدار دوم نفرستد
+            raid.alerted = True
+            message = await call_with_retry(self.manager.send_limiter, bot_api.send_message, chat_id, text)
+            raid.alert_id = message.message_id
+        elif raid.alert_id:
+            try:
+                await call_with_retry(self.manager.send_limiter, bot_api.edit_message_text, text,
+                                      chat_id=chat_id, message_id=raid.alert_id)
+            except BadRequest as e:
+                logger.warning(f"Could not update raid alert in {chat_id}: {e}")
+        logger.info(f"Raid in chat {chat_id}: {len(members)} joins handled ({raid.joined} total)")
+    
+    async def flush_all(self):
+        # هنگام خاموش شدن فقط کاربران ذخیره می‌شوند
+        buffers, self.buffers = self.buffers, {}
+        for chat_id, buffer in buffers.items():
+            buffer.task.cancel()
+            await self._flush(None, chat_id, buffer)
+
+# ==================== مدیریت ربات ====================
+class BotManager:
+    def __init__(self, send_rate=SEND_RATE_LIMIT):
+        self.config = BotConfig()
+        self.db = create_storage(self.config.get("storage_backend", "sqlite"))
+        self.async_db = AsyncDatabase(self.db)
+        self.matcher = ResponseMatcher()
+        self.matcher.load(self.db.get_all_response_pairs())
+        self.send_limiter = TokenBucket(send_rate)
+        self.flood = FloodDetector()
+        self.duplicates = DuplicateIndex()
+        self.spam_pool = None
+        self.spam_tasks = set()
+        self.fingerprint_second = 0.0
+        self.fingerprint_count = 0
+        self.broadcasts = BroadcastEngine(self.async_db, self.send_limiter)
+        self.languages = LanguageStore(self.async_db, self.config)
+        self.messages = MessageCatalog(self.config)
+        self.joins = JoinCoalescer(self)
+        self.active_chats = set()
+        self.start_time = datetime.now()
+        # در اجرای چندپروسه‌ای فقط پروسه اصلی کارهای سراسری را اجرا می‌کند
+        self.primary = True
+        self.worker_index = 0
+        self.metrics_server = None
+        
+        self.scheduler = Scheduler()
+        self.register_metrics()
+    
+    def register_metrics(self):
+        ingest = getattr(self.db, "ingest", None)
+        metrics.gauge("bot_ingest_queue_depth", "Messages waiting to be written",
+                      lambda: ingest.depth() if ingest else 0)
+        metrics.gauge("bot_db_write_queue_depth", "Database writes waiting for the writer thread",
+                      lambda: self.async_db.queue_depth())
+        metrics.gauge("bot_db_read_queue_depth", "Database reads waiting for a reader thread",
+                      lambda: self.async_db.queue_depth(read=True))
+        metrics.gauge("bot_scheduler_jobs", "Scheduled jobs", self.scheduler.pending)
+        metrics.gauge("bot_user_cache_size", "Cached user rows", lambda: self.db.get_cache_stats()["size"])
+        metrics.gauge("bot_active_broadcasts", "Running broadcast jobs", lambda: len(self.broadcasts.tasks))
+        metrics.gauge("bot_flood_tracked", "Chat/user pairs tracked by the flood detector", self.flood.size)
+        metrics.gauge("bot_spam_index_size", "Fingerprints in the near-duplicate index", self.duplicates.size)
+        metrics.gauge("bot_language_cache_size", "Cached user language preferences", self.languages.size)
+    
+    async def start_metrics_server(self):
+        if not metrics.port:
+            return
+        # در اجرای چندپروسه‌ای هر کارگر روی پورت جدا
+        port = metrics.port + self.worker_index
+        self.metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, port)
+        logger.info(f"Metrics available on {METRICS_LISTEN}:{port}/metrics")
+    
+    async def stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+            self.metrics_server = None
+    
+    async def start_scheduler(self):
+        self.scheduler.start()
+        self.scheduler.every(CONFIG_RELOAD_INTERVAL, "config_reload", self.reload_config)
+        self.scheduler.every(LANGUAGE_FLUSH_INTERVAL, "language_flush", self.languages.flush)
+        if self.db.change_log_enabled:
+            self.scheduler.every(CHANGE_POLL_INTERVAL, "apply_changes", self.apply_changes)
+        if not self.primary:
+            return
+        await self.load_expiries()
+        self.scheduler.every(EXPIRY_HORIZON, "expiry_refill", self.load_expiries)
+        self.scheduler.every(RETENTION_INTERVAL, "retention", self.run_retention, first=time.time() + 300)
+        self.scheduler.schedule(time.time(), "settle_contests", self.settle_contests)
+        if self.db.change_log_enabled:
+            self.scheduler.every(CHANGE_LOG_TTL, "prune_changes", self.async_db.prune_change_log)
+    
+    async def apply_changes(self):
+        # تغییرات نوشته‌شده توسط پروسه‌های دیگر روی کش و matcher اعمال می‌شوند
+        for kind, key in await self.async_db.get_changes():
+            if kind == "user":
+                self.db.invalidate_users(int(key))
+            elif kind == "language":
+                self.db.invalidate_users(int(key))
+                self.languages.invalidate(int(key))
+            elif kind == "response":
+                self.matcher.set_responses(key, await self.async_db.get_responses(key))
+    
+    async def run_retention(self):
+        default_days = self.config.get("message_retention_days", 0)
+        archived = 0
+        for chat_id, days in await self.async_db.get_retention_policies(default_days):
+            if not days:
+                continue
+            cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+            while True:
+                # دسته‌های کوچک تا نوشتن پیام‌های جدید معطل نماند
+                count = await self.async_db.archive_messages(chat_id, cutoff)
+                archived += count
+                if count < RETENTION_BATCH_SIZE:
+                    break
+                await asyncio.sleep(0.1)
+        
+        if archived:
+            logger.info(f"Archived {archived} old messages")
+        if not await self.async_db.incremental_vacuum():
+            logger.info("Incremental vacuum unavailable; run VACUUM once to enable auto_vacuum")
+    
+    async def reload_config(self):
+        self.config.reload_if_changed()
+    
+    async def load_expiries(self):
+        # فقط مهلت‌های نزدیک از ایندکس خوانده می‌شوند
+        until = (datetime.now() + timedelta(seconds=EXPIRY_HORIZON * 2)).isoformat()
+        mutes = await self.async_db.get_upcoming_mutes(until)
+        admins = await self.async_db.get_upcoming_admin_expiries(until)
+        for user_id, mute_until in mutes:
+            self.schedule_unmute(user_id, mute_until)
+        for user_id, admin_until in admins:
+            self.schedule_demote(user_id, admin_until)
+    
+    def schedule_unmute(self, user_id, mute_until):
+        async def expire():
+            if await self.async_db.expire_mute(user_id):
+                logger.info(f"Auto-unmuted user {user_id}")
+        
+        self.scheduler.schedule(datetime.fromisoformat(mute_until), ("mute", user_id), expire)
+    
+    def schedule_demote(self, user_id, admin_until):
+        async def expire():
+            if await self.async_db.expire_admin(user_id):
+                logger.info(f"Auto-demoted admin {user_id}")
+        
+        self.scheduler.schedule(datetime.fromisoformat(admin_until), ("admin", user_id), expire)
+    
+    async def settle_contests(self):
+        try:
+            if self.config.get("contest_enabled"):
+                settled = await self.async_db.settle_contests(self.config.get("contest_prize_days", 1))
+                for chat_id, week, winner_id, count in settled:
+                    logger.info(f"Contest settled: chat {chat_id}, week {week}, "
+                                f"winner {winner_id} ({count} messages)")
+        finally:
+            # دوباره در شروع هفته بعد (یکشنبه)
+            self.scheduler.schedule(next_week_start(), "settle_contests", self.settle_contests)
+    
+    async def mute_user(self, user_id, minutes):
+        mute_until = await self.async_db.mute_user(user_id, minutes)
+        self.schedule_unmute(user_id, mute_until)
+        return mute_until
+    
+    async def unmute_user(self, user_id):
+        await self.async_db.unmute_user(user_id)
+        self.scheduler.cancel(("mute", user_id))
+    
+    async def add_admin(self, user_id, days):
+        admin_until = await self.async_db.add_admin(user_id, days)
+        self.schedule_demote(user_id, admin_until)
+        return admin_until
+    
+    def format_user_info(self, user_data, lang="fa"):
+        if not user_data:
+            return self.messages.text(lang, "user_not_found")
+        
+        return self.messages.render(
+            lang, "user_info",
+            user_id=user_data[0],
+            username=user_data[1] or self.messages.text(lang, "no_username"),
+            first_name=user_data[2] or self.messages.text(lang, "no_name"),
+            last_name=user_data[3] or "",
+            message_count=user_data[8],
+            tokens=user_data[12],
+            admin=self.messages.text(lang, "yes" if user_data[13] else "no"),
+            muted=self.messages.text(lang, "yes" if user_data[15] else "no"),
+            warnings=user_data[17],
+            joined=user_data[10][:10]
+        )
+    
+    def get_response(self, text):
+        return self.matcher.get_response(text)
+    
+    async def learn_word(self, word, response, teacher_id):
+        if await self.async_db.add_response(word, response, teacher_id):
+            self.matcher.add(word, response)
+            return True
+        return False
+    
+    def start_fingerprint_pool(self):
+        # fork در پروسه چندنخی امن نیست؛ فرزندان spawn فقط spamhash را لازم دارند
+        # و چون پروسه فرزندند BotManager جدیدی نمی‌سازند
+        if self.spam_pool is None and SPAM_POOL_WORKERS > 0:
+            self.spam_pool = ProcessPoolExecutor(SPAM_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    
+    async def fingerprint(self, text):
+        # در بار کم محاسبه در همین پروسه سریع‌تر از رفت و برگشت به پروسه دیگر است
+        now = time.monotonic()
+        if now - self.fingerprint_second >= 1:
+            self.fingerprint_second, self.fingerprint_count = now, 0
+        self.fingerprint_count += 1
+        if self.fingerprint_count > SPAM_POOL_RATE:
+            if self.spam_pool:
+                metrics.inc("bot_spam_fingerprints_total", "pool")
+                return await asyncio.get_running_loop().run_in_executor(self.spam_pool, fingerprint_text, text)
+        metrics.inc("bot_spam_fingerprints_total", "inline")
+        return fingerprint_text(text)
+    
+    async def check_duplicate(self, chat_id, user_id, message_id, text):
+        if not self.config.get("antispam_enabled") or not self.config.get("duplicate_detection_enabled"):
+            return None
+        if len(text) < SPAM_MIN_LENGTH:
+            return None
+        fingerprint = await self.fingerprint(text)
+        if fingerprint is None:
+            return None
+        result = self.duplicates.add(
+            fingerprint, chat_id, user_id, message_id,
+            float(self.config.get("duplicate_window_seconds", 600)),
+            max(2, int(self.config.get("duplicate_chat_threshold", 4))),
+            max(2, int(self.config.get("duplicate_user_threshold", 6))))
+        if result and result["new"]:
+            metrics.inc("bot_spam_clusters_total")
+            logger.warning(f"Duplicate spam cluster {result['cluster']} detected: "
+                           f"{result['chats']} chats, {result['users']} users")
+        return result
+    
+    def remove_spam(self, bot_api, result):
+        # حذف در پس‌زمینه تا پردازش پیام‌های بعدی منتظر نماند
+        task = asyncio.create_task(self._delete_messages(bot_api, result))
+        self.spam_tasks.add(task)
+        task.add_done_callback(self.spam_tasks.discard)
+    
+    async def _delete_messages(self, bot_api, result):
+        semaphore = asyncio.Semaphore(SPAM_DELETE_CONCURRENCY)
+        
+        async def delete(chat_id, message_id):
+            async with semaphore:
+                try:
+                    await call_with_retry(self.send_limiter, bot_api.delete_message, chat_id, message_id)
+                    return True
+                except (BadRequest, Forbidden) as e:
+                    logger.debug(f"Could not delete spam message {message_id} in {chat_id}: {e}")
+                    return False
+        
+        deleted = await asyncio.gather(*(delete(chat_id, message_id) for chat_id, message_id in result["messages"]),
+                                       return_exceptions=True)
+        count = sum(1 for item in deleted if item is True)
+        metrics.inc("bot_spam_deleted_total", amount=count)
+        if result["new"]:
+            logger.info(f"Removed {count}/{len(deleted)} messages of spam cluster {result['cluster']}")
+    
+    async def moderate(self, bot_api, chat_id, action, user_ids, minutes=60):
+        # همه تغییرات دیتابیس در یک تراکنش، سپس فراخوانی‌های تلگرام با همزمانی محدود
+        # خروجی: (تعداد موفق، تعداد ناموفق، اطلاعات اضافه)
+        restricted = ChatPermissions(can_send_messages=False)
+        calls = []
+        extra = None
+        if action == "mute":
+            extra = await self.async_db.mute_users(user_ids, minutes)
+            until = datetime.fromisoformat(extra)
+            for user_id in user_ids:
+                self.schedule_unmute(user_id, extra)
+                calls.append((bot_api.restrict_chat_member, (chat_id, user_id, restricted), {"until_date": until}))
+        elif action == "unmute":
+            await self.async_db.unmute_users(user_ids)
+            # دسترسی‌ها به پیش‌فرض گروه برمی‌گردند
+            chat = await call_with_retry(self.send_limiter, bot_api.get_chat, chat_id)
+            permissions = chat.permissions or ChatPermissions.all_permissions()
+            for user_id in user_ids:
+                self.scheduler.cancel(("mute", user_id))
+                calls.append((bot_api.restrict_chat_member, (chat_id, user_id, permissions), {}))
+        elif action == "warn":
+            extra = await self.async_db.warn_users(
+                user_ids, max(1, int(self.config.get("max_warnings", 3))), WARN_MUTE_MINUTES)
+            for user_id, _, mute_until in extra:
+                if mute_until:
+                    self.schedule_unmute(user_id, mute_until)
+                    calls.append((bot_api.restrict_chat_member, (chat_id, user_id, restricted),
+                                  {"until_date": datetime.fromisoformat(mute_until)}))
+        elif action == "kick":
+            # بن و رفع بن فوری: کاربر بیرون می‌رود ولی می‌تواند برگردد
+            for user_id in user_ids:
+                calls.append((bot_api.ban_chat_member, (chat_id, user_id), {}))
+        elif action == "ban":
+            for user_id in user_ids:
+                calls.append((bot_api.ban_chat_member, (chat_id, user_id), {}))
+        
+        semaphore = asyncio.Semaphore(MODERATION_CONCURRENCY)
+        
+        async def run(func, args, kwargs):
+            async with semaphore:
+                try:
+                    await call_with_retry(self.send_limiter, func, *args, **kwargs)
+                    if action == "kick":
+                        await call_with_retry(self.send_limiter, bot_api.unban_chat_member, *args, only_if_banned=True)
+                    return True
+                except (BadRequest, Forbidden) as e:
+                    logger.warning(f"{action} failed for user {args[1]} in {chat_id}: {e}")
+                    return False
+        
+        results = await asyncio.gather(*(run(*call) for call in calls), return_exceptions=True)
+        done = sum(1 for item in results if item is True)
+        metrics.inc("bot_moderation_actions_total", action, "ok", amount=done)
+        metrics.inc("bot_moderation_actions_total", action, "failed", amount=len(results) - done)
+        return done, len(results) - done, extra
+    
+    async def clean_messages(self, bot_api, chat_id, message_ids, status=None):
+        # دسته‌های ۱۰۰تایی با delete_messages (PTB 20.8+)، در غیر این صورت تک‌تک؛ همه با همزمانی محدود
+        batched = hasattr(bot_api, "delete_messages")
+        size = CLEAN_BATCH_SIZE if batched else 1
+        chunks = [message_ids[i:i + size] for i in range(0, len(message_ids), size)]
+        semaphore = asyncio.Semaphore(CLEAN_CONCURRENCY)
+        # requested: دسته‌هایی که تلگرام پذیرفت ولی معلوم نیست چند پیامشان واقعا وجود داشت
+        progress = {"done": 0, "deleted": 0, "requested": 0}
+        
+        async def delete_one(message_id):
+            try:
+                await call_with_retry(self.send_limiter, bot_api.delete_message, chat_id, message_id)
+                progress["deleted"] += 1
+            except (BadRequest, Forbidden):
+                # پیام قبلا حذف شده یا قدیمی‌تر از ۴۸ ساعت است؛ بقیه ادامه می‌یابند
+                pass
+            finally:
+                progress["done"] += 1
+        
+        async def delete(chunk):
+            async with semaphore:
+                if batched:
+                    try:
+                        # شناسه‌های ناموجود را خود تلگرام نادیده می‌گیرد
+                        await call_with_retry(self.send_limiter, bot_api.delete_messages, chat_id, chunk)
+                        progress["requested"] += len(chunk)
+                        progress["done"] += len(chunk)
+                        return
+                    except (BadRequest, Forbidden) as e:
+                        logger.debug(f"Batch delete failed in {chat_id}, deleting one by one: {e}")
+                for message_id in chunk:
+                    await delete_one(message_id)
         
-        def check_admins():
+        async def report():
             while True:
+                await asyncio.sleep(CLEAN_PROGRESS_INTERVAL)
                 try:
-                    expired = self.db.check_expired_admins()
-                    if expired:
-                        logger.info(f"Auto-demoted admins: {expired}")
-                except Exception as e:
-                    logger.error(f"Error checking admins: {e}")
-                time.sleep(3600)  # هر ساعت
+                    await status.edit_text(f"🧹 پاک کردن پیام‌ها: {progress['done']}/{len(message_ids)}")
+                except BadRequest:
+                    pass
         
-        threading.Thread(target=check_mutes, daemon=True).start()
-        threading.Thread(target=check_admins, daemon=True).start()
-    
-    def format_user_info(self, user_data, lang="fa"):
-        if not user_data:
-            return "کاربر یافت نشد"
-        
-        user_id = user_data[0]
-        username = user_data[1] or "ندارد"
-        first_name = user_data[2] or "بدون نام"
-        last_name = user_data[3] or ""
-        message_count = user_data[8]
-        tokens = user_data[12]
-        is_admin = user_data[13]
-        is_muted = user_data[15]
-        warnings = user_data[17]
-        
-        if lang == "en":
-            info = f"""
-👤 User: {first_name} {last_name}
-🆔 ID: {user_id}
-📝 Username: @{username}
-📊 Messages: {message_count}
-🎫 Tokens: {tokens}
-👑 Admin: {'Yes' if is_admin else 'No'}
-🤫 Muted: {'Yes' if is_muted else 'No'}
-⚠️ Warnings: {warnings}
-📅 Joined: {user_data[10][:10]}
-            """
-        else:
-            info = f"""
-👤 کاربر: {first_name} {last_name}
-🆔 آی‌دی: {user_id}
-📝 نام کاربری: @{username}
-📊 پیام‌ها: {message_count}
-🎫 توکن: {tokens}
-👑 ادمین: {'✅' if is_admin else '❌'}
-🤫 سکوت: {'✅' if is_muted else '❌'}
-⚠️ اخطارها: {warnings}
-📅 عضویت: {user_data[10][:10]}
-            """
+        reporter = asyncio.create_task(report()) if status else None
+        try:
+            await asyncio.gather(*(delete(chunk) for chunk in chunks), return_exceptions=True)
+        finally:
+            if reporter:
+                reporter.cancel()
         
-        return info
+        deleted, requested = progress["deleted"], progress["requested"]
+        failed = len(message_ids) - deleted - requested
+        metrics.inc("bot_clean_deleted_total", "deleted", amount=deleted)
+        metrics.inc("bot_clean_deleted_total", "requested", amount=requested)
+        metrics.inc("bot_clean_deleted_total", "failed", amount=failed)
+        return deleted, requested, failed
     
-    def get_response(self, word):
-        responses = self.db.get_responses(word)
-        if responses:
-            return random.choice(responses)
-        return None
-    
-    def learn_word(self, word, response, teacher_id):
-        return self.db.add_response(word, response, teacher_id)
+    async def delete_response(self, word, response):
+        if await self.async_db.delete_response(word, response):
+            self.matcher.remove(word, response)
+            return True
+        return False
     
-    def process_message(self, user_id, chat_id, text):
+    def process_message(self, user_id, chat_id, text, message_id=None):
+        antispam = self.config.get("antispam_enabled")
+        
+        # فلود قبل از هر کار دیتابیسی بررسی می‌شود
+        if antispam:
+            action = self.flood.check(
+                chat_id, user_id,
+                max(1, int(self.config.get("flood_max_messages", 5))),
+                float(self.config.get("flood_window_seconds", 5)),
+                max(1, int(self.config.get("max_warnings", 3))))
+            if action:
+                metrics.inc("bot_flood_actions_total", action)
+                return {"action": action, "reason": "flood"}
+        
         # ذخیره پیام
-        self.db.add_message(user_id, chat_id, text)
+        self.db.add_message(user_id, chat_id, text, message_id)
         
         # چک کردن اسپم
-        if self.config.get("antispam_enabled"):
+        if antispam:
             # منطق ساده تشخیص اسپم
             if len(text) > 500:  # پیام خیلی طولانی
                 return {"action": "warn", "reason": "long_message"}
@@ -437,7 +4128,9 @@ class BotManager:
         return {"action": "ok"}
 
 # ==================== ایجاد نمونه ربات ====================
-bot = BotManager()
+# در حالت چندپروسه‌ای هر کارگر نمونه خودش را در run_worker می‌سازد و
+# پروسه توزیع‌کننده و پروسه‌های کمکی به دیتابیس و اجراکننده‌ها نیازی ندارند
+bot = BotManager() if BOT_WORKERS <= 1 and multiprocessing.current_process().name == "MainProcess" else None
 
 # ==================== Handlers ====================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -448,13 +4141,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Start from {user.id} in chat {chat.id}")
         
         # ذخیره کاربر
-        bot.db.add_user(user.id, user.username, user.first_name, user.last_name)
+        await bot.async_db.add_user(user.id, user.username, user.first_name, user.last_name)
         
         # اگر چت خصوصی
         if chat.type == "private":
             keyboard = [
-                [InlineKeyboardButton("🇮🇷 فارسی", callback_data="lang_fa")],
-                [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")]
+                [InlineKeyboardButton(bot.messages.text(code, "language_button"), callback_data=f"lang_{code}")]
+                for code in bot.messages.languages
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -464,7 +4157,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             # در گروه
-            lang = bot.user_languages.get(user.id, "fa")
+            lang = await bot.languages.get(user.id)
             if user.id == ADMIN_ID:
                 await update.message.reply_text(
                     "👑 سلام ادمین عزیز! ربات فعال است.\n"
@@ -486,107 +4179,24 @@ async def language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     data = query.data
     
-    if data == "lang_fa":
-        bot.user_languages[user_id] = "fa"
-        await query.edit_message_text(
-            "✅ زبان فارسی انتخاب شد!\n\n"
-            "🤖 به ربات مدیریت گروه خوش آمدید!\n\n"
-            "📋 دستورات:\n"
-            "/help - راهنما\n"
-            "/info - اطلاعات کاربر\n"
-            "/learn - آموزش کلمه\n"
-            "/stats - آمار\n"
-            "/admin - پنل مدیریت (فقط ادمین)"
-        )
-    elif data == "lang_en":
-        bot.user_languages[user_id] = "en"
-        await query.edit_message_text(
-            "✅ English language selected!\n\n"
-            "🤖 Welcome to Group Manager Bot!\n\n"
-            "📋 Commands:\n"
-            "/help - Help\n"
-            "/info - User info\n"
-            "/learn - Learn word\n"
-            "/stats - Statistics\n"
-            "/admin - Admin panel (admin only)"
-        )
+    lang = data[5:]
+    if lang in bot.messages.languages:
+        bot.languages.set(user_id, lang)
+        await query.edit_message_text(bot.messages.text(lang, "language_selected"))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    lang = bot.user_languages.get(user_id, "fa")
+    lang = await bot.languages.get(user_id)
     
-    if lang == "en":
-        help_text = """
-🤖 **Group Manager Bot - Commands**
-
-👤 **User Commands:**
-/start - Start bot
-/help - Show this help
-/info - Your info
-/stats - Group statistics
-/mytokens - Your tokens
-/learn - Teach me a word
-/responses - Show learned words
-/contest - Weekly contest
-
-👑 **Admin Commands:**
-/admin - Admin panel
-/mute - Mute user (reply)
-/unmute - Unmute user (reply)
-/promote - Make admin (reply)
-/demote - Remove admin (reply)
-/broadcast - Send to all
-/settings - Bot settings
-/clean - Clean messages
-
-⚠️ **Group Management:**
-Reply to message with:
-!mute 60 - Mute for 60min
-!unmute - Remove mute
-!warn - Give warning
-!kick - Kick user
-!ban - Ban user
-"""
-    else:
-        help_text = """
-🤖 **ربات مدیریت گروه - دستورات**
-
-👤 **دستورات کاربران:**
-/start - شروع ربات
-/help - راهنما
-/info - اطلاعات شما
-/stats - آمار گروه
-/mytokens - توکن‌های شما
-/learn - آموزش کلمه
-/responses - کلمات یادگرفته
-/contest - مسابقه هفتگی
-
-👑 **دستورات ادمین:**
-/admin - پنل مدیریت
-/mute - سکوت کاربر (ریپلای)
-/unmute - برداشتن سکوت (ریپلای)
-/promote - ادمین کردن (ریپلای)
-/demote - حذف ادمین (ریپلای)
-/broadcast - ارسال به همه
-/settings - تنظیمات ربات
-/clean - پاک کردن پیام‌ها
-
-⚠️ **مدیریت گروه:**
-روی پیام ریپلای کنید با:
-!mute 60 - سکوت ۶۰ دقیقه
-!unmute - برداشتن سکوت
-!warn - اخطار دادن
-!kick - اخراج کاربر
-!ban - بن کردن
-"""
+    help_text = bot.messages.text(lang, "help")
     
     await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
 
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
-        user_data = bot.db.get_user(user.id)
-        lang = bot.user_languages.get(user.id, "fa")
+        user_data = await bot.async_db.get_user(user.id)
+        lang = await bot.languages.get(user.id)
         
         info_text = bot.format_user_info(user_data, lang)
         await update.message.reply_text(info_text)
@@ -598,37 +4208,15 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def learn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
-        lang = bot.user_languages.get(user.id, "fa")
+        lang = await bot.languages.get(user.id)
         
         if not context.args:
-            if lang == "en":
-                await update.message.reply_text(
-                    "📚 **Learn a new word:**\n"
-                    "Format: /learn word = response\n\n"
-                    "**Examples:**\n"
-                    "/learn hello = hi there!\n"
-                    "/learn سلام = علیک\n"
-                    "/learn چطوری = خوبم تو چطور؟\n\n"
-                    "You can add multiple responses to same word!"
-                )
-            else:
-                await update.message.reply_text(
-                    "📚 **آموزش کلمه جدید:**\n"
-                    "فرمت: /learn کلمه = پاسخ\n\n"
-                    "**مثال‌ها:**\n"
-                    "/learn hello = hi there!\n"
-                    "/learn سلام = علیک\n"
-                    "/learn چطوری = خوبم تو چطور؟\n\n"
-                    "می‌توانید چند پاسخ برای یک کلمه اضافه کنید!"
-                )
+            await update.message.reply_text(bot.messages.text(lang, "learn_usage"))
             return
         
         text = " ".join(context.args)
         if "=" not in text:
-            if lang == "en":
-                await update.message.reply_text("❌ Use = to separate word and response!")
-            else:
-                await update.message.reply_text("❌ از = برای جدا کردن کلمه و پاسخ استفاده کنید!")
+            await update.message.reply_text(bot.messages.text(lang, "learn_no_separator"))
             return
         
         word, response = text.split("=", 1)
@@ -636,22 +4224,13 @@ async def learn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         response = response.strip()
         
         if not word or not response:
-            if lang == "en":
-                await update.message.reply_text("❌ Word and response cannot be empty!")
-            else:
-                await update.message.reply_text("❌ کلمه و پاسخ نمی‌توانند خالی باشند!")
+            await update.message.reply_text(bot.messages.text(lang, "learn_empty"))
             return
         
-        if bot.learn_word(word, response, user.id):
-            if lang == "en":
-                await update.message.reply_text(f"✅ Learned: **{word}** → **{response}**")
-            else:
-                await update.message.reply_text(f"✅ یادگرفتم: **{word}** → **{response}**")
+        if await bot.learn_word(word, response, user.id):
+            await update.message.reply_text(bot.messages.render(lang, "learn_saved", word=word, response=response))
         else:
-            if lang == "en":
-                await update.message.reply_text("❌ Error saving response!")
-            else:
-                await update.message.reply_text("❌ خطا در ذخیره پاسخ!")
+            await update.message.reply_text(bot.messages.text(lang, "learn_error"))
     
     except Exception as e:
         logger.error(f"Error in learn: {e}")
@@ -661,35 +4240,19 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         chat = update.effective_chat
         user = update.effective_user
-        lang = bot.user_languages.get(user.id, "fa")
-        
-        total_users = bot.db.get_user_count()
-        total_messages = bot.db.get_message_count()
-        top_users = bot.db.get_top_users(chat.id if chat.id < 0 else None, 5)
+        lang = await bot.languages.get(user.id)
         
-        if lang == "en":
-            stats_text = f"""
-📊 **Bot Statistics:**
-👥 Total Users: {total_users}
-📨 Total Messages: {total_messages}
-⏰ Uptime: {(datetime.now() - bot.start_time).days} days
-
-🏆 **Top Users:**
-"""
-            for i, (uid, name, username, count) in enumerate(top_users, 1):
-                stats_text += f"{i}. {name} (@{username or 'no'}) - {count} msgs\n"
+        total_users = await bot.async_db.get_user_count()
+        total_messages = await bot.async_db.get_message_count()
+        top_users = await bot.async_db.get_top_users(chat.id if chat.id < 0 else None, 5)
         
-        else:
-            stats_text = f"""
-📊 **آمار ربات:**
-👥 کاربران کل: {total_users}
-📨 پیام‌های کل: {total_messages}
-⏰ مدت فعالیت: {(datetime.now() - bot.start_time).days} روز
-
-🏆 **کاربران برتر:**
-"""
-            for i, (uid, name, username, count) in enumerate(top_users, 1):
-                stats_text += f"{i}. {name} (@{username or 'ندارد'}) - {count} پیام\n"
+        no_username = bot.messages.text(lang, "no_username")
+        parts = [bot.messages.render(lang, "stats", total_users=total_users, total_messages=total_messages,
+                                     days=(datetime.now() - bot.start_time).days)]
+        for i, (uid, name, username, count) in enumerate(top_users, 1):
+            parts.append(bot.messages.render(lang, "stats_row", index=i, name=name,
+                                             username=username or no_username, count=count))
+        stats_text = "".join(parts)
         
         await update.message.reply_text(stats_text)
     
@@ -705,7 +4268,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         keyboard = [
-            [InlineKeyboardButton("📊 آمار کلی", callback_data="admin_stats")],
+            [InlineKeyboardButton("📊 آمار کلی", callback_data="admin_stats"),
+             InlineKeyboardButton("📈 متریک‌ها", callback_data="admin_metrics")],
             [InlineKeyboardButton("👥 مدیریت کاربران", callback_data="admin_users")],
             [InlineKeyboardButton("⚙ تنظیمات ربات", callback_data="admin_settings")],
             [InlineKeyboardButton("📢 پیام همگانی", callback_data="admin_broadcast")],
@@ -736,9 +4300,10 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     
     if data == "admin_stats":
-        total_users = bot.db.get_user_count()
-        total_messages = bot.db.get_message_count()
-        learned_words = len(bot.db.get_all_responses())
+        total_users = await bot.async_db.get_user_count()
+        total_messages = await bot.async_db.get_message_count()
+        learned_words = len(await bot.async_db.get_all_responses())
+        cache = bot.db.get_cache_stats()
         
         stats_text = f"""
 📊 **آمار کامل ربات:**
@@ -746,6 +4311,7 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📨 پیام‌ها: {total_messages}
 🗣 کلمات یادگرفته: {learned_words}
 ⏰ مدت فعالیت: {(datetime.now() - bot.start_time).days} روز
+🗃 کش کاربران: {cache['hits']} موفق / {cache['misses']} ناموفق ({cache['hit_rate']:.0%})
 🎯 حالت فعلی: {bot.config.get('bot_mode')}
 🌐 زبان پیشفرض: {bot.config.get('language')}
         """
@@ -755,6 +4321,36 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await query.edit_message_text(stats_text, reply_markup=reply_markup)
     
+    elif data == "admin_metrics":
+        lag = metrics.summary("bot_update_lag_seconds")
+        updates = metrics.counter_total("bot_updates_total")
+        api_calls = metrics.counter_total("bot_telegram_requests_total")
+        api_errors = metrics.counter_total("bot_telegram_requests_total", lambda labels: labels[1] != 200)
+        
+        text = "📈 متریک‌ها:\n\n"
+        text += f"📥 آپدیت‌ها: {updates:g}\n"
+        if lag:
+            text += f"⏳ تاخیر آپدیت p50/p95: {lag[0][2]:.2f}s / {lag[0][3]:.2f}s\n"
+        text += f"📡 Bot API: {api_calls:g} درخواست، {api_errors:g} خطا\n"
+        text += f"🗃 صف ذخیره پیام: {metrics.gauges['bot_ingest_queue_depth']()}\n"
+        text += f"🗄 صف نوشتن دیتابیس: {bot.async_db.queue_depth()}\n\n"
+        
+        text += "🧩 هندلرها (تعداد | p50 | p95 میلی‌ثانیه):\n"
+        for handler, count, p50, p95, _ in metrics.summary("bot_handler_seconds", 8):
+            errors = metrics.counter_value("bot_handler_errors_total", handler)
+            text += f"• {handler}: {count} | {p50 * 1000:.1f} | {p95 * 1000:.1f}"
+            text += f" | ❌ {errors:g}\n" if errors else "\n"
+        
+        text += "\n🗄 دیتابیس (بیشترین زمان کل):\n"
+        for method, count, p50, p95, _ in metrics.summary("bot_db_seconds", 6):
+            text += f"• {method}: {count} | {p50 * 1000:.1f} | {p95 * 1000:.1f}\n"
+        
+        keyboard = [[InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="admin_metrics")],
+                    [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_back")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    
     elif data == "admin_broadcast":
         await query.edit_message_text(
             "📢 **ارسال پیام همگانی:**\n\n"
@@ -765,14 +4361,14 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data == "admin_responses":
-        responses = bot.db.get_all_responses()
+        responses = await bot.async_db.get_all_responses()
         
         if not responses:
             text = "هنوز کلمه‌ای یادگرفته نشده است."
         else:
             text = "📚 **کلمات یادگرفته شده:**\n\n"
             for i, word in enumerate(responses[:20], 1):
-                resps = bot.db.get_responses(word)
+                resps = await bot.async_db.get_responses(word)
                 text += f"{i}. **{word}** → {len(resps)} پاسخ\n"
         
         keyboard = [
@@ -815,7 +4411,8 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data == "admin_back":
         keyboard = [
-            [InlineKeyboardButton("📊 آمار کلی", callback_data="admin_stats")],
+            [InlineKeyboardButton("📊 آمار کلی", callback_data="admin_stats"),
+             InlineKeyboardButton("📈 متریک‌ها", callback_data="admin_metrics")],
             [InlineKeyboardButton("👥 مدیریت کاربران", callback_data="admin_users")],
             [InlineKeyboardButton("⚙ تنظیمات ربات", callback_data="admin_settings")],
             [InlineKeyboardButton("📢 پیام همگانی", callback_data="admin_broadcast")],
@@ -884,42 +4481,17 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_text = text
             reply_markup = None
         
-        # دریافت تمام کاربران
-        user_ids = bot.db.get_all_users()
-        
-        success = 0
-        failed = 0
-        
-        await update.message.reply_text(f"⏳ ارسال پیام به {len(user_ids)} کاربر...")
+        # ساخت کار ارسال؛ پیشرفت در دیتابیس ذخیره می‌شود و پس از ری‌استارت ادامه می‌یابد
+        job_id, total = await bot.async_db.create_broadcast(
+            user.id, message_text,
+            button_text if reply_markup else None,
+            button_url if reply_markup else None
+        )
         
-        for uid in user_ids:
-            try:
-                if reply_markup:
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text=message_text,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                success += 1
-            except Exception as e:
-                failed += 1
-                logger.error(f"Failed to send to {uid}: {e}")
-            
-            # تاخیر کوچک برای جلوگیری از محدودیت
-            await asyncio.sleep(0.1)
+        status = await update.message.reply_text(f"⏳ ارسال پیام به {total} کاربر...")
+        await bot.async_db.set_broadcast_status_message(job_id, status.chat_id, status.message_id)
         
-        await update.message.reply_text(
-            f"✅ ارسال پیام همگانی تکمیل شد!\n"
-            f"✅ موفق: {success}\n"
-            f"❌ ناموفق: {failed}"
-        )
+        bot.broadcasts.start(context.bot, job_id)
     
     except Exception as e:
         logger.error(f"Error in broadcast: {e}")
@@ -961,6 +4533,19 @@ async def set_message_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ نوع پیام نامعتبر است!")
             return
         
+        # متغیرها همین حالا بررسی می‌شوند، نه هنگام ارسال پیام
+        try:
+            bot.messages.validate(message_text)
+        except ValueError as e:
+            await update.message.reply_text(
+                f"❌ قالب نامعتبر: {e}\n\n"
+                "متغیرهای قابل استفاده:\n"
+                "{name} - نام کاربر\n"
+                "{time} - زمان\n"
+                "{group} - نام گروه"
+            )
+            return
+        
         config_key = valid_types[msg_type]
         bot.config.set(config_key, message_text)
         
@@ -972,7 +4557,7 @@ async def set_message_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def responses_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        responses = bot.db.get_all_responses()
+        responses = await bot.async_db.get_all_responses()
         
         if not responses:
             await update.message.reply_text("📭 هنوز کلمه‌ای یادگرفته نشده است!")
@@ -980,7 +4565,7 @@ async def responses_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         text = "📚 **کلمات یادگرفته شده:**\n\n"
         for i, word in enumerate(responses[:15], 1):
-            resps = bot.db.get_responses(word)
+            resps = await bot.async_db.get_responses(word)
             sample = resps[0][:30] + "..." if len(resps[0]) > 30 else resps[0]
             text += f"{i}. **{word}** → {sample} ({len(resps)} پاسخ)\n"
         
@@ -995,20 +4580,13 @@ async def responses_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def mytokens_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
-        user_data = bot.db.get_user(user.id)
+        user_data = await bot.async_db.get_user(user.id)
         
         if user_data:
             tokens = user_data[12]
-            lang = bot.user_languages.get(user.id, "fa")
+            lang = await bot.languages.get(user.id)
             
-            if lang == "en":
-                text = f"🎫 **Your Tokens:** {tokens}\n\n"
-                text += "Each token = 1 day of admin\n"
-                text += "Use /contest to win more tokens!"
-            else:
-                text = f"🎫 **توکن‌های شما:** {tokens}\n\n"
-                text += "هر توکن = ۱ روز ادمینی\n"
-                text += "برای کسب توکن بیشتر در /contest شرکت کنید!"
+            text = bot.messages.render(lang, "mytokens", tokens=tokens)
             
             await update.message.reply_text(text)
     
@@ -1019,33 +4597,19 @@ async def contest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         chat = update.effective_chat
         user = update.effective_user
-        lang = bot.user_languages.get(user.id, "fa")
-        
-        top_users = bot.db.get_top_users(chat.id if chat.id < 0 else None, 3)
-        
-        if lang == "en":
-            text = "🏆 **Weekly Contest**\n\n"
-            text += "**Current Top Users:**\n"
-            
-            for i, (uid, name, username, count) in enumerate(top_users, 1):
-                text += f"{i}. {name} - {count} messages\n"
-            
-            text += "\n**Prize for winner:**\n"
-            text += "🎫 1 Token (1 day admin)\n"
-            text += "👑 Special badge\n\n"
-            text += "Contest resets every Sunday!"
+        lang = await bot.languages.get(user.id)
         
+        if chat.id < 0:
+            top_users = await bot.async_db.get_weekly_top_users(chat.id, week_start(), 3)
         else:
-            text = "🏆 **مسابقه هفتگی**\n\n"
-            text += "**کاربران برتر فعلی:**\n"
-            
-            for i, (uid, name, username, count) in enumerate(top_users, 1):
-                text += f"{i}. {name} - {count} پیام\n"
-            
-            text += "\n**جایزه برنده:**\n"
-            text += "🎫 ۱ توکن (۱ روز ادمینی)\n"
-            text += "👑 نشان ویژه\n\n"
-            text += "مسابقه هر یکشنبه ریست می‌شود!"
+            top_users = await bot.async_db.get_top_users(None, 3)
+        prize = bot.config.get("contest_prize_days", 1)
+        
+        parts = [bot.messages.text(lang, "contest")]
+        for i, (uid, name, username, count) in enumerate(top_users, 1):
+            parts.append(bot.messages.render(lang, "contest_row", index=i, name=name, count=count))
+        parts.append(bot.messages.render(lang, "contest_prize", prize=prize))
+        text = "".join(parts)
         
         await update.message.reply_text(text)
     
@@ -1061,7 +4625,7 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # چک کردن ادمین بودن
-        user_data = bot.db.get_user(user.id)
+        user_data = await bot.async_db.get_user(user.id)
         if not user_data or not user_data[13]:
             await update.message.reply_text("❌ فقط ادمین‌ها می‌توانند سکوت کنند!")
             return
@@ -1074,10 +4638,10 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         minutes = int(context.args[0]) if context.args and context.args[0].isdigit() else 60
         
         # سکوت کاربر
-        mute_until = bot.db.mute_user(target_user.id, minutes)
+        mute_until = await bot.mute_user(target_user.id, minutes)
         
         # ارسال پیام
-        mute_msg = bot.config.get('mute_message').format(
+        mute_msg = bot.messages.format('mute_message',
             name=target_user.first_name,
             time=datetime.fromisoformat(mute_until).strftime("%H:%M"),
             group=chat.title
@@ -1115,10 +4679,10 @@ async def promote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         days = int(context.args[0]) if context.args and context.args[0].isdigit() else 3
         
         # ترفیع کاربر
-        admin_until = bot.db.add_admin(target_user.id, days)
+        admin_until = await bot.add_admin(target_user.id, days)
         
         # ارسال پیام
-        promote_msg = bot.config.get('admin_promoted').format(
+        promote_msg = bot.messages.format('admin_promoted',
             name=target_user.first_name,
             time=datetime.fromisoformat(admin_until).strftime("%Y-%m-%d"),
             group=chat.title
@@ -1151,13 +4715,42 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
             return
         
         # پردازش پیام
-        result = bot.process_message(user.id, chat.id, message.text)
+        result = bot.process_message(user.id, chat.id, message.text, message.message_id)
         
         # چک کردن اسپم
+        if result.get("action") == "drop":
+            return
+        
         if result.get("action") == "warn":
             await message.reply_text(bot.config.get("spam_warning"))
             return
         
+        if result.get("action") == "mute":
+            # اخطارها به max_warnings رسیده؛ سکوت به مدت mute_duration دقیقه
+            mute_until = await bot.mute_user(user.id, bot.config.get("mute_duration", 60))
+            if chat.type in ["group", "supergroup"]:
+                try:
+                    await context.bot.restrict_chat_member(
+                        chat.id, user.id, ChatPermissions(can_send_messages=False),
+                        until_date=datetime.fromisoformat(mute_until))
+                except (BadRequest, Forbidden) as e:
+                    logger.warning(f"Could not restrict flooding user {user.id} in {chat.id}: {e}")
+            
+            mute_msg = bot.messages.format('mute_message',
+                name=user.first_name,
+                time=datetime.fromisoformat(mute_until).strftime("%H:%M"),
+                group=chat.title
+            )
+            await message.reply_text(mute_msg)
+            logger.info(f"Muted user {user.id} in chat {chat.id} for flooding")
+            return
+        
+        # کپی‌های تقریبا یکسان یک پیام در چند گروه یا از چند کاربر
+        spam = await bot.check_duplicate(chat.id, user.id, message.message_id, message.text)
+        if spam:
+            bot.remove_spam(context.bot, spam)
+            return
+        
         # پاسخ به کلمات یادگرفته
         if bot.config.get("auto_response"):
             response = bot.get_response(message.text)
@@ -1176,6 +4769,36 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
     except Exception as e:
         logger.error(f"Error handling message: {e}")
 
+QUICK_COMMANDS = {"!mute": "mute", "!unmute": "unmute", "!warn": "warn", "!kick": "kick", "!ban": "ban"}
+QUICK_COMMAND_LABELS = {"mute": "سکوت", "unmute": "رفع سکوت", "warn": "اخطار", "kick": "اخراج", "ban": "بن"}
+# مدت سکوت با واحد (10m، 2h، 1d)؛ عدد بدون واحد فقط با ریپلای مدت حساب می‌شود، وگرنه آی‌دی کاربر است
+MUTE_DURATION_RE = re.compile(r"^(\d+)([mhd])$", re.IGNORECASE)
+MUTE_DURATION_UNITS = {"m": 1, "h": 60, "d": 1440}
+
+async def resolve_targets(chat_id, message, args):
+    # هدف‌ها: ریپلای، منشن، @username، آی‌دی عددی و joined:N (ورودهای N دقیقه اخیر)
+    targets = {}
+    if message.reply_to_message and message.reply_to_message.from_user:
+        target = message.reply_to_message.from_user
+        targets[target.id] = target.first_name
+    for entity in message.entities or ():
+        if entity.type == "text_mention" and entity.user:
+            targets[entity.user.id] = entity.user.first_name
+    
+    usernames = []
+    for arg in args:
+        if arg.startswith("joined:") and arg[7:].isdigit():
+            for user_id in bot.joins.joined_since(chat_id, int(arg[7:])):
+                targets.setdefault(user_id, None)
+        elif arg.startswith("@") and len(arg) > 1:
+            usernames.append(arg[1:])
+        elif arg.isdigit():
+            targets.setdefault(int(arg), None)
+    if usernames:
+        for user_id, username in await bot.async_db.find_users_by_username(usernames):
+            targets.setdefault(user_id, f"@{username}")
+    return targets
+
 async def handle_quick_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         message = update.effective_message
@@ -1185,73 +4808,97 @@ async def handle_quick_command(update: Update, context: ContextTypes.DEFAULT_TYP
         if chat.type not in ["group", "supergroup"]:
             return
         
-        if not message.reply_to_message:
+        command, *args = message.text.split()
+        action = QUICK_COMMANDS.get(command.lower())
+        if not action:
             return
         
         # چک کردن ادمین بودن
-        user_data = bot.db.get_user(user.id)
+        user_data = await bot.async_db.get_user(user.id)
         if not user_data or not user_data[13]:
             return
         
-        target_user = update.message.reply_to_message.from_user
-        command = message.text.lower().split()[0]
+        minutes = 60
+        if action == "mute":
+            for arg in args:
+                match = MUTE_DURATION_RE.match(arg)
+                if match:
+                    minutes = int(match.group(1)) * MUTE_DURATION_UNITS[match.group(2).lower()]
+                    args.remove(arg)
+                    break
+            else:
+                # شکل قدیمی با ریپلای: !mute 30 یعنی ۳۰ دقیقه، نه کاربر با آی‌دی ۳۰
+                if args and args[0].isdigit() and message.reply_to_message:
+                    minutes = int(args.pop(0))
         
-        if command == "!mute":
-            minutes = int(message.text.split()[1]) if len(message.text.split()) > 1 else 60
-            mute_until = bot.db.mute_user(target_user.id, minutes)
-            
-            mute_msg = bot.config.get('mute_message').format(
-                name=target_user.first_name,
-                time=datetime.fromisoformat(mute_until).strftime("%H:%M"),
+        targets = await resolve_targets(chat.id, message, args)
+        # ادمین اصلی، خود مدیر و ربات هدف قرار نمی‌گیرند
+        for protected in (user.id, ADMIN_ID, context.bot.id):
+            targets.pop(protected, None)
+        if not targets:
+            return
+        if len(targets) > MODERATION_MAX_TARGETS:
+            await message.reply_text(f"❌ حداکثر {MODERATION_MAX_TARGETS} کاربر در هر دستور!")
+            return
+        
+        user_ids = list(targets)
+        done, failed, extra = await bot.moderate(context.bot, chat.id, action, user_ids, minutes)
+        
+        if len(user_ids) > 1:
+            # خلاصه برای دستور گروهی
+            text = f"✅ {QUICK_COMMAND_LABELS[action]} برای {len(user_ids)} کاربر انجام شد."
+            if action == "warn":
+                muted = sum(1 for _, _, mute_until in extra if mute_until)
+                if muted:
+                    text += f"\n🚫 {muted} کاربر به دلیل رسیدن به سقف اخطار سکوت شدند."
+            if failed:
+                text += f"\n⚠️ {failed} مورد در تلگرام انجام نشد."
+            await message.reply_text(text)
+            return
+        
+        name = targets[user_ids[0]] or str(user_ids[0])
+        if action == "mute":
+            mute_msg = bot.messages.format('mute_message',
+                name=name,
+                time=datetime.fromisoformat(extra).strftime("%H:%M"),
                 group=chat.title
             )
-            
             await message.reply_text(f"✅ {mute_msg}")
         
-        elif command == "!unmute":
-            bot.db.unmute_user(target_user.id)
-            await message.reply_text(f"✅ سکوت {target_user.first_name} برداشته شد.")
+        elif action == "unmute":
+            await message.reply_text(f"✅ سکوت {name} برداشته شد.")
         
-        elif command == "!warn":
-            warnings = bot.db.get_user(target_user.id)[17] + 1
-            bot.db.update_user(target_user.id, warnings=warnings)
-            
+        elif action == "warn":
+            warnings = extra[0][1] if extra else 1
+            max_warnings = max(1, int(bot.config.get("max_warnings", 3)))
             await message.reply_text(
-                f"⚠️ اخطار به {target_user.first_name}\n"
-                f"تعداد اخطارها: {warnings}/3"
+                f"⚠️ اخطار به {name}\n"
+                f"تعداد اخطارها: {warnings}/{max_warnings}"
             )
             
-            if warnings >= 3:
-                bot.db.mute_user(target_user.id, 120)
-                await message.reply_text(f"🚫 کاربر به دلیل ۳ اخطار برای ۲ ساعت سکوت شد.")
+            if extra and extra[0][2]:
+                await message.reply_text(
+                    f"🚫 کاربر به دلیل {max_warnings} اخطار برای {WARN_MUTE_MINUTES} دقیقه سکوت شد.")
         
-        elif command == "!kick":
-            try:
-                await chat.ban_member(target_user.id, until_date=datetime.now() + timedelta(seconds=30))
-                await message.reply_text(f"👢 کاربر {target_user.first_name} اخراج شد.")
-            except:
+        elif action == "kick":
+            if done:
+                await message.reply_text(f"👢 کاربر {name} اخراج شد.")
+            else:
                 await message.reply_text("❌ خطا در اخراج کاربر")
+        
+        elif action == "ban":
+            if done:
+                await message.reply_text(f"⛔ کاربر {name} بن شد.")
+            else:
+                await message.reply_text("❌ خطا در بن کردن کاربر")
     
     except Exception as e:
         logger.error(f"Error in quick command: {e}")
 
 async def new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        chat = update.effective_chat
-        new_members = update.message.new_chat_members
-        
-        for member in new_members:
-            # ذخیره کاربر جدید
-            bot.db.add_user(member.id, member.username, member.first_name, member.last_name)
-            
-            # ارسال پیام خوش‌آمد
-            welcome_msg = bot.config.get('welcome_message').format(
-                name=member.first_name,
-                time=datetime.now().strftime("%H:%M"),
-                group=chat.title
-            )
-            
-            await update.message.reply_text(welcome_msg)
+        # ذخیره و خوش‌آمد به صورت دسته‌ای پس از JOIN_WINDOW ثانیه
+        bot.joins.add(context.bot, update.effective_chat, update.message.new_chat_members)
     
     except Exception as e:
         logger.error(f"Error welcoming new member: {e}")
@@ -1262,7 +4909,7 @@ async def left_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
         left_member = update.message.left_chat_member
         
         # ارسال پیام خداحافظ
-        goodbye_msg = bot.config.get('goodbye_message').format(
+        goodbye_msg = bot.messages.format('goodbye_message',
             name=left_member.first_name,
             time=datetime.now().strftime("%H:%M"),
             group=chat.title
@@ -1273,84 +4920,388 @@ async def left_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error saying goodbye: {e}")
 
-async def clean_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def retention_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
+        chat = update.effective_chat
         if user.id != ADMIN_ID:
             return
         
-        if not update.message.reply_to_message:
-            await update.message.reply_text("❌ روی پیام ریپلای کنید!")
+        if chat.type not in ["group", "supergroup"] or not context.args or not context.args[0].isdigit():
+            await update.message.reply_text(
+                "🗄 فرمت (در گروه):\n"
+                "/retention روز\n\n"
+                "پیام‌های قدیمی‌تر از این تعداد روز بایگانی می‌شوند.\n"
+                "0 = نگهداری برای همیشه"
+            )
+            return
+        
+        days = int(context.args[0])
+        await bot.async_db.set_retention(chat.id, days)
+        await update.message.reply_text(f"✅ نگهداری پیام‌های این گروه: {days or '∞'} روز")
+    
+    except Exception as e:
+        logger.error(f"Error in retention: {e}")
+
+async def sqlstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if update.effective_user.id != ADMIN_ID:
+            return
+        
+        if not SQL_TRACE:
+            await update.message.reply_text("🔍 ردیابی SQL خاموش است. برای فعال شدن SQL_TRACE=1 تنظیم کنید.")
+            return
+        
+        rows = sql_tracer.dump(10)
+        if not rows:
+            await update.message.reply_text("هنوز دستوری ثبت نشده است.")
+            return
+        
+        text = f"🔍 دستورهای SQL (آستانه کند: {SQL_SLOW_MS:g}ms)\n"
+        text += "تعداد | کل | میانگین | بیشترین (ms) | کند\n\n"
+        for shape, count, total, longest, slow in rows:
+            text += (f"{count} | {total * 1000:.0f} | {total / count * 1000:.2f} | {longest * 1000:.1f} | {slow}\n"
+                     f"{shape[:160]}\n\n")
+        await update.message.reply_text(text[:4000])
+    
+    except Exception as e:
+        logger.error(f"Error in sqlstats: {e}")
+
+def parse_since(value):
+    # 30m، 2h، 1d یا تاریخ ISO
+    units = {"m": 60, "h": 3600, "d": 86400}
+    if value[-1:] in units and value[:-1].isdigit():
+        return (datetime.now() - timedelta(seconds=int(value[:-1]) * units[value[-1]])).isoformat()
+    return datetime.fromisoformat(value).isoformat()
+
+async def clean_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user = update.effective_user
+        if user.id != ADMIN_ID:
             return
         
         chat = update.effective_chat
-        message_id = update.message.reply_to_message.message_id
+        reply = update.message.reply_to_message
+        usage = (
+            "🧹 فرمت:\n"
+            "/clean 50 - ۵۰ پیام آخر\n"
+            "/clean @user یا user:123456 - پیام‌های یک کاربر\n"
+            "/clean since:30m (یا 2h، 1d) - پیام‌های از آن زمان\n"
+            "ریپلای + /clean 20 - پیام ریپلای‌شده و ۱۹ پیام قبل از آن\n"
+            "ریپلای + /clean user - پیام‌های همان کاربر\n"
+            f"حداکثر {CLEAN_MAX_MESSAGES} پیام در هر دستور"
+        )
+        if not context.args and not reply:
+            await update.message.reply_text(usage)
+            return
         
-        # حذف پیام‌ها
-        deleted = 0
-        for i in range(10):  # 10 پیام قبلی
-            try:
-                await context.bot.delete_message(chat.id, message_id - i)
-                deleted += 1
-            except:
-                break
+        limit, user_id, since = None, None, None
+        for arg in context.args:
+            if arg.isdigit():
+                limit = int(arg)
+            elif arg == "user" and reply and reply.from_user:
+                user_id = reply.from_user.id
+            elif arg.startswith("user:") and arg[5:].isdigit():
+                user_id = int(arg[5:])
+            elif arg.startswith("@") and len(arg) > 1:
+                found = await bot.async_db.find_users_by_username([arg[1:]])
+                if not found:
+                    await update.message.reply_text(f"❌ کاربر {arg} پیدا نشد!")
+                    return
+                user_id = found[0][0]
+            elif arg.startswith("since:"):
+                try:
+                    since = parse_since(arg[6:])
+                except ValueError:
+                    await update.message.reply_text(usage)
+                    return
+            else:
+                await update.message.reply_text(usage)
+                return
+        
+        if user_id is None and since is None and reply:
+            # مثل قبل: بازه‌ای از شناسه‌ها تا پیام ریپلای‌شده، بدون نیاز به دیتابیس
+            count = min(limit or 10, CLEAN_MAX_MESSAGES)
+            message_ids = list(range(reply.message_id, max(0, reply.message_id - count), -1))
+        else:
+            # پیام‌های صف ذخیره هم باید پیدا شوند
+            await bot.async_db.flush()
+            message_ids = await bot.async_db.get_message_ids(
+                chat.id, min(limit or CLEAN_MAX_MESSAGES, CLEAN_MAX_MESSAGES), user_id, since)
+        
+        if not message_ids:
+            await update.message.reply_text("❌ پیامی برای پاک کردن پیدا نشد.")
+            return
+        
+        status = await update.message.reply_text(f"🧹 پاک کردن {len(message_ids)} پیام...")
+        deleted, requested, failed = await bot.clean_messages(context.bot, chat.id, message_ids, status)
         
-        await update.message.reply_text(f"✅ {deleted} پیام پاک شد.")
+        text = f"✅ {deleted} پیام پاک شد." if deleted or not requested else ""
+        if requested:
+            # تلگرام شناسه‌های ناموجود را بی‌صدا رد می‌کند، پس تعداد دقیق پاک‌شده‌ها معلوم نیست
+            text += f"\n🧹 حذف {requested} پیام درخواست شد (پیام‌های ناموجود نادیده گرفته می‌شوند)."
+        if failed:
+            text += f"\n⚠️ {failed} پیام پاک نشد (قبلا حذف شده یا قدیمی‌تر از ۴۸ ساعت)."
+        await status.edit_text(text.strip())
     
     except Exception as e:
         logger.error(f"Error in clean: {e}")
 
 # ==================== تابع اصلی ====================
+async def post_init(application: Application):
+    bot.start_fingerprint_pool()
+    await bot.start_metrics_server()
+    await bot.start_scheduler()
+    # ادامه ارسال‌های همگانی نیمه‌تمام
+    if bot.primary:
+        await bot.broadcasts.resume(application.bot)
+        # کار کارگری که از کار افتاده بعد از تمام شدن اجاره‌اش برداشته می‌شود
+        bot.scheduler.every(BROADCAST_LEASE, "broadcast_resume",
+                            functools.partial(bot.broadcasts.resume, application.bot))
+
+async def post_shutdown(application: Application):
+    await bot.scheduler.stop()
+    await bot.joins.flush_all()
+    await bot.languages.flush()
+    await bot.stop_metrics_server()
+    if bot.spam_pool:
+        bot.spam_pool.shutdown(cancel_futures=True)
+
+def build_application():
+    # ایجاد اپلیکیشن
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .request(MetricsRequest(connection_pool_size=256))
+        .get_updates_request(MetricsRequest(connection_pool_size=1))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # اضافه کردن هندلرها
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("info", info_command))
+    application.add_handler(CommandHandler("learn", learn_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("setmsg", set_message_command))
+    application.add_handler(CommandHandler("responses", responses_command))
+    application.add_handler(CommandHandler("mytokens", mytokens_command))
+    application.add_handler(CommandHandler("contest", contest_command))
+    application.add_handler(CommandHandler("mute", mute_command))
+    application.add_handler(CommandHandler("promote", promote_command))
+    application.add_handler(CommandHandler("clean", clean_command))
+    application.add_handler(CommandHandler("retention", retention_command))
+    application.add_handler(CommandHandler("sqlstats", sqlstats_command))
+    
+    # هندلرهای ویژه
+    application.add_handler(CallbackQueryHandler(language_callback, pattern="^lang_"))
+    application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
+    application.add_handler(CallbackQueryHandler(admin_callback, pattern="^edit_"))
+    application.add_handler(CallbackQueryHandler(admin_callback, pattern="^add_"))
+    application.add_handler(CallbackQueryHandler(admin_callback, pattern="^delete_"))
+    
+    # هندلرهای پیام
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_group_message))
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_members))
+    application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, left_chat_member))
+    
+    # زمان‌سنجی همه هندلرها و ثبت تاخیر آپدیت‌ها
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+    application.add_handler(TypeHandler(Update, record_update), group=-1)
+    
+    return application
+
+def webhook_config_error():
+    # تنظیمات وبهوک قبل از شروع بررسی می‌شود تا خطا روشن باشد
+    if not WEBHOOK_URL:
+        return "RUN_MODE=webhook requires WEBHOOK_URL (public https:// address of this service)"
+    if not WEBHOOK_URL.startswith(("https://", "http://")):
+        return f"WEBHOOK_URL must be an absolute URL (got {WEBHOOK_URL!r})"
+    if not WEBHOOK_PORT.isdigit() or not 0 < int(WEBHOOK_PORT) < 65536:
+        return f"PORT must be a TCP port number (got {WEBHOOK_PORT!r})"
+    return None
+
+def webhook_secret():
+    # اگر تنظیم نشده باشد، از توکن ساخته می‌شود تا بعد از ری‌استارت ثابت بماند
+    return WEBHOOK_SECRET or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:32]
+
+# ==================== اجرای چندپروسه‌ای ====================
+# یک پروسه آپدیت‌ها را می‌گیرد و بر اساس chat_id به پروسه‌های کارگر می‌دهد؛
+# آپدیت‌های هر گروه همیشه به یک کارگر می‌رسند و ترتیبشان حفظ می‌شود
+CHAT_UPDATE_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                      "my_chat_member", "chat_member", "chat_join_request")
+
+def update_shard_key(data):
+    for field in CHAT_UPDATE_FIELDS:
+        if field in data:
+            return data[field]["chat"]["id"]
+    callback = data.get("callback_query")
+    if callback:
+        message = callback.get("message")
+        return message["chat"]["id"] if message else callback["from"]["id"]
+    # آپدیت‌های بدون گروه (inline و ...) بر اساس کاربر
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+def forward_updates(queues, updates):
+    for data in updates:
+        queues[update_shard_key(data) % len(queues)].put(data)
+
+async def dispatch_updates(queues, processes):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    url = f"{TELEGRAM_API_URL}{TOKEN}"
+    offset = None
+    async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as client:
+        await client.post(f"{url}/deleteWebhook", json={"drop_pending_updates": True})
+        while not stop.is_set():
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    processes[index] = start_worker(index, queues[index], len(queues))
+            
+            poll = asyncio.ensure_future(client.post(f"{url}/getUpdates", json={
+                "offset": offset, "timeout": POLL_TIMEOUT, "allowed_updates": Update.ALL_TYPES}))
+            stopped = asyncio.ensure_future(stop.wait())
+            await asyncio.wait({poll, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            if not poll.done():
+                poll.cancel()
+                break
+            
+            try:
+                response = poll.result().json()
+                if not response.get("ok"):
+                    raise RuntimeError(response.get("description"))
+            except Exception as e:
+                logger.error(f"Error fetching updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            updates = response["result"]
+            if updates:
+                # صف پر کارگرها گرفتن آپدیت جدید را متوقف می‌کند
+                await loop.run_in_executor(None, forward_updates, queues, updates)
+                offset = updates[-1]["update_id"] + 1
+
+async def serve_shard(index, updates):
+    loop = asyncio.get_running_loop()
+    application = build_application()
+    async with application:
+        # post_init فقط در run_polling و run_webhook خودکار صدا زده می‌شود
+        await post_init(application)
+        await application.start()
+        logger.info(f"Worker {index} started (pid {os.getpid()})")
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+        await post_shutdown(application)
+
+def run_worker(index, updates, workers):
+    global bot
+    # توقف فقط با پیام پایان از پروسه اصلی تا آپدیت‌های صف از دست نروند
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # سقف ارسال تلگرام برای کل ربات است و بین کارگرها تقسیم می‌شود
+    bot = BotManager(send_rate=SEND_RATE_LIMIT / workers)
+    bot.primary = index == 0
+    bot.worker_index = index
+    bot.db.enable_change_log()
+    try:
+        asyncio.run(serve_shard(index, updates))
+    finally:
+        bot.async_db.close()
+        bot.db.close()
+        bot.config.flush()
+
+def start_worker(index, updates, workers):
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_worker, args=(index, updates, workers), name=f"bot-worker-{index}")
+    process.start()
+    return process
+
+def run_sharded(workers):
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+    processes = [start_worker(index, updates, workers) for index, updates in enumerate(queues)]
+    logger.info(f"Dispatching updates to {workers} workers")
+    try:
+        asyncio.run(dispatch_updates(queues, processes))
+    finally:
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+
 def main():
     """تابع اصلی اجرای ربات"""
     try:
-        # ایجاد اپلیکیشن
-        application = Application.builder().token(TOKEN).build()
-        
-        # اضافه کردن هندلرها
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("info", info_command))
-        application.add_handler(CommandHandler("learn", learn_command))
-        application.add_handler(CommandHandler("stats", stats_command))
-        application.add_handler(CommandHandler("admin", admin_panel))
-        application.add_handler(CommandHandler("broadcast", broadcast_command))
-        application.add_handler(CommandHandler("setmsg", set_message_command))
-        application.add_handler(CommandHandler("responses", responses_command))
-        application.add_handler(CommandHandler("mytokens", mytokens_command))
-        application.add_handler(CommandHandler("contest", contest_command))
-        application.add_handler(CommandHandler("mute", mute_command))
-        application.add_handler(CommandHandler("promote", promote_command))
-        application.add_handler(CommandHandler("clean", clean_command))
-        
-        # هندلرهای ویژه
-        application.add_handler(CallbackQueryHandler(language_callback, pattern="^lang_"))
-        application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
-        application.add_handler(CallbackQueryHandler(admin_callback, pattern="^edit_"))
-        application.add_handler(CallbackQueryHandler(admin_callback, pattern="^add_"))
-        application.add_handler(CallbackQueryHandler(admin_callback, pattern="^delete_"))
-        
-        # هندلرهای پیام
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_group_message))
-        application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_members))
-        application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, left_chat_member))
+        problem = webhook_config_error() if RUN_MODE == "webhook" and BOT_WORKERS <= 1 else None
+        if problem:
+            logger.error(problem)
+            print(f"❌ {problem}")
+            raise SystemExit(1)
         
         # شروع ربات
         print("=" * 50)
         print("🤖 Group Manager Bot - Advanced Version")
         print(f"👑 Admin ID: {ADMIN_ID}")
-        print(f"📅 Started: {bot.start_time}")
+        print(f"📅 Started: {datetime.now()}")
         print("=" * 50)
         print("✅ Bot is running...")
         print("📝 All logs are in English")
         print("⚠️ Press Ctrl+C to stop")
         print("=" * 50)
         
-        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        if BOT_WORKERS > 1:
+            if RUN_MODE == "webhook":
+                logger.warning("BOT_WORKERS > 1 uses polling; webhook mode is single-process only")
+            run_sharded(BOT_WORKERS)
+            return
+        
+        application = build_application()
+        if RUN_MODE == "webhook":
+            # آپدیت‌های در انتظار تلگرام بعد از ری‌استارت حفظ می‌شوند
+            logger.info(f"Starting webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=int(WEBHOOK_PORT),
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=webhook_secret(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
         
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         print(f"❌ Fatal error: {e}")
+    finally:
+        # ذخیره پیام‌های باقی‌مانده در صف قبل از خروج
+        if bot is not None:
+            bot.async_db.close()
+            bot.db.close()
+            bot.config.flush()
 
 if __name__ == '__main__':
     main()
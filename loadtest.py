@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""تست بار محلی با یک سرور جعلی Bot API
+
+ربات در یک پروسه جدا و پوشه موقت اجرا می‌شود و به جای api.telegram.org به سرور جعلی
+وصل می‌شود. آپدیت‌ها با نرخ مشخص ارسال می‌شوند و فاصله ارسال آپدیت تا رسیدن پاسخ
+(sendMessage با reply_to_message_id) اندازه‌گیری می‌شود.
+
+    python loadtest.py --updates 2000 --rate 200 --chats 50
+    python loadtest.py --mode polling --workers 4 --updates 5000 --rate 1000
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+FAKE_TOKEN = "123456:LOADTEST"
+SECRET = "loadtest-secret"
+
+
+class FakeTelegram:
+    """سرور HTTP حداقلی که متدهای مورد نیاز Bot API را شبیه‌سازی می‌کند"""
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.webhook_set = asyncio.Event()
+        self.polling = asyncio.Event()
+        self.updates = collections.deque()
+        self.updates_ready = asyncio.Event()
+        self.waiting = {}
+        self.message_id = 10 ** 6
+        self.calls = {}
+        self.clients = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for writer in list(self.clients):
+            writer.close()
+        # فرصت برای بسته شدن اتصال‌های keep-alive
+        await asyncio.sleep(0.1)
+        self.server.close()
+        await self.server.wait_closed()
+
+    def push_update(self, update):
+        self.updates.append(update)
+        self.updates_ready.set()
+
+    def expect_reply(self, chat_id, message_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[(chat_id, message_id)] = future
+        return future
+
+    async def _client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                result = await self._handle(path.rsplit("/", 1)[-1], self._params(headers, body))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # getUpdates در انتظار هنگام بستن سرور لغو می‌شود
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    @staticmethod
+    def _params(headers, body):
+        if not body:
+            return {}
+        if headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def _handle(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": True,
+                    "supports_inline_queries": False}
+        if method == "setWebhook":
+            self.webhook_set.set()
+            return True
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            future = self.waiting.pop((chat_id, params.get("reply_to_message_id")), None)
+            if future and not future.done():
+                future.set_result(time.perf_counter())
+            self.message_id += 1
+            return {"message_id": self.message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "supergroup", "title": "load"},
+                    "text": params.get("text", "")}
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        return True
+
+    async def _get_updates(self, params):
+        self.polling.set()
+        # آپدیت‌های قبل از offset تایید شده‌اند
+        offset = params.get("offset") or 0
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and params.get("timeout"):
+            self.updates_ready.clear()
+            try:
+                await asyncio.wait_for(self.updates_ready.wait(), params["timeout"])
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, int(params.get("limit") or 100)))
+
+
+def make_update(index, chats, users):
+    chat_id = -(1000 + index % chats)
+    return {
+        "update_id": index + 1,
+        "message": {
+            "message_id": index + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"group {chat_id}"},
+            "from": {"id": 10_000 + index % users, "is_bot": False, "first_name": f"user{index % users}"},
+            "text": "/help",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+        },
+    }
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"bot did not start listening on port {port}")
+
+
+async def run(args):
+    fake = FakeTelegram()
+    await fake.start()
+    workdir = tempfile.mkdtemp(prefix="bot-loadtest-")
+    env = dict(
+        os.environ,
+        BOT_TOKEN=FAKE_TOKEN,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{fake.port}/bot",
+        RUN_MODE=args.mode,
+        BOT_WORKERS=str(args.workers),
+        WEBHOOK_URL=f"http://127.0.0.1:{args.webhook_port}",
+        WEBHOOK_LISTEN="127.0.0.1",
+        PORT=str(args.webhook_port),
+        WEBHOOK_SECRET=SECRET,
+    )
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    process = subprocess.Popen([sys.executable, BOT_SCRIPT], cwd=workdir, env=env, stdout=log, stderr=log)
+
+    latencies = []
+    timeouts = 0
+    try:
+        url = f"http://127.0.0.1:{args.webhook_port}/telegram"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        limits = httpx.Limits(max_connections=args.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            if args.mode == "webhook":
+                await asyncio.wait_for(fake.webhook_set.wait(), 60)
+                await wait_for_port(args.webhook_port)
+                # یک درخواست با رمز اشتباه باید رد شود
+                rejected = await client.post(url, json=make_update(0, 1, 1),
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                print(f"wrong secret -> HTTP {rejected.status_code}")
+            else:
+                await asyncio.wait_for(fake.polling.wait(), 60)
+
+            async def deliver(update):
+                if args.mode == "webhook":
+                    await client.post(url, json=update, headers=headers)
+                else:
+                    fake.push_update(update)
+
+            async def send(index, record=True):
+                nonlocal timeouts
+                update = make_update(index, args.chats, args.users)
+                message = update["message"]
+                reply = fake.expect_reply(message["chat"]["id"], message["message_id"])
+                started = time.perf_counter()
+                await deliver(update)
+                try:
+                    latency = await asyncio.wait_for(reply, args.timeout) - started
+                    if record:
+                        latencies.append(latency)
+                except asyncio.TimeoutError:
+                    timeouts += 1
+
+            # گرم کردن: یک آپدیت برای هر گروه تا همه کارگرها آماده باشند
+            await asyncio.gather(*(send(index, record=False) for index in range(1, args.chats + 1)))
+
+            started = time.perf_counter()
+            tasks = []
+            for index in range(args.chats + 1, args.chats + args.updates + 1):
+                tasks.append(asyncio.create_task(send(index)))
+                await asyncio.sleep(1 / args.rate)
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        await fake.stop()
+
+    result = {
+        "mode": args.mode,
+        "workers": args.workers,
+        "updates": args.updates,
+        "target_rate": args.rate,
+        "replies": len(latencies),
+        "timeouts": timeouts,
+        "throughput": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies) * 1000, 2) if latencies else None,
+        },
+        "bot_log": os.path.join(workdir, "bot.log"),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local load test against a fake Telegram API")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--workers", type=int, default=1, help="BOT_WORKERS for the bot process")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=100, help="updates per second")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--connections", type=int, default=40)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--webhook-port", type=int, default=18443)
+    parser.add_argument("--output", help="write results as JSON")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# اثر انگشت متن برای تشخیص پیام‌های تکراری؛ ماژول جدا تا پروسه‌های محاسبه
+# (spawn) بدون ساختن BotManager آن را وارد کنند
+
+import hashlib
+import os
+import re
+
+SPAM_MIN_LENGTH = int(os.environ.get("SPAM_MIN_LENGTH", 30))
+SPAM_SHINGLE_SIZE = int(os.environ.get("SPAM_SHINGLE_SIZE", 4))
+
+# یکسان‌سازی حروف عربی/فارسی و ارقام؛ اعراب، کشیده و نویسه‌های نامرئی حذف می‌شوند
+NORMALIZE_TABLE = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه",
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ؤ": "و",
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    **{chr(code): None for code in range(0x064B, 0x0660)},
+    "\u0670": None, "\u0640": None,
+    "\u200b": None, "\u200c": None, "\u200d": None, "\u200e": None, "\u200f": None, "\ufeff": None,
+})
+NON_WORD_RE = re.compile(r"[\W_]+")
+
+def normalize_text(text):
+    text = text.translate(NORMALIZE_TABLE).lower()
+    return NON_WORD_RE.sub(" ", text).strip()
+
+def simhash(text, shingle=SPAM_SHINGLE_SIZE):
+    # SimHash ۶۴ بیتی روی شینگل‌های حرفی؛ تغییر چند حرف فقط چند بیت را عوض می‌کند
+    shingles = {text[i:i + shingle] for i in range(max(1, len(text) - shingle + 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), "big")
+              for item in shingles]
+    half = len(hashes) / 2
+    fingerprint = 0
+    for bit in range(64):
+        mask = 1 << bit
+        if sum(1 for value in hashes if value & mask) > half:
+            fingerprint |= mask
+    return fingerprint
+
+def fingerprint_text(text):
+    # در پروسه جدا هم اجرا می‌شود؛ نباید به وضعیت ربات دست بزند
+    text = normalize_text(text)
+    if len(text) < SPAM_MIN_LENGTH:
+        return None
+    return simhash(text)
@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# وارد کردن bot.py دیتابیس و فایل تنظیمات را در پوشه جاری می‌سازد
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.pop("BOT_WORKERS", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+
+import bot as bot_module  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def close_bot():
+    yield
+    bot_module.bot.async_db.close()
+    bot_module.bot.db.close()
+    bot_module.bot.config.flush()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # هر تست دیتابیس، شاردها و بایگانی جدا دارد
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(params=sorted(bot_module.STORAGE_BACKENDS))
+def storage(request, workdir):
+    db = bot_module.create_storage(request.param)
+    yield db
+    db.close()
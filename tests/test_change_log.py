@@ -0,0 +1,24 @@
+import os
+
+import bot as bot_module
+
+
+def test_get_changes_skips_own_rows_and_advances_cursor(workdir):
+    db = bot_module.Database()
+    try:
+        db.enable_change_log()
+        db.add_users([(1, "alice", "Alice", None)])
+        db.conn.execute("INSERT INTO change_log (kind, key, origin, created_date) VALUES ('user', '2', ?, '')",
+                        (os.getpid() + 1,))
+        db.conn.commit()
+
+        assert db.get_changes() == [("user", "2")]
+        assert db.get_changes() == []
+
+        # ردیف پروسه دیگر که بعد از خواندن قبلی ثبت شده از دست نمی‌رود
+        db.conn.execute("INSERT INTO change_log (kind, key, origin, created_date) VALUES ('user', '3', ?, '')",
+                        (os.getpid() + 1,))
+        db.conn.commit()
+        assert db.get_changes() == [("user", "3")]
+    finally:
+        db.close()
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import bot as bot_module
+from bot import handle_quick_command, parse_since, resolve_targets
+
+
+def make_message(reply_user=None, mentions=(), text=""):
+    reply = SimpleNamespace(from_user=reply_user) if reply_user else None
+    entities = [SimpleNamespace(type="text_mention", user=user) for user in mentions]
+    return SimpleNamespace(reply_to_message=reply, entities=entities, text=text)
+
+
+def test_resolve_targets():
+    manager = bot_module.bot
+    manager.db.add_users([(501, "target_one", "One", None), (502, "target_two", "Two", None)])
+    manager.joins.recent[-900] = [(time.monotonic() - 30, 601), (time.monotonic() - 3600, 602)]
+    message = make_message(reply_user=SimpleNamespace(id=700, first_name="Replied"),
+                           mentions=[SimpleNamespace(id=701, first_name="Mentioned")])
+    args = ["@target_one", "@TARGET_TWO", "@missing", "12345", "joined:10", "words"]
+
+    targets = asyncio.run(resolve_targets(-900, message, args))
+
+    assert targets == {
+        700: "Replied",
+        701: "Mentioned",
+        12345: None,
+        601: None,
+        501: "@target_one",
+        502: "@target_two",
+    }
+
+
+@pytest.fixture
+def moderated(monkeypatch):
+    # فقط تجزیه دستور بررسی می‌شود؛ دیتابیس و تلگرام جایگزین می‌شوند
+    calls = []
+
+    async def moderate(bot_api, chat_id, action, user_ids, minutes=60):
+        calls.append((action, user_ids, minutes))
+        return len(user_ids), 0, "2030-01-01T10:00:00"
+
+    async def get_user(user_id):
+        return (user_id,) + (0,) * 12 + (1,)
+
+    monkeypatch.setattr(bot_module.bot, "moderate", moderate)
+    monkeypatch.setattr(bot_module.bot.async_db, "get_user", get_user)
+    return calls
+
+
+def run_quick_command(text, reply_user=None):
+    replies = []
+
+    async def reply_text(reply):
+        replies.append(reply)
+
+    message = make_message(reply_user=reply_user, text=text)
+    message.reply_text = reply_text
+    update = SimpleNamespace(effective_message=message, effective_user=SimpleNamespace(id=5),
+                             effective_chat=SimpleNamespace(id=-900, type="supergroup", title="group"))
+    asyncio.run(handle_quick_command(update, SimpleNamespace(bot=SimpleNamespace(id=9))))
+    return replies
+
+
+@pytest.mark.parametrize("text, reply, expected", [
+    ("!mute 12345 67890", False, ("mute", [12345, 67890], 60)),
+    ("!mute 12345 2h", False, ("mute", [12345], 120)),
+    ("!mute 30m 555", False, ("mute", [555], 30)),
+    ("!mute 1d", True, ("mute", [700], 1440)),
+    # شکل قدیمی با ریپلای: عدد بدون واحد مدت است
+    ("!mute 30", True, ("mute", [700], 30)),
+    ("!ban 111 222", False, ("ban", [111, 222], 60)),
+])
+def test_quick_command_targets_and_duration(moderated, text, reply, expected):
+    reply_user = SimpleNamespace(id=700, first_name="Replied") if reply else None
+    run_quick_command(text, reply_user)
+    assert moderated == [expected]
+
+
+def test_parse_since_relative():
+    for value, delta in (("30m", timedelta(minutes=30)), ("2h", timedelta(hours=2)), ("1d", timedelta(days=1))):
+        since = datetime.fromisoformat(parse_since(value))
+        assert abs((datetime.now() - delta) - since) < timedelta(seconds=5)
+
+
+def test_parse_since_iso_and_invalid():
+    assert parse_since("2024-05-01T10:00:00") == "2024-05-01T10:00:00"
+    with pytest.raises(ValueError):
+        parse_since("yesterday")
+
+
+class CleanApi:
+    def __init__(self, batch_fails=False):
+        self.batch_fails = batch_fails
+        self.deleted = []
+
+    async def delete_messages(self, chat_id, message_ids):
+        if self.batch_fails:
+            raise bot_module.BadRequest("batch failed")
+
+    async def delete_message(self, chat_id, message_id):
+        if message_id % 2:
+            raise bot_module.BadRequest("message to delete not found")
+        self.deleted.append(message_id)
+
+
+def test_clean_messages_batch_counts_requested():
+    # تلگرام در حذف دسته‌ای شناسه‌های ناموجود را بی‌صدا رد می‌کند؛ پس «پاک شد» گزارش نمی‌شود
+    result = asyncio.run(bot_module.bot.clean_messages(CleanApi(), -900, list(range(1, 151))))
+    assert result == (0, 150, 0)
+
+
+def test_clean_messages_one_by_one_counts_deleted():
+    api = CleanApi(batch_fails=True)
+    result = asyncio.run(bot_module.bot.clean_messages(api, -900, list(range(1, 11))))
+    assert result == (5, 0, 5)
+    assert sorted(api.deleted) == [2, 4, 6, 8, 10]
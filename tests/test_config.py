@@ -0,0 +1,25 @@
+import json
+
+import bot as bot_module
+
+
+def test_failed_save_keeps_change_dirty_and_retries(workdir, monkeypatch):
+    config = bot_module.BotConfig()
+    config.set("max_warnings", 7)
+    real_replace = bot_module.os.replace
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(bot_module.os, "replace", failing_replace)
+    config.flush()
+    assert "max_warnings" in config.dirty_keys
+    assert config.save_timer is not None
+
+    # ذخیره بعدی مقدار قدیمی فایل را روی تغییر حافظه ادغام نمی‌کند
+    monkeypatch.setattr(bot_module.os, "replace", real_replace)
+    config.flush()
+    assert not config.dirty_keys
+    assert config.get("max_warnings") == 7
+    with open(bot_module.CONFIG_FILE, encoding="utf-8") as f:
+        assert json.load(f)["max_warnings"] == 7
@@ -0,0 +1,33 @@
+from bot import ResponseMatcher
+
+
+def make_matcher(*pairs):
+    matcher = ResponseMatcher()
+    matcher.load(pairs)
+    return matcher
+
+
+def test_finds_whole_words_only():
+    matcher = make_matcher(("سلام", "درود"), ("hi", "hello"))
+    assert matcher.get_response("سلام دوستان") == "درود"
+    assert matcher.get_response("this is hidden") is None
+    assert matcher.get_response("Hi there") == "hello"
+
+
+def test_longest_word_wins():
+    matcher = make_matcher(("good", "a"), ("good morning", "b"))
+    assert matcher.get_response("good morning all") == "b"
+    assert sorted(matcher.find("good morning all")) == ["good", "good morning"]
+
+
+def test_remove_and_set_responses():
+    matcher = make_matcher(("bye", "ciao"))
+    matcher.remove("bye", "ciao")
+    assert matcher.get_response("bye") is None
+    matcher.set_responses("bye", ["later"])
+    assert matcher.get_response("ok bye") == "later"
+
+
+def test_overlapping_words():
+    matcher = make_matcher(("he", "1"), ("she", "2"), ("hers", "3"))
+    assert sorted(matcher.find("she hers he")) == ["he", "hers", "she"]
@@ -0,0 +1,41 @@
+import pytest
+
+from bot import CATALOGS, CONFIG_TEMPLATE_FIELDS, MessageCatalog, Template
+
+
+def test_template_renders_fields():
+    template = Template("سلام {name} به {group}", CONFIG_TEMPLATE_FIELDS)
+    assert template.fields == {"name", "group"}
+    assert template.render(name="علی", group="تست") == "سلام علی به تست"
+
+
+def test_static_template_returns_same_text():
+    template = Template("بدون متغیر {{براکت}}")
+    assert template.static == "بدون متغیر {براکت}"
+    assert template.render() is template.static
+
+
+@pytest.mark.parametrize("text", [
+    "{}",
+    "{name.attr}",
+    "{name[0]}",
+    "{name:>10}",
+    "{name!r}",
+    "{unknown}",
+    "unclosed {name",
+])
+def test_invalid_placeholders_rejected(text):
+    with pytest.raises(ValueError):
+        MessageCatalog.validate(text)
+
+
+def test_all_catalog_texts_parse():
+    catalog = MessageCatalog(config={})
+    for lang in CATALOGS:
+        for key in CATALOGS[lang]:
+            catalog._template(lang, key)
+
+
+def test_broken_config_template_is_sent_verbatim():
+    catalog = MessageCatalog(config={"welcome_message": "hi {user.name}"})
+    assert catalog.format("welcome_message", name="x", time="", group="") == "hi {user.name}"
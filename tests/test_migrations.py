@@ -0,0 +1,93 @@
+import sqlite3
+
+import bot as bot_module
+
+# جدول‌های نسخه اول ربات، قبل از وجود schema_version
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        phone TEXT,
+        language TEXT DEFAULT 'fa',
+        bio TEXT,
+        country TEXT,
+        message_count INTEGER DEFAULT 0,
+        total_time INTEGER DEFAULT 0,
+        join_date TEXT,
+        last_seen TEXT,
+        tokens INTEGER DEFAULT 0,
+        is_admin INTEGER DEFAULT 0,
+        admin_until TEXT,
+        is_muted INTEGER DEFAULT 0,
+        mute_until TEXT,
+        warnings INTEGER DEFAULT 0
+    );
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        chat_id INTEGER,
+        text TEXT,
+        date TEXT
+    );
+    CREATE TABLE responses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        word TEXT,
+        response TEXT,
+        added_by INTEGER,
+        added_date TEXT
+    );
+    CREATE TABLE contests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start_date TEXT,
+        end_date TEXT,
+        winner_id INTEGER,
+        prize TEXT
+    );
+    CREATE TABLE group_settings (
+        chat_id INTEGER PRIMARY KEY,
+        welcome_enabled INTEGER DEFAULT 1,
+        goodbye_enabled INTEGER DEFAULT 1,
+        antispam_enabled INTEGER DEFAULT 1,
+        learning_enabled INTEGER DEFAULT 1
+    );
+'''
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def test_baseline_database_migrates_to_latest(workdir):
+    conn = sqlite3.connect(bot_module.DATABASE_NAME)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (user_id, username, first_name, message_count) VALUES (1, 'alice', 'Alice', 2)")
+    conn.executemany("INSERT INTO messages (user_id, chat_id, text, date) VALUES (?, ?, ?, ?)",
+                     [(1, -10, "hello", "2024-01-01T10:00:00"), (1, -10, "again", "2024-01-01T11:00:00")])
+    conn.execute("INSERT INTO responses (word, response, added_by, added_date) VALUES ('hi', 'hello', 1, '')")
+    conn.commit()
+    conn.close()
+
+    db = bot_module.Database()
+    try:
+        latest = max(version for version, _, _ in bot_module.MIGRATIONS)
+        assert db.get_schema_version() == latest == 10
+        assert {"message_id"} <= columns(db.conn, "messages")
+        assert {"owner", "lease_until"} <= columns(db.conn, "broadcast_jobs")
+        assert {"retention_days"} <= columns(db.conn, "group_settings")
+
+        # داده‌های قبلی سالم می‌مانند و شمارنده‌های هر گروه پر می‌شوند
+        assert db.get_user(1)[1] == "alice"
+        assert db.get_message_count() == 2
+        assert db.get_top_users(-10, 10) == [(1, "Alice", "alice", 2)]
+        assert db.get_all_response_pairs() == [("hi", "hello")]
+    finally:
+        db.close()
+
+    # اجرای دوباره مهاجرت‌ها چیزی را تغییر نمی‌دهد
+    db = bot_module.Database()
+    try:
+        assert db.get_schema_version() == 10
+    finally:
+        db.close()
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+import bot as bot_module
+
+
+def add_sample(db):
+    db.add_users([(1, "alice", "Alice", None), (2, "bob", "Bob", None), (3, None, "Carol", None)])
+    db.add_message(1, -10, "hello", 101)
+    db.add_message(2, -10, "hi", 102)
+    db.add_message(1, -10, "again", 103)
+    db.add_message(1, -20, "other chat", 5)
+    db.flush()
+
+
+def test_users_and_message_counts(storage):
+    add_sample(storage)
+    assert storage.get_user(1)[:3] == (1, "alice", "Alice")
+    assert storage.get_user(1)[8] == 3
+    assert storage.get_message_count() == 4
+    assert storage.get_top_users(-10, 10) == [(1, "Alice", "alice", 2), (2, "Bob", "bob", 1)]
+    assert [row[0] for row in storage.get_top_users(None, 10)] == [1, 2, 3]
+
+
+def test_add_users_keeps_counts(storage):
+    add_sample(storage)
+    storage.add_users([(1, "alice2", "Alice", None)])
+    assert storage.get_user(1)[1] == "alice2"
+    assert storage.get_user(1)[8] == 3
+
+
+def test_message_ids(storage):
+    add_sample(storage)
+    assert storage.get_message_ids(-10, 10) == [103, 102, 101]
+    assert storage.get_message_ids(-10, 1) == [103]
+    assert storage.get_message_ids(-10, 10, user_id=2) == [102]
+    future = (datetime.now() + timedelta(hours=1)).isoformat()
+    assert storage.get_message_ids(-10, 10, since=future) == []
+
+
+def test_find_users_by_username(storage):
+    add_sample(storage)
+    assert sorted(storage.find_users_by_username(["ALICE", "bob", "nobody"])) == [(1, "alice"), (2, "bob")]
+
+
+def test_user_languages(storage):
+    add_sample(storage)
+    storage.set_user_languages([(1, "en")])
+    assert storage.get_user_languages([1, 2, 99]) == {1: "en", 2: "fa"}
+
+
+def test_mute_unmute_warn(storage):
+    add_sample(storage)
+    mute_until = storage.mute_users([2], 10)
+    assert datetime.fromisoformat(mute_until) > datetime.now()
+    assert storage.get_user(2)[15] == 1
+    storage.unmute_users([2])
+    assert storage.get_user(2)[15] == 0
+
+    assert storage.warn_users([3], 2, 30) == [(3, 1, None)]
+    (user_id, warnings, muted), = storage.warn_users([3], 2, 30)
+    assert (user_id, warnings) == (3, 2)
+    assert muted is not None
+
+
+def test_broadcast_lease(storage):
+    add_sample(storage)
+    job_id, total = storage.create_broadcast(1, "news")
+    assert total == 3
+    assert storage.claim_broadcast(job_id, "worker-a", 60)
+    assert not storage.claim_broadcast(job_id, "worker-b", 60)
+    assert storage.claim_broadcast(job_id, "worker-a", 60)
+
+    pending = storage.get_pending_recipients(job_id)
+    assert pending == [1, 2, 3]
+    storage.mark_broadcast_recipients(job_id, [(1, 1), (2, 2)])
+    assert storage.get_pending_recipients(job_id) == [3]
+    storage.finish_broadcast(job_id)
+    assert storage.get_broadcast(job_id)[4] == "done"
+    assert job_id not in storage.get_running_broadcasts()
+
+
+def test_expired_lease_can_be_taken(storage):
+    add_sample(storage)
+    job_id, _ = storage.create_broadcast(1, "news")
+    assert storage.claim_broadcast(job_id, "worker-a", -1)
+    assert storage.claim_broadcast(job_id, "worker-b", 60)
+
+
+def test_retention_policies(storage):
+    add_sample(storage)
+    storage.set_retention(-20, 0)
+    # ۰ یعنی نگهداری برای همیشه، نه مقدار پیش‌فرض
+    assert sorted(storage.get_retention_policies(30)) == [(-20, 0), (-10, 30)]
+    storage.set_retention(-10, 7)
+    assert sorted(storage.get_retention_policies(30)) == [(-20, 0), (-10, 7)]
+
+
+def test_archive_messages(storage):
+    storage.add_users([(1, "alice", "Alice", None)])
+    storage.add_messages([(1, -10, "old", "2020-01-05T10:00:00", 7), (1, -10, "new", "2099-01-05T10:00:00", 8)])
+    assert storage.archive_messages(-10, "2021-01-01") == 1
+    assert storage.get_message_ids(-10, 10) == [8]
+    if not isinstance(storage, bot_module.MemoryStorage):
+        rows = list(bot_module.read_archive(bot_module.archive_path("2020-01")))
+        assert [(row["text"], row["message_id"]) for row in rows] == [("old", 7)]
+
+
+def test_sharded_main_db_failure_does_not_duplicate_shard_rows(workdir, monkeypatch):
+    db = bot_module.ShardedSQLiteStorage()
+    try:
+        db.add_users([(1, "alice", "Alice", None)])
+        original = db._add_user_counts
+        calls = []
+
+        def failing_once(cursor, counts, last_seen):
+            calls.append(dict(counts))
+            if len(calls) == 1:
+                raise bot_module.sqlite3.OperationalError("database is locked")
+            return original(cursor, counts, last_seen)
+
+        monkeypatch.setattr(db, "_add_user_counts", failing_once)
+        now = datetime.now().isoformat()
+        # شاردها commit شده‌اند، پس خطای فایل اصلی نباید به تکرار همین ردیف‌ها برسد
+        db.add_messages([(1, -10, "a", now, 1), (1, -10, "b", now, 2)])
+        assert db.get_message_count() == 2
+        assert db.get_top_users(-10, 10) == [(1, "Alice", "alice", 2)]
+        assert db.get_user(1)[8] == 0
+
+        # شمارنده نگه‌داشته‌شده در نوشتن بعدی اضافه می‌شود
+        db.add_messages([(1, -10, "c", now, 3)])
+        assert calls[-1] == {1: 3}
+        assert db.get_message_count() == 3
+        assert db.get_user(1)[8] == 3
+    finally:
+        db.close()